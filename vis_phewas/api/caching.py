@@ -0,0 +1,91 @@
+"""
+HTTP conditional requests for the read endpoints of the API.
+
+The catalog only changes when it is reloaded, and the code producing the responses only changes with a release, so a
+response is identified by the release, the dataset version and the request it answers. Each response carries a strong
+ETag derived from all three, and a request whose If-None-Match matches it is
+answered with 304 Not Modified before the view runs, without querying the catalog. The responses are marked as
+cacheable by browsers and shared caches, which revalidate them with the ETag once they are older than
+API_CACHE_MAX_AGE seconds.
+"""
+import functools
+import hashlib
+from pathlib import Path
+from urllib.parse import urlencode
+
+from django.apps import apps
+from django.conf import settings
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+from mainapp.dataset import current_dataset_version
+
+
+def canonical_request(request) -> str:
+    """
+    Function to get the canonical form of a request, which is the same for requests with the same parameters in any
+    order.
+
+    :param request: The request
+    :return: The path, the sorted query parameters and the accepted media types of the request
+    """
+    query = sorted((key, value) for key, values in request.GET.lists() for value in values)
+    # The accepted media types select the renderer, so responses in different formats have different ETags
+    return f"{request.path}?{urlencode(query)}|{request.META.get('HTTP_ACCEPT', '')}"
+
+
+@functools.lru_cache(maxsize=1)
+def release_version() -> str:
+    """
+    Function to get the version of the deployed code, read once per process.
+
+    :return: The RELEASE_VERSION setting, or the SHA-256 digest of the Python source of the apps of the project if it is
+    not set
+    """
+    if getattr(settings, 'RELEASE_VERSION', ''):
+        return settings.RELEASE_VERSION
+    base_dir = Path(settings.BASE_DIR).resolve()
+    app_dirs = sorted(Path(config.path).resolve() for config in apps.get_app_configs()
+                      if Path(config.path).resolve().is_relative_to(base_dir))
+    digest = hashlib.sha256()
+    for app_dir in app_dirs:
+        for path in sorted(app_dir.rglob('*.py')):
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def dataset_etag(request, *args, **kwargs) -> str:
+    """
+    Function to get the ETag of the response to a request.
+
+    :param request: The request
+    :return: The first 32 characters of the SHA-256 digest of the release, the dataset version and the canonical
+    request
+    """
+    return hashlib.sha256(
+        f"{release_version()}|{current_dataset_version()}|{canonical_request(request)}".encode()).hexdigest()[:32]
+
+
+def conditional_on_dataset(view_method):
+    """
+    Decorator for the get method of an API view, answering the requests whose ETag matches with 304 Not Modified and
+    making the successful responses cacheable.
+
+    :param view_method: The get method of the view
+    :return: The decorated method
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        response = condition(etag_func=dataset_etag)(
+            lambda request, *args, **kwargs: view_method(self, request, *args, **kwargs))(request, *args, **kwargs)
+        if response.status_code not in (200, 304):
+            # Errors can be transient, so they are never revalidated
+            if response.has_header('ETag'):
+                del response['ETag']
+            return response
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'API_CACHE_MAX_AGE', 0),
+                            must_revalidate=True)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    return wrapper
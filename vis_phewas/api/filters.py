@@ -0,0 +1,187 @@
+"""
+Filters of the catalog sent by the front end.
+
+A filters string such as "gene_name:==:A AND p:<:0.01" is compiled into predicates that are combined from left to
+right, which apply_filters turns into a query of the catalog and the catalog snapshot engine into SQL. The API views
+and the SOM input both filter the catalog with them.
+"""
+import html
+import re
+
+from django.db.models import Q, QuerySet
+
+
+def normalise_snp_filter(filter_str):
+    """
+    Normalise a single SNP filter to be case-insensitive, handle different delimiters,
+    and ensure HLA_[gene_name]_[first_two_numbers][optional_next_two_numbers] format is used only for :==: operator.
+    :param filter_str: The filter string containing SNP conditions.
+    :return: The normalised filter string.
+    """
+
+    def normalise_snp(snp_value, include_prefix):
+        # Remove any leading 'HLA' or unnecessary delimiters
+        snp_value = re.sub(r'^HLA[-_\s]?', '', snp_value, flags=re.IGNORECASE)
+
+        # normalise delimiters to underscores
+        snp_value = re.sub(r'[-\s/*]', '_', snp_value)
+
+        # Capture the gene name and the numbers separately
+        match = re.match(r'([A-Z]+\d?)[_\s-]?(\d{2})([:_\s-]?(\d{2}))?$', snp_value, flags=re.IGNORECASE)
+        if match:
+            gene_name = match.group(1).upper()  # Ensure gene name is uppercase
+            first_two_digits = match.group(2)  # Capture the first two digits
+            next_two_digits = match.group(4) if match.group(4) else ""  # Capture the next two digits if present
+            result = f'{gene_name}_{first_two_digits}{next_two_digits}'
+            return f'HLA_{result}' if include_prefix else result
+        else:
+            # If no match, return the original value (preserving the gene name normalization)
+            return f'HLA_{snp_value.upper()}' if include_prefix else snp_value.upper()
+
+    # Identify the operator and SNP part
+    match = re.match(r'(snp\s*[:_-]?)((==|:==:|contains):?\s*)((?:HLA[-_ ]?)?[A-Z0-9-_\s/*:]+)', filter_str,
+                     flags=re.IGNORECASE)
+    if match:
+        operator = match.group(3).strip().lower()
+        snp_value = match.group(4).strip()
+
+        # Determine if the HLA prefix should be included based on the operator
+        include_prefix = operator == "=="
+
+        # normalise the SNP value
+        normalised_snp = normalise_snp(snp_value, include_prefix)
+
+        # Return the normalised condition
+        return f"{match.group(1)}{operator}:{normalised_snp}"
+
+    return filter_str  # Return the filter as-is if no match
+
+
+def apply_filters(queryset: QuerySet, filters: str, category_id: str = None, show_subtypes: bool = False,
+                  export: bool = False, initial: bool = False) -> QuerySet:
+    """
+    Apply the filters to the queryset.
+    :param initial:
+    :param export:
+    :param queryset:
+    :param filters:
+    :param category_id:
+    :param show_subtypes: Whether to show the subtypes of the alleles or just the main groups
+    :return: Filtered queryset
+    """
+    # If the category_id is provided, filter the queryset by the category
+    if category_id:
+        category_string: str = category_id.replace('category-', '').replace('_', ' ')
+        queryset = queryset.filter(category_string=category_string)
+    # If the export flag is set, return the queryset without any filters
+    if not export and not initial:
+        # If show_subtypes is not set, filter the queryset to show only the subtypes# If the show_subtypes flag is set, filter the queryset to show only the main groups
+        if not show_subtypes:
+            queryset = queryset.filter(subtype='00')
+
+        # If the show_subtypes flag is set, filter the queryset to show only the main groups
+        else:
+            queryset = queryset.exclude(subtype='00')
+
+    # If no filters are provided, return the queryset filtered to show only the significant results
+    if not filters:
+        return queryset.filter(p__lte=0.05)
+
+    # Apply the filters to the queryset
+    combined_query: Q = Q()
+    for logical_operator, field, operator, value in compile_filters(filters, show_subtypes):
+        # Apply the filter based on the operator
+        if operator == '==':
+            q: Q = Q(**{f'{field}__iexact': value})
+        elif operator == 'contains':
+            q = Q(**{f'{field}__icontains': value})
+        elif operator == '>':
+            q = Q(**{f'{field}__gt': value})
+        elif operator == '<':
+            q = Q(**{f'{field}__lt': value})
+        elif operator == '>=':
+            q = Q(**{f'{field}__gte': value})
+        else:
+            q = Q(**{f'{field}__lte': value})
+
+        # Combine the queries based on the logical operator
+        if logical_operator == 'AND':
+            combined_query &= q
+        elif logical_operator == 'OR':
+            combined_query |= q
+
+    # Filter the queryset based on the combined query
+    queryset = queryset.filter(combined_query)
+    # Filter the queryset to show only the significant results
+    filtered_queryset: QuerySet = queryset.filter(p__lte=0.05)
+    return filtered_queryset
+
+
+def compile_filters(filters: str, show_subtypes: bool = False) -> list:
+    """
+    Compile the filters string into the predicates apply_filters combines from left to right.
+    :param filters: The filters string
+    :param show_subtypes: Whether to show the subtypes of the alleles or just the main groups
+    :return: List of (logical operator, field, operator, value) tuples, without the filters that cannot be applied
+    """
+    if not filters:
+        return []
+
+    filters = html.unescape(filters)  # Unescape the HTML entities in the filters to handle escapes <, >, etc.
+
+    # If show_subtypes is false, remove the last two digits of the SNP filter
+    if not show_subtypes:
+        # Match HLA_[letter]_[four digits] and capture only the first two digits
+        filters = re.sub(r'(HLA_[A-Z]_\d{2})\d{2}', r'\1', filters)
+
+    # Parse the filters into predicates
+    filter_list: list = parse_filters(filters)
+    predicates: list = []
+    for logical_operator, filter_str in filter_list:
+        if filter_str.startswith('snp'):
+            filter_str = normalise_snp_filter(filter_str)
+        parts: list = filter_str.split(':', 2)
+        if len(parts) < 3:
+            continue
+        field, operator, value = parts
+        value = value.rstrip(',')
+        # Skip the filters with an unknown operator
+        if operator not in ('==', 'contains', '>', '<', '>=', '<='):
+            continue
+        predicates.append((logical_operator, field, operator, value))
+    return predicates
+
+
+def parse_filters(filters: str) -> list:
+    """
+    Parse the filters string into a list of tuples.
+    :param filters:
+    :return:
+    """
+    # Initialise the filter list and the current operator
+    filter_list: list = []
+    # Initialise the pattern to match the logical operators
+    current_operator = None
+    # Initialise the pattern to match the logical operators
+    pattern = re.compile(r'\s*(AND|OR)\s*')
+    # Split the filters string into parts based on the logical operators
+    parts: list = pattern.split(filters)
+
+    # Loop through the parts and add them to the filter list
+    for part in parts:
+        part = part.strip()
+        # If the part is a logical operator, set the current operator
+        if part in ('AND', 'OR'):
+            current_operator = part
+        # If the part is not a logical operator, add it to the filter list
+        elif part:
+            sub_parts: list = re.findall(r'([^,]+|"[^"]*")+', part)
+            for sub_part in sub_parts:
+                sub_part = sub_part.strip().strip('"')
+                if current_operator:
+                    filter_list.append((current_operator, sub_part))
+                    current_operator = None
+                else:
+                    filter_list.append(('AND', sub_part))
+    # Return the filter list
+    return filter_list
@@ -0,0 +1,118 @@
+"""
+Compact encoding of the graph data responses.
+
+The default responses repeat the full ID of each node in the nodes, in the source and target of every edge and in the
+visible nodes, and spread every allele column into each node. The compact format stores each distinct string once in
+a string table, and refers to it by index everywhere else:
+
+    {
+        "format": "compact-v1",
+        "strings": ["allele-HLA_A_01", "HLA_A_01", "allele", ...],
+        "nodes": {"id": [0, ...], "columns": {"label": [1, ...], "p": [0.01, ...], ...},
+                  "string_columns": ["label", ...]},
+        "edges": [source0, target0, source1, target1, ...],
+        "visible": [0, ...]
+    }
+
+Node attributes are stored column by column, in the order of the nodes, with None for the nodes that do not have the
+attribute. Only the columns whose values are all strings are stored as indices into the string table; columns mixing
+strings with other values are stored as they are. The positions returned with layout=true become the x and y columns.
+"""
+from collections import OrderedDict
+
+COMPACT_FORMAT = 'compact-v1'
+
+
+class StringTable:
+    """
+    Table of the distinct strings of a response, indexed in the order they are first added.
+    """
+
+    def __init__(self):
+        self.indices = OrderedDict()
+
+    def index(self, value: str) -> int:
+        """
+        Method to get the index of a string, adding it to the table if it is not in it.
+
+        :param value: The string
+        :return: The index of the string in the table
+        """
+        index = self.indices.get(value)
+        if index is None:
+            index = self.indices[value] = len(self.indices)
+        return index
+
+    def strings(self) -> list:
+        """
+        :return: The strings in the order of their indices
+        """
+        return list(self.indices)
+
+
+def encode_compact_graph(nodes: list, edges: list, visible: list, positions: dict = None) -> dict:
+    """
+    This function encodes a graph response in the compact format
+    :param nodes: The nodes of the response
+    :param edges: The edges of the response
+    :param visible: The IDs of the visible nodes
+    :param positions: Dictionary of node ID to [x, y], or None if the response is not laid out
+    :return: The compact response
+    """
+    table = StringTable()
+    ids = [table.index(node['id']) for node in nodes]
+
+    # Collect the attributes of the nodes column by column, in the order they first appear
+    names = OrderedDict((name, None) for node in nodes for name in node if name != 'id')
+    columns, string_columns = {}, []
+    for name in names:
+        values = [node.get(name) for node in nodes]
+        present = [value for value in values if value is not None]
+        # A column mixing strings with numbers is sent as is, as its numbers could not be told apart from indices
+        if present and all(isinstance(value, str) for value in present):
+            string_columns.append(name)
+            values = [None if value is None else table.index(value) for value in values]
+        columns[name] = values
+    if positions is not None:
+        placed = [positions.get(node['id']) for node in nodes]
+        columns['x'] = [position[0] if position else None for position in placed]
+        columns['y'] = [position[1] if position else None for position in placed]
+
+    edge_indices = []
+    for edge in edges:
+        edge_indices.extend((table.index(edge['source']), table.index(edge['target'])))
+    visible_indices = [table.index(node_id) for node_id in visible]
+
+    return {'format': COMPACT_FORMAT, 'strings': table.strings(),
+            'nodes': {'id': ids, 'columns': columns, 'string_columns': string_columns},
+            'edges': edge_indices, 'visible': visible_indices}
+
+
+def decode_compact_graph(payload: dict) -> tuple:
+    """
+    This function decodes a compact graph response, as the front end does
+    :param payload: The compact response
+    :return: The nodes, edges, visible nodes and positions (None if the response is not laid out)
+    """
+    if payload.get('format') != COMPACT_FORMAT:
+        raise ValueError(f"Unknown graph format: {payload.get('format')}")
+    strings = payload['strings']
+    node_ids = [strings[index] for index in payload['nodes']['id']]
+    columns = dict(payload['nodes']['columns'])
+    for name in payload['nodes']['string_columns']:
+        columns[name] = [strings[index] if index is not None else None for index in columns[name]]
+
+    positions = None
+    if 'x' in columns:
+        xs, ys = columns.pop('x'), columns.pop('y')
+        positions = {node_id: [x, y] for node_id, x, y in zip(node_ids, xs, ys) if x is not None}
+
+    nodes = []
+    for i, node_id in enumerate(node_ids):
+        node = {'id': node_id}
+        node.update((name, values[i]) for name, values in columns.items() if values[i] is not None)
+        nodes.append(node)
+    edges = [{'source': strings[source], 'target': strings[target]}
+             for source, target in zip(payload['edges'][::2], payload['edges'][1::2])]
+    visible = [strings[index] for index in payload['visible']]
+    return nodes, edges, visible, positions
@@ -0,0 +1,195 @@
+"""
+Server-side layout of the graph.
+
+The positions of the category and disease nodes are computed once per dataset version from the hierarchy of the
+significant associations, with categories on a circle and the diseases of each category around it, so that every
+filtered subset of the graph reuses the same positions. The alleles of a disease are placed on a staggered arc
+pointing away from its category, computed for all the alleles of a response at once with NumPy. The layout of each
+response is cached per canonical request, so clients only have to place the nodes instead of laying out the graph.
+
+The geometry is the same as GraphHelper.applyLayout in the front end, which remains the fallback when no positions
+are returned.
+"""
+import functools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from mainapp.dataset import get_dataset_version
+from mainapp.models import HlaPheWasCatalog
+
+# Centre of the graph and radius of the circle of categories
+LAYOUT_CENTER = (500.0, 500.0)
+CATEGORY_RADIUS = 600.0
+
+# Radius of the circle of diseases around their category
+DISEASE_RADIUS = 50.0
+
+# Radius of the closest allele to its disease, the increase of the radius along the arc, and the angle of the arc
+ALLELE_BASE_RADIUS = 40.0
+ALLELE_RADIUS_STEP = 40.0
+ALLELE_SPREAD = np.pi / 3
+
+
+def category_node_id(category_string: str) -> str:
+    """
+    :param category_string: The category
+    :return: The ID of the category node in the graph
+    """
+    return f"category-{category_string.replace(' ', '_')}"
+
+
+def disease_node_id(phewas_string: str) -> str:
+    """
+    :param phewas_string: The disease
+    :return: The ID of the disease node in the graph
+    """
+    return f"disease-{phewas_string.replace(' ', '_')}"
+
+
+def radial_positions(count: int, radius: float, center=LAYOUT_CENTER) -> np.ndarray:
+    """
+    This function places nodes evenly on a circle, in the order of the front end
+    :param count: The number of nodes
+    :param radius: The radius of the circle
+    :param center: The centre of the circle
+    :return: Array of shape (count, 2) with the x and y coordinates of the nodes
+    """
+    angles = 2 * np.pi * np.arange(count) / max(count, 1)
+    return np.column_stack([center[0] + radius * np.sin(angles), center[1] + radius * np.cos(angles)])
+
+
+@functools.lru_cache(maxsize=2)
+def hierarchy_layout(dataset_version: str) -> dict:
+    """
+    This function computes the positions of the category and disease nodes of a catalog version
+    :param dataset_version: The dataset version, which the positions are cached for
+    :return: Dictionary of node ID to (x, y), and of disease node ID to the position of its category under the
+    'parents' key
+    """
+    pairs = (HlaPheWasCatalog.objects.filter(p__lte=0.05).values_list('category_string', 'phewas_string')
+             .distinct().order_by('category_string', 'phewas_string'))
+    diseases_by_category = OrderedDict()
+    for category_string, phewas_string in pairs:
+        diseases_by_category.setdefault(category_string, []).append(phewas_string)
+
+    positions, parents = {}, {}
+    category_positions = radial_positions(len(diseases_by_category), CATEGORY_RADIUS)
+    for (category_string, diseases), category_position in zip(diseases_by_category.items(), category_positions):
+        positions[category_node_id(category_string)] = tuple(category_position)
+        for phewas_string, disease_position in zip(diseases, radial_positions(len(diseases), DISEASE_RADIUS,
+                                                                               category_position)):
+            # A disease in several categories keeps the position around the first one
+            disease_id = disease_node_id(phewas_string)
+            if disease_id not in positions:
+                positions[disease_id] = tuple(disease_position)
+                parents[disease_id] = tuple(category_position)
+    return {'positions': positions, 'parents': parents}
+
+
+def allele_positions(alleles: list, hierarchy: dict) -> dict:
+    """
+    This function places alleles on staggered arcs around their diseases, pointing away from the categories of the
+    diseases, with the arcs of all the diseases computed at once
+    :param alleles: List of (allele node ID, label, disease node ID)
+    :param hierarchy: The hierarchy layout, as returned by hierarchy_layout
+    :return: Dictionary of allele node ID to (x, y), without the alleles of diseases that have no position
+    """
+    alleles = [allele for allele in alleles if allele[2] in hierarchy['positions']]
+    if not alleles:
+        return {}
+    # Sort the alleles of each disease by their label in descending order, as the front end does
+    alleles.sort(key=lambda allele: allele[1].lower(), reverse=True)
+    alleles.sort(key=lambda allele: allele[2])
+
+    diseases = np.array([allele[2] for allele in alleles])
+    _, starts, counts = np.unique(diseases, return_index=True, return_counts=True)
+    sizes = np.repeat(counts, counts).astype(float)
+    index = np.arange(len(alleles)) - np.repeat(starts, counts)
+
+    disease_xy = np.array([hierarchy['positions'][disease] for disease in diseases])
+    category_xy = np.array([hierarchy['parents'][disease] for disease in diseases])
+    disease_angles = np.arctan2(disease_xy[:, 1] - category_xy[:, 1], disease_xy[:, 0] - category_xy[:, 0])
+
+    radii = ALLELE_BASE_RADIUS + index / sizes * ALLELE_RADIUS_STEP
+    angles = disease_angles + (index - (sizes - 1) / 2) * (ALLELE_SPREAD / sizes)
+    xy = disease_xy + radii[:, None] * np.column_stack([np.cos(angles), np.sin(angles)])
+    return {allele[0]: tuple(position) for allele, position in zip(alleles, xy)}
+
+
+def compute_graph_layout(nodes: list, edges: list, dataset_version: str) -> dict:
+    """
+    This function computes the positions of the nodes of a graph response
+    :param nodes: The nodes of the response
+    :param edges: The edges of the response
+    :param dataset_version: The dataset version of the catalog the nodes were read from
+    :return: Dictionary of node ID to [x, y] rounded to two decimals, for the nodes that can be placed
+    """
+    hierarchy = hierarchy_layout(dataset_version)
+    parent_by_node = {edge['target']: edge['source'] for edge in edges}
+
+    positions = {node['id']: hierarchy['positions'][node['id']] for node in nodes
+                 if node['node_type'] != 'allele' and node['id'] in hierarchy['positions']}
+    positions.update(allele_positions(
+        [(node['id'], node['label'], parent_by_node.get(node['id'])) for node in nodes
+         if node['node_type'] == 'allele'], hierarchy))
+    return {node_id: [round(float(x), 2), round(float(y), 2)] for node_id, (x, y) in positions.items()}
+
+
+class GraphLayoutCache:
+    """
+    In-process LRU cache of the layouts of graph responses, keyed by the canonical request.
+    """
+
+    def __init__(self, max_size: int):
+        """
+        :param max_size: Maximum number of layouts to keep
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: tuple, compute):
+        """
+        Method to get a cached layout, computing and caching it if it is not cached.
+
+        :param key: The canonical request
+        :param compute: Function computing the layout
+        :return: The layout
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        layout = compute()
+        with self._lock:
+            self._entries[key] = layout
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return layout
+
+    def clear(self):
+        """
+        Remove every layout from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+layout_cache = GraphLayoutCache(getattr(settings, 'GRAPH_LAYOUT_CACHE_SIZE', 256))
+
+
+def graph_layout(request_key: tuple, nodes: list, edges: list) -> dict:
+    """
+    This function gets the positions of the nodes of a graph response, from the cache if the same request was laid
+    out for the current catalog
+    :param request_key: The canonical request, made of the type, parent node, compiled filters and subtype flag
+    :param nodes: The nodes of the response
+    :param edges: The edges of the response
+    :return: Dictionary of node ID to [x, y]
+    """
+    dataset_version = get_dataset_version()
+    return layout_cache.get_or_compute((dataset_version,) + tuple(request_key),
+                                       lambda: compute_graph_layout(nodes, edges, dataset_version))
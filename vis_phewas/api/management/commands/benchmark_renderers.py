@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+from api.renderers import FastJSONRenderer, finite_floats, stream_json_list, orjson
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+
+def combined_associations_payload(rows: int, seed: int = 0) -> list:
+    """
+    Function to generate combined associations shaped like the responses of CombinedAssociationsView.
+
+    :param rows: Number of combined associations
+    :param seed: Seed of the random values
+    :return: List of combined associations, a few of which have non-finite odds ratios
+    """
+    rng = np.random.default_rng(seed)
+    odds_ratios = rng.lognormal(size=rows)
+    odds_ratios[::997] = np.inf
+    p_values = rng.uniform(0, 0.05, size=rows)
+    return [{'gene1': f"A_{i % 100:02d}", 'gene1_name': 'A', 'gene1_serotype': f"{i % 100:02d}", 'gene1_subtype': '00',
+             'gene2': f"B_{i % 97:02d}", 'gene2_name': 'B', 'gene2_serotype': f"{i % 97:02d}", 'gene2_subtype': '00',
+             'combined_odds_ratio': float(odds_ratio), 'combined_p_value': float(p_value)}
+            for i, (odds_ratio, p_value) in enumerate(zip(odds_ratios, p_values))]
+
+
+class Command(BaseCommand):
+    help = 'Compares the time taken to render a large API response with the DRF and the fast JSON renderers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000, help='Number of combined associations to render')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of times each renderer is timed')
+
+    def time_renderer(self, render, repeat: int) -> tuple:
+        # Keep the best time, which is the least disturbed by the rest of the machine
+        best = float('inf')
+        size = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            size = len(render())
+            best = min(best, time.perf_counter() - start)
+        return best, size
+
+    def handle(self, *args, **kwargs):
+        payload = combined_associations_payload(kwargs['rows'])
+        self.stdout.write(f"Rendering {len(payload)} combined associations, best of {kwargs['repeat']} runs "
+                          f"({'orjson' if orjson is not None else 'orjson is not installed, DRF encoder'})")
+
+        # The DRF renderer rejects non-finite floats, so it renders a copy with them replaced beforehand
+        finite_payload = finite_floats(payload)
+        timings = {
+            'DRF JSONRenderer': lambda: JSONRenderer().render(finite_payload),
+            'FastJSONRenderer': lambda: FastJSONRenderer().render(payload),
+            'Streamed chunks': lambda: b''.join(stream_json_list(payload)),
+        }
+        baseline = None
+        for name, render in timings.items():
+            seconds, size = self.time_renderer(render, kwargs['repeat'])
+            baseline = baseline or seconds
+            self.stdout.write(f"{name:<18} {seconds * 1000:9.1f} ms {size / 1024:9.0f} KiB "
+                              f"{baseline / seconds:6.1f}x")
@@ -0,0 +1,33 @@
+import time
+from datetime import timedelta
+
+from api.models import TemporaryCSVData
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Deletes the SOM data staged by the API that has not been used recently'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-hours', type=float, default=None,
+                            help='Age of the last use beyond which staged data is deleted (defaults to '
+                                 'TEMPORARY_DATA_MAX_AGE_HOURS)')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and sweep every this many seconds instead of sweeping once')
+
+    def handle(self, *args, **kwargs):
+        max_age_hours = kwargs['max_age_hours']
+        if max_age_hours is None:
+            max_age_hours = getattr(settings, 'TEMPORARY_DATA_MAX_AGE_HOURS', 24)
+
+        while True:
+            # Staged data is kept while requests keep staging the same rows, and expires purely on its last use
+            threshold_time = timezone.now() - timedelta(hours=max_age_hours)
+            deleted, _ = TemporaryCSVData.objects.filter(last_used_at__lt=threshold_time).delete()
+            self.stdout.write(f"Deleted {deleted} staged data records last used before {threshold_time:%Y-%m-%d %H:%M}")
+
+            if kwargs['interval'] is None:
+                break
+            time.sleep(kwargs['interval'])
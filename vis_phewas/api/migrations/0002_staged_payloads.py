@@ -0,0 +1,39 @@
+# Generated by Django 5.1 on 2026-10-19 07:59
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='temporarycsvdata',
+            name='content_hash',
+            field=models.CharField(max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='temporarycsvdata',
+            name='last_used_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='temporarycsvdata',
+            name='payload',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='temporarycsvdata',
+            name='ref_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='temporarycsvdata',
+            name='csv_content',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1 on 2026-10-19 12:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_staged_payloads'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='temporarycsvdata',
+            name='ref_count',
+        ),
+    ]
@@ -1,11 +1,89 @@
-from django.db import models
+import hashlib
+from io import BytesIO, StringIO
+
+import numpy as np
+import pandas as pd
+from django.db import models, IntegrityError, transaction
+from django.utils import timezone
+from pandas.api.types import is_numeric_dtype
 
 
 class TemporaryCSVData(models.Model):
-    csv_content = models.TextField()  # Store the CSV content as text
+    csv_content = models.TextField(blank=True, default='')  # CSV content of the rows staged before payloads
+    payload = models.BinaryField(null=True)  # Compressed npz archive with one array per column of the staged rows
+    content_hash = models.CharField(max_length=64, unique=True, null=True)  # Hash of the SOM type and staged rows
     som_type = models.CharField(max_length=100)  # Store the SOM type, e.g., 'disease' or 'allele'
     created_at = models.DateTimeField(
         auto_now_add=True)  # Automatically set the field to now when the object is first created
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)  # Last time the rows were staged
 
     def __str__(self):
         return f"Temporary CSV Data (ID: {self.id})"
+
+    @classmethod
+    def stage(cls, df: pd.DataFrame, som_type: str) -> 'TemporaryCSVData':
+        """
+        Stage the rows of a SOM input, reusing the staged copy of the same rows if there is one.
+        :param df: The rows to stage
+        :param som_type: The type of the SOM the rows are staged for
+        :return: The staged data, with its last use updated if it was already staged
+        """
+        content_hash = hash_dataframe(df, som_type)
+        # Reuse the staged copy of the same rows without rewriting its payload
+        if cls.objects.filter(content_hash=content_hash).update(last_used_at=timezone.now()):
+            return cls.objects.get(content_hash=content_hash)
+        try:
+            # The savepoint lets the lookup below run if another request staged the same rows at the same time
+            with transaction.atomic():
+                return cls.objects.create(payload=encode_dataframe(df), content_hash=content_hash, som_type=som_type)
+        except IntegrityError:
+            cls.objects.filter(content_hash=content_hash).update(last_used_at=timezone.now())
+            return cls.objects.get(content_hash=content_hash)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Read the staged rows back.
+        :return: The staged rows as a DataFrame
+        """
+        if self.payload is None:
+            # Rows staged before payloads were introduced are stored as CSV text
+            return pd.read_csv(StringIO(self.csv_content))
+        return decode_dataframe(bytes(self.payload))
+
+
+def hash_dataframe(df: pd.DataFrame, som_type: str) -> str:
+    """
+    Hash the rows of a DataFrame, used to find rows that were already staged.
+    :param df: The DataFrame to hash
+    :param som_type: The type of the SOM the rows are staged for
+    :return: The SHA-256 digest of the SOM type, columns and rows
+    """
+    digest = hashlib.sha256(f"{som_type}:{','.join(map(str, df.columns))}".encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def encode_dataframe(df: pd.DataFrame) -> bytes:
+    """
+    Encode a DataFrame as a compressed npz archive with one array per column.
+    :param df: The DataFrame to encode
+    :return: The bytes of the archive
+    """
+    buffer = BytesIO()
+    # Text and categorical columns are stored as fixed-width unicode arrays so that the archive never needs pickling
+    # to be read
+    columns = {column: values.to_numpy() if is_numeric_dtype(values) else values.to_numpy(dtype=str)
+               for column, values in df.items()}
+    np.savez_compressed(buffer, **columns)
+    return buffer.getvalue()
+
+
+def decode_dataframe(payload: bytes) -> pd.DataFrame:
+    """
+    Decode a DataFrame encoded by encode_dataframe.
+    :param payload: The bytes of the archive
+    :return: The decoded DataFrame, with the text columns as categoricals
+    """
+    with np.load(BytesIO(payload), allow_pickle=False) as archive:
+        return pd.DataFrame({column: pd.Categorical(archive[column].astype(object))
+                             if archive[column].dtype.kind == 'U' else archive[column] for column in archive.files})
@@ -0,0 +1,164 @@
+"""
+Renderers of the API responses.
+
+JSON responses are encoded with orjson when it is installed, which is several times faster than the standard library
+encoder on the large lists of associations the graph and combined associations return, and with the DRF encoder
+otherwise. Either way, NaN and infinite floats, which JSON cannot represent, are rendered as null. Long lists can also
+be streamed as a JSON array encoded chunk by chunk.
+"""
+import itertools
+import math
+
+import numpy as np
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+
+try:
+    import msgpack
+except ImportError:  # Responses are only served as JSON
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # The DRF encoder is used instead
+    orjson = None
+
+# Number of items of a streamed list encoded at a time
+STREAM_CHUNK_ITEMS = 1000
+
+
+def finite_floats(data):
+    """
+    Function to replace the NaN and infinite floats of the data with None, as JSON cannot represent them.
+
+    :param data: The data, made of dictionaries, lists, tuples and scalars
+    :return: The data with its non-finite floats replaced
+    """
+    if isinstance(data, dict):
+        return {key: finite_floats(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [finite_floats(value) for value in data]
+    if isinstance(data, (float, np.floating)) and not math.isfinite(data):
+        return None
+    return data
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer encoding with orjson if it is installed, and rendering NaN and infinite floats as null.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """
+        Method to render the data as JSON.
+
+        :param data: The data to render
+        :param accepted_media_type: The media type accepted by the client, which may ask for an indented response
+        :param renderer_context: The context of the view
+        :return: The JSON bytes
+        """
+        if data is None:
+            return b''
+        if orjson is None:
+            return super().render(finite_floats(data), accepted_media_type, renderer_context)
+
+        # orjson renders NaN and infinite floats as null, and NumPy values as their Python equivalents
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            option |= orjson.OPT_INDENT_2
+        # Types orjson does not know, such as decimals and lazy strings, are converted by the DRF encoder
+        return orjson.dumps(data, default=encoders.JSONEncoder().default, option=option)
+
+
+def encode_json(data) -> bytes:
+    """
+    Function to encode data as compact JSON with the fast renderer.
+
+    :param data: The data to encode
+    :return: The JSON bytes
+    """
+    return FastJSONRenderer().render(data)
+
+
+def stream_json_list(items, chunk_size: int = STREAM_CHUNK_ITEMS):
+    """
+    Generator encoding a list as a JSON array chunk by chunk, so that the whole array is never held encoded.
+
+    :param items: The items of the list, which may be an iterator
+    :param chunk_size: The number of items encoded at a time
+    :return: The parts of the JSON array
+    """
+    items = iter(items)
+    separator = b''
+    yield b'['
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        # Encode the chunk as an array, and drop its brackets
+        yield separator + encode_json(chunk)[1:-1]
+        separator = b','
+    yield b']'
+
+
+class StreamingJSONListResponse(StreamingHttpResponse):
+    """
+    Response streaming a list as a JSON array.
+    """
+
+    def __init__(self, items, chunk_size: int = STREAM_CHUNK_ITEMS, **kwargs):
+        """
+        :param items: The items of the list, which may be an iterator
+        :param chunk_size: The number of items encoded at a time
+        """
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(stream_json_list(items, chunk_size), **kwargs)
+
+
+def list_response_is_streamed(items: list) -> bool:
+    """
+    Function to decide whether a list response is long enough to be streamed.
+
+    :param items: The items of the list
+    :return: Whether the list has at least JSON_STREAMING_MIN_ITEMS items
+    """
+    return len(items) >= getattr(settings, 'JSON_STREAMING_MIN_ITEMS', 10000)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renderer serving responses as MessagePack, selected with an Accept: application/msgpack header or
+    ?format=msgpack.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """
+        Method to render the data as MessagePack.
+
+        :param data: The data to render
+        :param accepted_media_type: The media type accepted by the client
+        :param renderer_context: The context of the view
+        :return: The MessagePack bytes
+        """
+        if data is None:
+            return b''
+        return msgpack.packb(data, use_bin_type=True)
+
+
+def graph_renderer_classes() -> list:
+    """
+    Function to get the renderers of the graph data responses.
+
+    :return: The default renderers, and the MessagePack renderer if msgpack is installed
+    """
+    renderers = list(api_settings.DEFAULT_RENDERER_CLASSES)
+    if msgpack is not None:
+        renderers.append(MessagePackRenderer)
+    return renderers
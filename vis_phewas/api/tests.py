@@ -1,13 +1,29 @@
+import json
 import unittest
+from datetime import timedelta
+from io import StringIO
 from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
 
 from django.test import TestCase
+from django.core.management import call_command
 from django.urls import reverse
+from django.utils import timezone
 from mainapp.models import HlaPheWasCatalog
 from rest_framework import status
 from rest_framework.test import APIClient
 
-from api.views import normalise_snp_filter
+from api.caching import release_version
+from api.filters import normalise_snp_filter
+from api.graph_format import decode_compact_graph, encode_compact_graph
+from api.layout import hierarchy_layout, layout_cache, LAYOUT_CENTER, CATEGORY_RADIUS, DISEASE_RADIUS, \
+    ALLELE_BASE_RADIUS, ALLELE_RADIUS_STEP
+from api.models import TemporaryCSVData
+from api.renderers import msgpack, FastJSONRenderer, finite_floats, stream_json_list
+from api.views import get_filtered_df
 
 
 class HlaPheWasCatalogTestCase(TestCase):
@@ -271,6 +287,220 @@ class HlaPheWasCatalogTestCase(TestCase):
         expected_diseases = ['brain cancer']
         self.assertEqual(response.data['diseases'], expected_diseases)
 
+    def test_send_data_to_som_view_deduplicates(self):
+        url = reverse('send_data_to_som')
+        response = self.client.get(url, {'filters': '', 'type': 'snp'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data_id = response.json()['data_id']
+        TemporaryCSVData.objects.filter(id=data_id).update(last_used_at=timezone.now() - timedelta(hours=1))
+
+        # Sending the same data again reuses the staged copy and renews its last use
+        response = self.client.get(url, {'filters': '', 'type': 'snp'})
+        self.assertEqual(response.json()['data_id'], data_id)
+        temp_data = TemporaryCSVData.objects.get(id=data_id)
+        self.assertGreater(temp_data.last_used_at, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(temp_data.csv_content, '')
+
+        # The staged rows read back as they were filtered
+        staged_df = temp_data.to_dataframe()
+        pd.testing.assert_frame_equal(staged_df, get_filtered_df(''), check_dtype=False)
+
+        # The same rows staged for the other SOM type are staged separately
+        response = self.client.get(url, {'filters': '', 'type': 'disease'})
+        self.assertNotEqual(response.json()['data_id'], data_id)
+        self.assertEqual(TemporaryCSVData.objects.count(), 2)
+
+    def test_sweep_temporary_data(self):
+        recent = TemporaryCSVData.stage(pd.DataFrame({'snp': ['HLA_A_01'], 'p': [0.01]}), 'snp')
+        old = TemporaryCSVData.stage(pd.DataFrame({'snp': ['HLA_B_01'], 'p': [0.02]}), 'snp')
+        legacy = TemporaryCSVData.objects.create(csv_content='snp,p\nHLA_C_01,0.03\n', som_type='snp')
+        TemporaryCSVData.objects.filter(id__in=[old.id, legacy.id]).update(
+            last_used_at=timezone.now() - timedelta(hours=25))
+
+        call_command('sweep_temporary_data', stdout=StringIO())
+
+        self.assertEqual(list(TemporaryCSVData.objects.values_list('id', flat=True)), [recent.id])
+
+    def test_graph_data_view_layout(self):
+        # The layouts are cached per dataset version, which the test databases can share
+        hierarchy_layout.cache_clear()
+        layout_cache.clear()
+        self.addCleanup(hierarchy_layout.cache_clear)
+        self.addCleanup(layout_cache.clear)
+        for category, disease, snp, p in [('neurological', 'migraine', 'HLA_A_0101', 0.02),
+                                          ('neurological', 'migraine', 'HLA_B_0201', 0.03),
+                                          ('circulatory', 'hypertension', 'HLA_C_0301', 0.04)]:
+            HlaPheWasCatalog.objects.create(
+                category_string=category, phewas_string=disease, phewas_code=2.0, snp=snp, gene_class=1,
+                gene_name=snp.split('_')[1], a1='A', a2='P', cases=100, controls=200, p=p, odds_ratio=1.5, l95=1.1,
+                u95=2.0, maf=0.1, serotype='01', subtype='01', chromosome=6, nchrobs=300)
+        url = reverse('graph_data')
+
+        # Without the layout flag, no positions are returned
+        response = self.client.get(url, {'type': 'initial'})
+        self.assertNotIn('positions', response.data)
+
+        # The categories are placed on a circle
+        response = self.client.get(url, {'type': 'initial', 'layout': 'true'})
+        positions = response.data['positions']
+        self.assertEqual(set(positions), {'category-circulatory', 'category-neurological'})
+        for x, y in positions.values():
+            self.assertAlmostEqual(np.hypot(x - LAYOUT_CENTER[0], y - LAYOUT_CENTER[1]), CATEGORY_RADIUS, places=1)
+
+        # The diseases are placed around their category, whatever the filters
+        response = self.client.get(url, {'type': 'diseases', 'category_id': 'category-neurological', 'layout': 'true',
+                                         'showSubtypes': 'true'})
+        disease_positions = response.data['positions']
+        self.assertEqual(set(disease_positions), {'disease-brain_cancer', 'disease-migraine'})
+        category_xy = np.array(positions['category-neurological'])
+        for xy in disease_positions.values():
+            self.assertAlmostEqual(np.linalg.norm(np.array(xy) - category_xy), DISEASE_RADIUS, places=1)
+        response = self.client.get(url, {'type': 'diseases', 'category_id': 'category-neurological', 'layout': 'true',
+                                         'showSubtypes': 'true', 'filters': 'phewas_string:==:migraine'})
+        self.assertEqual(response.data['positions'], {'disease-migraine': disease_positions['disease-migraine']})
+
+        # The alleles are placed on an arc around their disease, and the layout is cached for equivalent filters
+        params = {'type': 'alleles', 'disease_id': 'disease-migraine', 'layout': 'true', 'showSubtypes': 'true',
+                  'filters': 'p:<:0.05'}
+        response = self.client.get(url, params)
+        allele_positions = response.data['positions']
+        self.assertEqual(set(allele_positions), {'allele-HLA_A_0101', 'allele-HLA_B_0201'})
+        disease_xy = np.array(disease_positions['disease-migraine'])
+        for xy in allele_positions.values():
+            distance = np.linalg.norm(np.array(xy) - disease_xy)
+            self.assertTrue(ALLELE_BASE_RADIUS - 0.01 <= distance <= ALLELE_BASE_RADIUS + ALLELE_RADIUS_STEP)
+        with patch('api.layout.compute_graph_layout') as mock_compute_graph_layout:
+            response = self.client.get(url, {**params, 'filters': ' p:<:0.05 '})
+        mock_compute_graph_layout.assert_not_called()
+        self.assertEqual(response.data['positions'], allele_positions)
+
+    def test_graph_data_view_compact(self):
+        for i in range(50):
+            HlaPheWasCatalog.objects.create(
+                category_string='neurological', phewas_string='brain cancer', phewas_code=1.0,
+                snp=f'HLA_A_{i:02d}{i:02d}', gene_class=1, gene_name='A', a1='A', a2='P', cases=100, controls=200,
+                p=0.001 * (i + 1) / 50, odds_ratio=1 + i / 10, l95=1.1, u95=2.0, maf=0.1, serotype=f'{i:02d}',
+                subtype=f'{i:02d}', chromosome=6, nchrobs=300)
+        url = reverse('graph_data')
+        params = {'type': 'alleles', 'disease_id': 'disease-brain_cancer', 'filters': '', 'showSubtypes': 'true',
+                  'layout': 'true'}
+        response = self.client.get(url, params)
+        compact_response = self.client.get(url, {**params, 'compact': 'true'})
+        self.assertEqual(compact_response.status_code, status.HTTP_200_OK)
+
+        # The compact response decodes to the same graph, and each string is only sent once
+        nodes, edges, visible, positions = decode_compact_graph(compact_response.json())
+        self.assertEqual(nodes, response.json()['nodes'])
+        self.assertEqual(edges, response.json()['edges'])
+        self.assertEqual(visible, response.json()['visible'])
+        self.assertEqual(positions, response.json()['positions'])
+        strings = compact_response.json()['strings']
+        self.assertEqual(len(strings), len(set(strings)))
+        self.assertLess(len(compact_response.content), len(response.content) / 2)
+
+        # The compact response can also be served as MessagePack
+        if msgpack is None:
+            self.skipTest('msgpack is not installed')
+        msgpack_response = self.client.get(url, {**params, 'compact': 'true'}, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(msgpack_response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(msgpack_response.content), compact_response.json())
+        self.assertLess(len(msgpack_response.content), len(compact_response.content))
+
+    def test_compact_graph_mixed_columns(self):
+        # Columns mixing strings with numbers are sent as they are, and decode to the same values
+        nodes = [{'id': 'allele-HLA_A_01', 'label': 'A_01', 'serotype': '01', 'p': 0.01},
+                 {'id': 'allele-HLA_A_02', 'label': 'A_02', 'serotype': 2, 'p': 'n/a'},
+                 {'id': 'disease-migraine', 'label': 'migraine'}]
+        edges = [{'source': 'disease-migraine', 'target': 'allele-HLA_A_01'}]
+        payload = encode_compact_graph(nodes, edges, ['allele-HLA_A_01'])
+        self.assertEqual(payload['nodes']['string_columns'], ['label'])
+        self.assertEqual(decode_compact_graph(payload), (nodes, edges, ['allele-HLA_A_01'], None))
+
+    def test_fast_json_renderer(self):
+        data = {'odds_ratio': float('inf'), 'p': float('nan'), 'values': [np.float32(1.5), np.float64('-inf'), 2],
+                'label': 'brain cancer'}
+        expected = {'odds_ratio': None, 'p': None, 'values': [1.5, None, 2], 'label': 'brain cancer'}
+        self.assertEqual(json.loads(FastJSONRenderer().render(data)), expected)
+        # Without orjson, the DRF encoder renders the same JSON
+        with patch('api.renderers.orjson', None):
+            self.assertEqual(json.loads(FastJSONRenderer().render(data)), expected)
+
+        # Streamed lists are the same JSON arrays, whatever the chunk size
+        items = [{'i': i, 'p': float('nan') if i % 3 else 0.01} for i in range(10)]
+        for chunk_size in [1, 3, 10, 20]:
+            self.assertEqual(json.loads(b''.join(stream_json_list(items, chunk_size))), finite_floats(items))
+        self.assertEqual(b''.join(stream_json_list([])), b'[]')
+
+    def test_combined_associations_view_streamed(self):
+        for snp, p in [('HLA_A_0101', 0.01), ('HLA_B_0101', 0.02), ('HLA_C_0101', 0.001)]:
+            HlaPheWasCatalog.objects.create(
+                category_string='neurological', phewas_string='brain cancer', phewas_code=1.0, snp=snp,
+                gene_class=1, gene_name=snp.split('_')[1], a1='A', a2='P', cases=100, controls=200, p=p,
+                odds_ratio=1.5, l95=1.1, u95=2.0, maf=0.1, serotype='01', subtype='01', chromosome=6, nchrobs=300)
+        url = reverse('combined_associations')
+        params = {'disease': 'brain cancer', 'show_subtypes': 'true'}
+        response = self.client.get(url, params)
+        self.assertFalse(response.streaming)
+        with self.settings(JSON_STREAMING_MIN_ITEMS=2):
+            streamed_response = self.client.get(url, params)
+        self.assertTrue(streamed_response.streaming)
+        self.assertEqual(streamed_response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(streamed_response.streaming_content)), response.json())
+        self.assertEqual(len(response.json()), 6)
+
+    def test_conditional_requests(self):
+        url = reverse('graph_data')
+        params = {'type': 'diseases', 'category_id': 'category-neurological', 'showSubtypes': 'true'}
+        with self.settings(DATASET_VERSION_TTL=60):
+            response = self.client.get(url, params)
+            etag = response['ETag']
+            self.assertTrue(etag.startswith('"') and not etag.startswith('W/'))
+            self.assertIn('public', response['Cache-Control'])
+            self.assertIn('must-revalidate', response['Cache-Control'])
+            self.assertIn('Accept', response['Vary'])
+
+            # A matching ETag is answered without a body and without querying the catalog
+            with self.assertNumQueries(0):
+                not_modified = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(not_modified.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(not_modified.content, b'')
+            self.assertEqual(not_modified['ETag'], etag)
+
+            # The ETag is the same for the same parameters in any order, and different for other parameters
+            reordered = self.client.get(f"{url}?showSubtypes=true&category_id=category-neurological&type=diseases")
+            self.assertEqual(reordered['ETag'], etag)
+            self.assertNotEqual(self.client.get(url, {**params, 'showSubtypes': 'false'})['ETag'], etag)
+
+            # Errors are not cached
+            error = self.client.get(url, {'type': 'unknown'})
+            self.assertEqual(error.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertFalse(error.has_header('ETag'))
+
+            # Reloading the catalog changes the ETag once the dataset version is read again
+            HlaPheWasCatalog.objects.create(
+                category_string='neurological', phewas_string='migraine', phewas_code=2.0, snp='HLA_A_0101',
+                gene_class=1, gene_name='A', a1='A', a2='P', cases=100, controls=200, p=0.01, odds_ratio=1.5,
+                l95=1.1, u95=2.0, maf=0.1, serotype='01', subtype='01', chromosome=6, nchrobs=300)
+        with self.settings(DATASET_VERSION_TTL=0):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['nodes']), 2)
+
+        # A new release changes the ETag of the same catalog
+        etag = response['ETag']
+        release_version.cache_clear()
+        self.addCleanup(release_version.cache_clear)
+        with self.settings(DATASET_VERSION_TTL=60, RELEASE_VERSION='next-release'):
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_benchmark_renderers(self):
+        out = StringIO()
+        call_command('benchmark_renderers', rows=100, repeat=1, stdout=out)
+        self.assertIn('FastJSONRenderer', out.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()
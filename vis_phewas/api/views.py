@@ -1,17 +1,20 @@
 import html
 import itertools
-import re
 import urllib.parse
-from datetime import timedelta
 from io import StringIO
 from typing import List
 
 import pandas as pd
+from api.caching import conditional_on_dataset
+from api.filters import apply_filters, compile_filters
+from api.graph_format import encode_compact_graph
+from api.layout import graph_layout
 from api.models import TemporaryCSVData
-from django.db import transaction
-from django.db.models import Q, Count, QuerySet
+from api.renderers import graph_renderer_classes, list_response_is_streamed, StreamingJSONListResponse
+from django.db.models import Count, QuerySet
 from django.http import HttpResponse, JsonResponse
-from django.utils import timezone
+from mainapp.analytics import query_catalog_snapshot, snapshot_combined_associations
+from mainapp.dataset import catalog_dataframe, as_catalog_dtypes
 from mainapp.models import HlaPheWasCatalog
 from rest_framework import status
 from rest_framework.response import Response
@@ -38,7 +41,10 @@ class GraphDataView(APIView):
     API view to get the data for the graph.
     :return: Response object with the graph data for the specified type
     """
+    # The graph data can also be served as MessagePack
+    renderer_classes = graph_renderer_classes()
 
+    @conditional_on_dataset
     def get(self, request) -> Response:
         """
         Get the data for the graph.
@@ -48,6 +54,10 @@ class GraphDataView(APIView):
         """
         data_type: str = request.GET.get('type', 'initial')
         filters = request.GET.get('filters')
+        # Whether to return the positions of the nodes, so that the client does not have to lay them out
+        layout: bool = request.GET.get('layout', 'false').lower() == 'true'
+        # Whether to encode the response in the compact format, with a string table and columnar node attributes
+        compact: bool = request.GET.get('compact', 'false').lower() == 'true'
         show_subtypes = request.GET.get('showSubtypes')
         # If the show_subtypes is not set, set it to False
         if show_subtypes == 'undefined' or show_subtypes is None:
@@ -59,182 +69,35 @@ class GraphDataView(APIView):
             filters = []
 
         # Get the data based on the type
+        parent_id: str = ''
         if data_type == 'initial':
             nodes, edges, visible = get_category_data(filters, show_subtypes, initial=True)
         elif data_type == 'categories':
             nodes, edges, visible = get_category_data(filters, initial=False, show_subtypes=show_subtypes)
         elif data_type == 'diseases':
             category_id: str = request.GET.get('category_id')
+            parent_id = category_id
             nodes, edges, visible = get_disease_data(category_id, filters, show_subtypes)
         elif data_type == 'alleles':
             # Get the disease ID from the request escaped with urllib.parse.unquote
             disease_id: str = urllib.parse.unquote(request.GET.get('disease_id'))
+            parent_id = disease_id
             nodes, edges, visible = get_allele_data(disease_id, filters, show_subtypes)
         else:
             return Response({'error': 'Invalid request'}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response({'nodes': nodes, 'edges': edges, 'visible': visible})
+        positions = None
+        if layout:
+            # Key the layout by the request in its canonical form, so that equivalent filters share a layout
+            request_key: tuple = (data_type, parent_id, tuple(compile_filters(filters, show_subtypes)), show_subtypes)
+            positions = graph_layout(request_key, nodes, edges)
+        if compact:
+            return Response(encode_compact_graph(nodes, edges, visible, positions))
 
-
-def normalise_snp_filter(filter_str):
-    """
-    Normalise a single SNP filter to be case-insensitive, handle different delimiters,
-    and ensure HLA_[gene_name]_[first_two_numbers][optional_next_two_numbers] format is used only for :==: operator.
-    :param filter_str: The filter string containing SNP conditions.
-    :return: The normalised filter string.
-    """
-
-    def normalise_snp(snp_value, include_prefix):
-        # Remove any leading 'HLA' or unnecessary delimiters
-        snp_value = re.sub(r'^HLA[-_\s]?', '', snp_value, flags=re.IGNORECASE)
-
-        # normalise delimiters to underscores
-        snp_value = re.sub(r'[-\s/*]', '_', snp_value)
-
-        # Capture the gene name and the numbers separately
-        match = re.match(r'([A-Z]+\d?)[_\s-]?(\d{2})([:_\s-]?(\d{2}))?$', snp_value, flags=re.IGNORECASE)
-        if match:
-            gene_name = match.group(1).upper()  # Ensure gene name is uppercase
-            first_two_digits = match.group(2)  # Capture the first two digits
-            next_two_digits = match.group(4) if match.group(4) else ""  # Capture the next two digits if present
-            result = f'{gene_name}_{first_two_digits}{next_two_digits}'
-            return f'HLA_{result}' if include_prefix else result
-        else:
-            # If no match, return the original value (preserving the gene name normalization)
-            return f'HLA_{snp_value.upper()}' if include_prefix else snp_value.upper()
-
-    # Identify the operator and SNP part
-    match = re.match(r'(snp\s*[:_-]?)((==|:==:|contains):?\s*)((?:HLA[-_ ]?)?[A-Z0-9-_\s/*:]+)', filter_str,
-                     flags=re.IGNORECASE)
-    if match:
-        operator = match.group(3).strip().lower()
-        snp_value = match.group(4).strip()
-
-        # Determine if the HLA prefix should be included based on the operator
-        include_prefix = operator == "=="
-
-        # normalise the SNP value
-        normalised_snp = normalise_snp(snp_value, include_prefix)
-
-        # Return the normalised condition
-        return f"{match.group(1)}{operator}:{normalised_snp}"
-
-    return filter_str  # Return the filter as-is if no match
-
-
-def apply_filters(queryset: QuerySet, filters: str, category_id: str = None, show_subtypes: bool = False,
-                  export: bool = False, initial: bool = False) -> QuerySet:
-    """
-    Apply the filters to the queryset.
-    :param initial:
-    :param export:
-    :param queryset:
-    :param filters:
-    :param category_id:
-    :param show_subtypes: Whether to show the subtypes of the alleles or just the main groups
-    :return: Filtered queryset
-    """
-    # If the category_id is provided, filter the queryset by the category
-    if category_id:
-        category_string: str = category_id.replace('category-', '').replace('_', ' ')
-        queryset = queryset.filter(category_string=category_string)
-    # If the export flag is set, return the queryset without any filters
-    if not export and not initial:
-        # If show_subtypes is not set, filter the queryset to show only the subtypes# If the show_subtypes flag is set, filter the queryset to show only the main groups
-        if not show_subtypes:
-            queryset = queryset.filter(subtype='00')
-
-        # If the show_subtypes flag is set, filter the queryset to show only the main groups
-        else:
-            queryset = queryset.exclude(subtype='00')
-
-    # If no filters are provided, return the queryset filtered to show only the significant results
-    if not filters:
-        return queryset.filter(p__lte=0.05)
-
-    filters = html.unescape(filters)  # Unescape the HTML entities in the filters to handle escapes <, >, etc.
-
-    # If show_subtypes is false, remove the last two digits of the SNP filter
-    if not show_subtypes:
-        # Match HLA_[letter]_[four digits] and capture only the first two digits
-        filters = re.sub(r'(HLA_[A-Z]_\d{2})\d{2}', r'\1', filters)
-
-    # Parse the filters and apply them to the queryset
-    filter_list: list = parse_filters(filters)
-    combined_query: Q = Q()
-
-    # Loop through the filter list and apply the filters to the queryset
-    for logical_operator, filter_str in filter_list:
-        if filter_str.startswith('snp'):
-            filter_str = normalise_snp_filter(filter_str)
-        parts: list = filter_str.split(':', 2)
-        if len(parts) < 3:
-            continue
-        field, operator, value = parts
-        value = value.rstrip(',')
-
-        # Apply the filter based on the operator
-        if operator == '==':
-            q: Q = Q(**{f'{field}__iexact': value})
-        elif operator == 'contains':
-            q = Q(**{f'{field}__icontains': value})
-        elif operator == '>':
-            q = Q(**{f'{field}__gt': value})
-        elif operator == '<':
-            q = Q(**{f'{field}__lt': value})
-        elif operator == '>=':
-            q = Q(**{f'{field}__gte': value})
-        elif operator == '<=':
-            q = Q(**{f'{field}__lte': value})
-        else:
-            continue
-
-        # Combine the queries based on the logical operator
-        if logical_operator == 'AND':
-            combined_query &= q
-        elif logical_operator == 'OR':
-            combined_query |= q
-
-    # Filter the queryset based on the combined query
-    queryset = queryset.filter(combined_query)
-    # Filter the queryset to show only the significant results
-    filtered_queryset: QuerySet = queryset.filter(p__lte=0.05)
-    return filtered_queryset
-
-
-def parse_filters(filters: str) -> list:
-    """
-    Parse the filters string into a list of tuples.
-    :param filters:
-    :return:
-    """
-    # Initialise the filter list and the current operator
-    filter_list: list = []
-    # Initialise the pattern to match the logical operators
-    current_operator = None
-    # Initialise the pattern to match the logical operators
-    pattern = re.compile(r'\s*(AND|OR)\s*')
-    # Split the filters string into parts based on the logical operators
-    parts: list = pattern.split(filters)
-
-    # Loop through the parts and add them to the filter list
-    for part in parts:
-        part = part.strip()
-        # If the part is a logical operator, set the current operator
-        if part in ('AND', 'OR'):
-            current_operator = part
-        # If the part is not a logical operator, add it to the filter list
-        elif part:
-            sub_parts: list = re.findall(r'([^,]+|"[^"]*")+', part)
-            for sub_part in sub_parts:
-                sub_part = sub_part.strip().strip('"')
-                if current_operator:
-                    filter_list.append((current_operator, sub_part))
-                    current_operator = None
-                else:
-                    filter_list.append(('AND', sub_part))
-    # Return the filter list
-    return filter_list
+        data: dict = {'nodes': nodes, 'edges': edges, 'visible': visible}
+        if positions is not None:
+            data['positions'] = positions
+        return Response(data)
 
 
 def get_category_data(filters: str, show_subtypes: bool, initial: bool = True) -> tuple:
@@ -343,6 +206,7 @@ class InfoView(APIView):
     :return: Response object with the information for the allele
     """
 
+    @conditional_on_dataset
     def get(self, request) -> Response:
         """
         Get the information for a specific allele.
@@ -389,6 +253,7 @@ class ExportDataView(APIView):
     :return: HttpResponse object with the exported data as a CSV file
     """
 
+    @conditional_on_dataset
     def get(self, request) -> HttpResponse:
         """
         Export the data to a CSV file.
@@ -426,16 +291,16 @@ def get_filtered_df(filters: str) -> pd.DataFrame:
     :param filters: The filters to apply to the data
     :return: df: The filtered data as a DataFrame
     """
-    # Get the filtered data
-    queryset: QuerySet = HlaPheWasCatalog.objects.all()
+    # Scan the catalog snapshot if there is one, with the filters pushed into the scan
+    df = query_catalog_snapshot(compile_filters(filters, show_subtypes=True), required=[('p', '<=', 0.05)])
+    if df is not None:
+        return as_catalog_dtypes(df)
+
+    # Get the filtered data, in the order of the snapshot
+    queryset: QuerySet = HlaPheWasCatalog.objects.order_by('id')
     filtered_queryset: QuerySet = apply_filters(queryset, filters, show_subtypes=True, export=True)
-    # Get the data as a DataFrame
-    df: pd.DataFrame = pd.DataFrame(list(filtered_queryset.values()))
-    # Drop the ID column
-    if 'id' in df.columns:
-        df = df.drop(columns=['id'])
-        # Return the filtered DataFrame
-    return df
+    # Get the data as a typed DataFrame, without the ID column
+    return catalog_dataframe(filtered_queryset)
 
 
 class SendDataToSOMView(APIView):
@@ -462,42 +327,12 @@ class SendDataToSOMView(APIView):
         num_clusters = int(request.GET.get('num_clusters') or 4)
         # Get the filtered data as a DataFrame
         df: pd.DataFrame = get_filtered_df(filters)
-        # Write the data to a buffer
-        buffer: StringIO = StringIO()
-        df.to_csv(buffer, index=False)
-        csv_content: str = buffer.getvalue()
-        # Cleanup the old data if necessary
-        last_cleanup_time: TemporaryCSVData = TemporaryCSVData.objects.order_by('-created_at').first()
-        # If the last cleanup time is not set or more than a day has passed since the last cleanup, cleanup the old data
-        if not last_cleanup_time or (timezone.now() - last_cleanup_time.created_at) > timedelta(days=1):
-            self.cleanup_old_data()
-        # Store the data in the database
-        temp_data: TemporaryCSVData = TemporaryCSVData.objects.create(csv_content=csv_content, som_type=som_type)
+        # Store the data in the database, or reuse the copy stored for the same data
+        temp_data: TemporaryCSVData = TemporaryCSVData.stage(df, som_type)
         # Return the response with the status of the request, data ID, number of clusters, and filters
         return JsonResponse({'status': 'CSV data stored', 'data_id': temp_data.id, 'num_clusters': num_clusters,
                              'filters': filters})
 
-    def cleanup_old_data(self) -> None:
-        """
-        Cleanup old data from both the database.
-        Removes old database records older than 1 day.
-        """
-        # Set the threshold time to 1 day ago
-        threshold_time = timezone.now() - timedelta(days=1)
-
-        # Use a transaction to ensure atomicity
-        with transaction.atomic():
-            # Filter the old records from the database
-            old_records = TemporaryCSVData.objects.filter(created_at__lt=threshold_time)
-
-            # Record the count before deletion for logging
-            old_records_count = old_records.count()
-
-            # Delete the old records from the database
-            old_records.delete()
-
-        print(f"Deleted {old_records_count} old records from the database.")
-
 
 class CombinedAssociationsView(APIView):
     """
@@ -507,14 +342,19 @@ class CombinedAssociationsView(APIView):
     :return: Response object with the combined associations for the disease
     """
 
+    @conditional_on_dataset
     def get(self, request) -> Response:
         # Get the disease and show_subtypes parameters from the request
         disease: str = request.GET.get('disease')
         show_subtypes: str = request.GET.get('show_subtypes')
+        # Combine the alleles in the engine if there is a catalog snapshot
+        result = snapshot_combined_associations(disease, show_subtypes == 'true')
+        if result is not None:
+            return self.list_response(request, result)
         # Get the allele data for the disease
         allele_data: QuerySet = HlaPheWasCatalog.objects.filter(phewas_string=disease).values(
             'snp', 'gene_name', 'serotype', 'subtype', 'odds_ratio', 'p'
-        )
+        ).order_by('id')
         # Filter the allele data based on the show_subtypes parameter
         if show_subtypes == 'true':
             allele_data = allele_data.exclude(subtype='00')
@@ -546,6 +386,18 @@ class CombinedAssociationsView(APIView):
                 'combined_p_value': combined_p_value
             })
         # Return the response with the combined associations for the disease
+        return self.list_response(request, result)
+
+    @staticmethod
+    def list_response(request, result: list):
+        """
+        Get the response for a list of combined associations, streamed as JSON if the list is long.
+        :param request: Request object from the client
+        :param result: The combined associations
+        :return: Response object with the combined associations
+        """
+        if list_response_is_streamed(result) and request.accepted_renderer.format == 'json':
+            return StreamingJSONListResponse(result)
         return Response(result)
 
 
@@ -557,6 +409,7 @@ class GetNodePathView(APIView):
     :return: Response object with the path from the outer level to the inner level
     """
 
+    @conditional_on_dataset
     def get(self, request) -> Response:
         """
         Get the node path from the outer level to the inner level.
@@ -596,6 +449,7 @@ class GetDiseasesForCategoryView(APIView):
     :return: Response object with the diseases for the category
     """
 
+    @conditional_on_dataset
     def get(self, request) -> Response:
 
         """
@@ -0,0 +1,239 @@
+"""
+Analytical reads of the catalog from a columnar snapshot.
+
+The database remains the source of truth, but scans of the whole catalog (exports, SOM inputs and combined
+associations) are run by DuckDB, an in-process engine, over a Parquet snapshot of the catalog written when it is
+loaded. Snapshots are named after the dataset version, so a snapshot is only read while it matches the rows in the
+database. The filters of the graph are compiled into SQL predicates and pushed into the scan, which reads only the
+columns it needs and runs on the thread budget of the worker.
+
+DuckDB is optional: without it, or without a snapshot of the current catalog, the callers query the database.
+"""
+import glob
+import logging
+import os
+import tempfile
+import threading
+
+import pandas as pd
+from django.conf import settings
+from django.core.exceptions import FieldError, FieldDoesNotExist
+from django.db import models
+from mainapp.compute import thread_budget
+from mainapp.dataset import get_dataset_version, catalog_fields
+from mainapp.models import HlaPheWasCatalog
+
+try:
+    import duckdb
+except ImportError:  # The database is queried instead
+    duckdb = None
+
+logger = logging.getLogger('mainapp.analytics')
+
+# Number of rows read from the database at a time when writing a snapshot
+SNAPSHOT_CHUNK_SIZE = 50000
+
+_local = threading.local()
+
+
+def snapshot_root() -> str:
+    """
+    This function gets the directory catalog snapshots are written to
+    :return: CATALOG_SNAPSHOT_ROOT
+    """
+    return str(getattr(settings, 'CATALOG_SNAPSHOT_ROOT', settings.BASE_DIR / 'catalog_snapshots'))
+
+
+def snapshot_path(version: str) -> str:
+    """
+    This function gets the path of the snapshot of a version of the catalog
+    :param version: The dataset version
+    :return: The path of the Parquet file
+    """
+    return os.path.join(snapshot_root(), f"catalog-{version}.parquet")
+
+
+def _connection():
+    # DuckDB connections are not thread-safe, so each thread has its own in-memory database
+    if not hasattr(_local, 'connection'):
+        _local.connection = duckdb.connect()
+    return _local.connection
+
+
+def write_catalog_snapshot() -> str:
+    """
+    This function writes a Parquet snapshot of the catalog, named after its dataset version, and deletes the snapshots
+    of previous versions
+    :return: The path of the snapshot
+    """
+    if duckdb is None:
+        raise RuntimeError('Writing catalog snapshots requires duckdb to be installed.')
+    version = get_dataset_version()
+    path = snapshot_path(version)
+    os.makedirs(snapshot_root(), exist_ok=True)
+
+    names = ['id'] + [field.name for field in catalog_fields()]
+    connection = duckdb.connect()
+    rows = HlaPheWasCatalog.objects.order_by('id').values_list(*names).iterator(chunk_size=SNAPSHOT_CHUNK_SIZE)
+    created = False
+    while True:
+        chunk = pd.DataFrame.from_records([row for _, row in zip(range(SNAPSHOT_CHUNK_SIZE), rows)], columns=names)
+        if chunk.empty and created:
+            break
+        connection.register('chunk', chunk)
+        if created:
+            connection.execute('INSERT INTO catalog SELECT * FROM chunk')
+        else:
+            # The first chunk fixes the column types, even if the catalog is empty
+            connection.execute('CREATE TABLE catalog AS SELECT * FROM chunk')
+            created = True
+        connection.unregister('chunk')
+        if len(chunk) < SNAPSHOT_CHUNK_SIZE:
+            break
+
+    # Write to a temporary file first so that a snapshot is never read half written
+    fd, temp_path = tempfile.mkstemp(dir=snapshot_root(), prefix='.tmp-', suffix='.parquet')
+    os.close(fd)
+    try:
+        connection.execute(f"COPY (SELECT * FROM catalog ORDER BY id) TO '{temp_path}' (FORMAT PARQUET)")
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        connection.close()
+
+    for old_path in glob.glob(snapshot_path('*')):
+        if old_path != path:
+            os.remove(old_path)
+    logger.info('Wrote catalog snapshot %s', path)
+    return path
+
+
+def current_snapshot():
+    """
+    This function gets the snapshot of the catalog currently in the database
+    :return: The path of the snapshot, or None if DuckDB is not installed or the catalog has no snapshot
+    """
+    if duckdb is None:
+        return None
+    path = snapshot_path(get_dataset_version())
+    return path if os.path.exists(path) else None
+
+
+def predicate_sql(field_name: str, operator: str, value) -> tuple:
+    """
+    This function compiles a filter predicate into SQL, with the same meaning as the lookup apply_filters uses
+    :param field_name: The catalog field
+    :param operator: '==' (case-insensitive equality), 'contains' (case-insensitive), '>', '<', '>=', '<=', 'exact',
+    'in' or 'not in'
+    :param value: The value of the predicate, or a list of values for 'in' and 'not in'
+    :return: The SQL condition and its parameters
+    """
+    try:
+        field = HlaPheWasCatalog._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        raise FieldError(f"Cannot resolve keyword '{field_name}' into field.")
+    column = f'"{field.name}"'
+    numeric = isinstance(field, (models.IntegerField, models.FloatField))
+
+    if operator == 'contains':
+        # Escape the LIKE wildcards so that the value is matched literally, as icontains does
+        pattern = '%' + str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return f"CAST({column} AS VARCHAR) ILIKE ? ESCAPE '\\'", [pattern]
+    if operator in ('in', 'not in'):
+        values = [field.get_prep_value(v) for v in value]
+        placeholders = ', '.join('?' * len(values))
+        return f"{column} {operator.upper()} ({placeholders})", values
+    if operator == '==' and not numeric:
+        return f"lower({column}) = lower(?)", [str(value)]
+    comparisons = {'==': '=', 'exact': '=', '>': '>', '<': '<', '>=': '>=', '<=': '<='}
+    if operator not in comparisons:
+        raise ValueError(f"Invalid filter operator: {operator}")
+    return f"{column} {comparisons[operator]} ?", [field.get_prep_value(value)]
+
+
+def where_sql(predicates=(), required=()) -> tuple:
+    """
+    This function compiles filters into an SQL WHERE clause
+    :param predicates: List of (logical operator, field, operator, value) combined from left to right, as
+    apply_filters combines its Q objects
+    :param required: List of (field, operator, value) that must all hold
+    :return: The WHERE clause (empty if there are no predicates) and its parameters
+    """
+    conditions, params = [], []
+    combined = None
+    for logical_operator, field_name, operator, value in predicates:
+        if logical_operator not in ('AND', 'OR'):
+            raise ValueError(f"Invalid logical operator: {logical_operator}")
+        condition, condition_params = predicate_sql(field_name, operator, value)
+        params.extend(condition_params)
+        combined = condition if combined is None else f"({combined}) {logical_operator} ({condition})"
+    if combined is not None:
+        conditions.append(f"({combined})")
+    for field_name, operator, value in required:
+        condition, condition_params = predicate_sql(field_name, operator, value)
+        conditions.append(condition)
+        params.extend(condition_params)
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ''), params
+
+
+def query_catalog_snapshot(predicates=(), required=(), columns=None, order_by=('id',)):
+    """
+    This function reads filtered catalog rows from the current snapshot
+    :param predicates: Filter predicates combined from left to right, as returned by compile_filters
+    :param required: Predicates that must all hold
+    :param columns: Columns to read, defaulting to every column but id
+    :param order_by: Columns to order the rows by
+    :return: The rows as a DataFrame, or None if there is no snapshot to read them from
+    """
+    path = current_snapshot()
+    if path is None:
+        return None
+    columns = list(columns or [field.name for field in catalog_fields()])
+    for name in list(columns) + list(order_by):
+        HlaPheWasCatalog._meta.get_field(name)  # Only catalog columns are interpolated into the query
+
+    where, params = where_sql(predicates, required)
+    connection = _connection()
+    connection.execute(f"SET threads TO {thread_budget()}")
+    select = ', '.join(f'"{name}"' for name in columns)
+    order = ', '.join(f'"{name}"' for name in order_by)
+    return connection.execute(f"SELECT {select} FROM read_parquet(?) {where} ORDER BY {order}",
+                              [path] + params).df()
+
+
+def snapshot_combined_associations(disease: str, show_subtypes: bool):
+    """
+    This function computes the combined associations of each pair of alleles associated with a disease from the
+    current snapshot, as CombinedAssociationsView does. The pairs are joined in the engine, and their p-values are
+    combined with Fisher's method, which for two p-values has the closed form p1 * p2 * (1 - ln(p1 * p2))
+    :param disease: The disease
+    :param show_subtypes: Whether to combine the subtypes of the alleles rather than the main groups
+    :return: List of combined associations with a p-value below 0.05, or None if there is no snapshot
+    """
+    path = current_snapshot()
+    if path is None:
+        return None
+    connection = _connection()
+    connection.execute(f"SET threads TO {thread_budget()}")
+    subtype_condition = "subtype <> '00'" if show_subtypes else "subtype = '00'"
+    rows = connection.execute(f"""
+        WITH alleles AS (
+            SELECT row_number() OVER (ORDER BY id) AS position, snp, gene_name, serotype, subtype, odds_ratio, p
+            FROM read_parquet(?) WHERE phewas_string = ? AND {subtype_condition}
+        ), pairs AS (
+            SELECT a.*, b.snp AS snp2, b.gene_name AS gene_name2, b.serotype AS serotype2, b.subtype AS subtype2,
+                   a.odds_ratio * b.odds_ratio AS combined_odds_ratio, a.p * b.p AS p_product,
+                   a.position AS position1, b.position AS position2
+            FROM alleles a JOIN alleles b ON a.position < b.position
+        )
+        SELECT replace(snp, 'HLA_', ''), gene_name, serotype, subtype, replace(snp2, 'HLA_', ''), gene_name2,
+               serotype2, subtype2, combined_odds_ratio,
+               CASE WHEN p_product = 0 THEN 0 ELSE p_product * (1 - ln(p_product)) END AS combined_p_value
+        FROM pairs
+        WHERE combined_odds_ratio <> 0 AND combined_p_value < 0.05
+        ORDER BY position1, position2
+    """, [path, disease]).fetchall()
+    keys = ['gene1', 'gene1_name', 'gene1_serotype', 'gene1_subtype', 'gene2', 'gene2_name', 'gene2_serotype',
+            'gene2_subtype', 'combined_odds_ratio', 'combined_p_value']
+    return [dict(zip(keys, row)) for row in rows]
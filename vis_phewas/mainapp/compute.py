@@ -0,0 +1,58 @@
+"""
+Thread budgets for the numeric code run by the web workers.
+
+BLAS and OpenMP libraries start one thread per core by default, so every gunicorn worker running an SVD, a scaler,
+a SOM or K-Means at the same time would try to use every core of the host. Each worker process is instead given an
+equal share of the cores, applied with threadpoolctl around the numeric stages of a request or job.
+"""
+import logging
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+from threadpoolctl import threadpool_limits, threadpool_info
+
+logger = logging.getLogger('mainapp.compute')
+
+
+def available_cores() -> int:
+    """
+    This function gets the number of cores the process may run on
+    :return: The number of cores in the CPU affinity of the process, or of the host if it cannot be read
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def thread_budget() -> int:
+    """
+    This function gets the number of BLAS/OpenMP threads each worker process may use
+    :return: COMPUTE_THREADS if set, otherwise the available cores shared equally between the WEB_WORKERS processes
+    """
+    configured = getattr(settings, 'COMPUTE_THREADS', None)
+    if configured:
+        return configured
+    return max(available_cores() // max(getattr(settings, 'WEB_WORKERS', 1), 1), 1)
+
+
+@contextmanager
+def compute_context(name: str, threads: int = None):
+    """
+    This function limits the BLAS/OpenMP threads of the numeric code run inside it to the thread budget of the
+    worker. It can also decorate a function.
+
+    The limits apply to the whole process, so the requests and background jobs of a worker that overlap all run with
+    the same budget.
+    :param name: Name of the stage, which is logged with the effective limits at debug level
+    :param threads: Number of threads to allow, defaulting to the thread budget of the worker
+    :return: The number of threads allowed
+    """
+    threads = thread_budget() if threads is None else threads
+    with threadpool_limits(limits=threads):
+        # Listing the thread pools inspects every loaded library, so it is only done when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            limits = ', '.join(f"{info['internal_api']}={info['num_threads']}" for info in threadpool_info())
+            logger.debug('%s running with a budget of %d threads (%s)', name, threads, limits or 'no thread pools')
+        yield threads
@@ -0,0 +1,114 @@
+import hashlib
+import time
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import models
+from django.db.models import Count, Max, Min, QuerySet
+from mainapp.models import HlaPheWasCatalog
+from pandas.api.types import union_categoricals
+
+# Number of rows read from the database cursor at a time when materialising the catalog
+CATALOG_CHUNK_SIZE = 20000
+
+# Columns kept in double precision, as p-values can be too small for single precision
+FLOAT64_COLUMNS = {'p'}
+
+# Dataset version last read by current_dataset_version, and the monotonic time it was read at
+_dataset_version = [None, 0.0]
+
+
+def get_dataset_version() -> str:
+    """
+    This function gets a version of the loaded catalog, used to key anything derived from the whole catalog
+    :return: The first 16 characters of the SHA-256 digest of the number of rows and their id range, which changes
+    whenever rows are loaded or deleted
+    """
+    stats = HlaPheWasCatalog.objects.aggregate(count=Count('id'), first=Min('id'), last=Max('id'))
+    return hashlib.sha256(f"{stats['count']}:{stats['first']}:{stats['last']}".encode()).hexdigest()[:16]
+
+
+def current_dataset_version() -> str:
+    """
+    This function gets the dataset version without querying the database on every call, for checks that must be
+    cheap such as the conditional requests of the API. The version is read again once it is older than
+    DATASET_VERSION_TTL seconds, so a reloaded catalog is picked up after at most that long
+    :return: The dataset version, as returned by get_dataset_version
+    """
+    ttl = getattr(settings, 'DATASET_VERSION_TTL', 30)
+    version, checked_at = _dataset_version
+    now = time.monotonic()
+    if version is None or now - checked_at >= ttl:
+        version = get_dataset_version()
+        _dataset_version[:] = [version, now]
+    return version
+
+
+def catalog_fields() -> list:
+    """
+    This function gets the fields of the catalog rows, without the id
+    :return: The model fields in their declaration order
+    """
+    return [field for field in HlaPheWasCatalog._meta.concrete_fields if not field.primary_key]
+
+
+def catalog_dtype(field: models.Field):
+    """
+    This function gets the dtype a catalog field is materialised with
+    :param field: The model field
+    :return: 'category' for text, int32 for integers, and float32 for floats except the FLOAT64_COLUMNS
+    """
+    if isinstance(field, models.IntegerField):
+        return np.int32
+    if isinstance(field, models.FloatField):
+        return np.float64 if field.name in FLOAT64_COLUMNS else np.float32
+    return 'category'
+
+
+def catalog_dataframe(queryset: QuerySet, chunk_size: int = CATALOG_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    This function materialises catalog rows as a typed DataFrame, without the id column. The rows are read from the
+    cursor in chunks that are converted column by column, so no dictionary or object is created per row
+    :param queryset: The catalog rows
+    :param chunk_size: The number of rows read from the cursor at a time
+    :return: The rows with categorical text columns, int32 integers and float32 floats (float64 for p-values), or an
+    empty DataFrame without columns if there are no rows
+    """
+    fields = catalog_fields()
+    dtypes = [catalog_dtype(field) for field in fields]
+    chunks = [[] for _ in fields]
+
+    rows = queryset.values_list(*(field.name for field in fields)).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = [row for _, row in zip(range(chunk_size), rows)]
+        if not chunk:
+            break
+        # Transpose the chunk so that each column is converted to its dtype at once
+        for column_chunks, dtype, values in zip(chunks, dtypes, zip(*chunk)):
+            if dtype == 'category':
+                column_chunks.append(pd.Categorical(values))
+            else:
+                column_chunks.append(np.fromiter(values, dtype=dtype, count=len(values)))
+
+    if not chunks[0]:
+        return pd.DataFrame()
+    columns = {}
+    for field, dtype, column_chunks in zip(fields, dtypes, chunks):
+        if dtype == 'category':
+            # Merge the categories of the chunks, sorted as they would be if the column was converted at once
+            columns[field.name] = union_categoricals(column_chunks, sort_categories=True)
+        else:
+            columns[field.name] = np.concatenate(column_chunks)
+    return pd.DataFrame(columns)
+
+
+def as_catalog_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function converts catalog rows read by other means to the dtypes catalog_dataframe materialises them with
+    :param df: The catalog rows
+    :return: The rows with the catalog dtypes, or an empty DataFrame without columns if there are no rows
+    """
+    if df.empty:
+        return pd.DataFrame()
+    return df.astype({field.name: catalog_dtype(field) for field in catalog_fields() if field.name in df.columns})
@@ -1,6 +1,8 @@
 import csv
 
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
+from mainapp.analytics import write_catalog_snapshot, duckdb
 from mainapp.models import HlaPheWasCatalog
 
 
@@ -35,3 +37,10 @@ class Command(BaseCommand):
                 )
 
         self.stdout.write(self.style.SUCCESS('Data loaded successfully'))
+
+        # Write the snapshot the analytical reads scan, which the database is queried without
+        if duckdb is not None:
+            self.stdout.write(f"Wrote catalog snapshot {write_catalog_snapshot()}")
+
+        # Fit the SVD bases of the SOM inputs, which SOM requests only load
+        call_command('fit_feature_basis', stdout=self.stdout)
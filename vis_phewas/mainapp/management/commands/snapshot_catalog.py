@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand, CommandError
+from mainapp.analytics import write_catalog_snapshot, duckdb
+
+
+class Command(BaseCommand):
+    help = 'Writes the Parquet snapshot of the catalog that exports, SOM inputs and combined associations are read from'
+
+    def handle(self, *args, **kwargs):
+        if duckdb is None:
+            raise CommandError('Writing catalog snapshots requires duckdb to be installed')
+        self.stdout.write(self.style.SUCCESS(f"Wrote catalog snapshot {write_catalog_snapshot()}"))
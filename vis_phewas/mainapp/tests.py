@@ -1 +1,185 @@
-# Create your tests here.
+import tempfile
+from unittest import skipIf
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from django.urls import reverse
+from threadpoolctl import threadpool_info
+
+from api.filters import apply_filters, compile_filters
+from api.views import get_filtered_df
+from mainapp.analytics import duckdb, write_catalog_snapshot, current_snapshot, query_catalog_snapshot, \
+    snapshot_combined_associations, where_sql
+from mainapp.compute import compute_context, thread_budget
+from mainapp.dataset import get_dataset_version, catalog_dataframe
+from mainapp.models import HlaPheWasCatalog
+
+
+class ComputeContextTestCase(TestCase):
+    """
+    Test cases for the thread budgets of the numeric code.
+    """
+
+    @override_settings(WEB_WORKERS=3, COMPUTE_THREADS=None)
+    @patch('mainapp.compute.available_cores', return_value=8)
+    def test_thread_budget_shares_cores(self, mock_available_cores):
+        """
+        Test that the cores are shared equally between the worker processes, with at least one thread each.
+        """
+        self.assertEqual(thread_budget(), 2)
+        with override_settings(WEB_WORKERS=16):
+            self.assertEqual(thread_budget(), 1)
+        with override_settings(COMPUTE_THREADS=5):
+            self.assertEqual(thread_budget(), 5)
+
+    def test_compute_context_limits_threads(self):
+        """
+        Test that the thread pools are limited inside the compute context, also used as a decorator, and restored
+        after it.
+        """
+        original = [info['num_threads'] for info in threadpool_info()]
+
+        with self.assertLogs('mainapp.compute', level='DEBUG') as logs:
+            with compute_context('Test', threads=1) as threads:
+                self.assertEqual(threads, 1)
+                self.assertTrue(all(info['num_threads'] == 1 for info in threadpool_info()))
+        self.assertIn('Test running with a budget of 1 threads', logs.output[0])
+        self.assertEqual([info['num_threads'] for info in threadpool_info()], original)
+
+        @compute_context('Decorated', threads=1)
+        def limits():
+            return [info['num_threads'] for info in threadpool_info()]
+
+        # The decorator applies the limits on every call
+        for _ in range(2):
+            self.assertTrue(all(n == 1 for n in limits()))
+
+
+class DatasetVersionTestCase(TestCase):
+    """
+    Test cases for the version of the loaded catalog.
+    """
+
+    def test_dataset_version_changes_with_catalog(self):
+        """
+        Test that the dataset version changes when rows are loaded or deleted, and only then.
+        """
+        empty_version = get_dataset_version()
+        self.assertEqual(get_dataset_version(), empty_version)
+
+        row = HlaPheWasCatalog.objects.create(
+            snp='HLA_A_01', phewas_code=1, phewas_string='Phenotype_A', cases=100, controls=1000,
+            category_string='Category_A', odds_ratio=1.5, p=0.01, l95=0.5, u95=3.0, gene_name='A', maf=0.1,
+            a1='A', a2='G', chromosome=6, nchrobs=1000, gene_class=1, serotype='0', subtype='01')
+        loaded_version = get_dataset_version()
+        self.assertNotEqual(loaded_version, empty_version)
+        self.assertRegex(loaded_version, r'^[0-9a-f]{16}$')
+
+        row.delete()
+        self.assertEqual(get_dataset_version(), empty_version)
+
+    def test_catalog_dataframe(self):
+        """
+        Test that the catalog is materialised in chunks with typed columns and without the id column, with the same
+        values as the rows of the queryset.
+        """
+        self.assertTrue(catalog_dataframe(HlaPheWasCatalog.objects.all()).empty)
+        for i, snp in enumerate(['HLA_A_01', 'HLA_B_02', 'HLA_A_01', 'HLA_C_03', 'HLA_B_02']):
+            HlaPheWasCatalog.objects.create(
+                snp=snp, phewas_code=i, phewas_string=f'Phenotype_{i % 2}', cases=100 + i, controls=1000,
+                category_string='Category_A', odds_ratio=1.5 + i, p=1e-60 * (i + 1), l95=0.5, u95=3.0,
+                gene_name=snp.split('_')[1], maf=0.1, a1='A', a2='G', chromosome=6, nchrobs=1000, gene_class=1,
+                serotype='0', subtype='01')
+        queryset = HlaPheWasCatalog.objects.order_by('id')
+
+        df = catalog_dataframe(queryset, chunk_size=2)
+
+        expected = pd.DataFrame(list(queryset.values())).drop(columns=['id'])
+        self.assertEqual(list(df.columns), list(expected.columns))
+        self.assertEqual(df['snp'].dtype, 'category')
+        self.assertEqual(list(df['snp'].cat.categories), ['HLA_A_01', 'HLA_B_02', 'HLA_C_03'])
+        self.assertEqual(df['cases'].dtype, np.int32)
+        self.assertEqual(df['odds_ratio'].dtype, np.float32)
+        # p-values are kept in double precision, as they can be smaller than single precision allows
+        self.assertEqual(df['p'].dtype, np.float64)
+        pd.testing.assert_frame_equal(df.astype(expected.dtypes.to_dict()), expected)
+
+
+@skipIf(duckdb is None, 'duckdb is not installed')
+class AnalyticsTestCase(TestCase):
+    """
+    Test cases for the analytical reads of the catalog snapshot.
+    """
+
+    def setUp(self):
+        # Write the snapshots to a temporary directory
+        snapshot_root = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_root.cleanup)
+        settings_override = override_settings(CATALOG_SNAPSHOT_ROOT=snapshot_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        for i, snp in enumerate(['HLA_A_01', 'HLA_A_0101', 'HLA_B_02', 'HLA_B_0201', 'HLA_C_03', 'HLA_C_0301']):
+            for j, phenotype in enumerate(['Phenotype_A', 'Phenotype_B']):
+                HlaPheWasCatalog.objects.create(
+                    snp=snp, phewas_code=j, phewas_string=phenotype, cases=100 + 10 * i, controls=1000,
+                    category_string=f'Category_{j}', odds_ratio=0.5 + i / 2 + j, p=0.001 * (1 + i) * (1 + 9 * j),
+                    l95=0.5, u95=3.0, gene_name=snp.split('_')[1], maf=0.1, a1='A', a2='G', chromosome=6,
+                    nchrobs=1000, gene_class=1, serotype=snp[-2:] if len(snp) == 8 else snp[-4:-2],
+                    subtype='00' if len(snp) == 8 else snp[-2:])
+
+    def test_where_sql_combines_from_left_to_right(self):
+        """
+        Test that the filter predicates are combined from left to right, as the Q objects of apply_filters are.
+        """
+        where, params = where_sql([('AND', 'gene_name', '==', 'A'), ('OR', 'gene_name', '==', 'B'),
+                                   ('AND', 'p', '<', '0.01')], required=[('subtype', 'not in', ['0', '00'])])
+        self.assertEqual(where, 'WHERE (((lower("gene_name") = lower(?)) OR (lower("gene_name") = lower(?))) AND '
+                                '("p" < ?)) AND "subtype" NOT IN (?, ?)')
+        self.assertEqual(params, ['A', 'B', 0.01, '0', '00'])
+
+    def test_snapshot_matches_database(self):
+        """
+        Test that the snapshot is only read while it matches the catalog, and that the rows, filters and combined
+        associations read from it are those of the database.
+        """
+        self.assertIsNone(current_snapshot())
+        self.assertIsNone(query_catalog_snapshot())
+        path = write_catalog_snapshot()
+        self.assertEqual(current_snapshot(), path)
+
+        for filters in ['', 'gene_name:==:a OR gene_name:==:C, p:<:0.005', 'category_string:contains:_1',
+                        'odds_ratio:>=:2 AND snp:==:HLA_B_02']:
+            df = query_catalog_snapshot(compile_filters(filters, show_subtypes=True), required=[('p', '<=', 0.05)],
+                                        columns=['snp', 'phewas_string', 'p'])
+            queryset = apply_filters(HlaPheWasCatalog.objects.order_by('id'), filters, show_subtypes=True,
+                                     export=True)
+            expected = pd.DataFrame.from_records(queryset.values_list('snp', 'phewas_string', 'p'),
+                                                 columns=['snp', 'phewas_string', 'p'])
+            pd.testing.assert_frame_equal(df, expected)
+        with patch('mainapp.analytics.current_snapshot', return_value=None):
+            expected_df = get_filtered_df('gene_name:==:B')
+        pd.testing.assert_frame_equal(get_filtered_df('gene_name:==:B'), expected_df)
+
+        client = APIClient()
+        for show_subtypes in ['true', 'false']:
+            params = {'disease': 'Phenotype_B', 'show_subtypes': show_subtypes}
+            combined = snapshot_combined_associations('Phenotype_B', show_subtypes == 'true')
+            with patch('mainapp.analytics.current_snapshot', return_value=None):
+                expected_combined = client.get(reverse('combined_associations'), params).data
+            self.assertTrue(combined)
+            self.assertEqual(len(combined), len(expected_combined))
+            for result, expected_result in zip(combined, expected_combined):
+                self.assertEqual(result.keys(), expected_result.keys())
+                for key, value in expected_result.items():
+                    if isinstance(value, float):
+                        self.assertAlmostEqual(result[key], value, delta=1e-12)
+                    else:
+                        self.assertEqual(result[key], value)
+
+        # The snapshot is no longer read once the catalog changes
+        HlaPheWasCatalog.objects.filter(snp='HLA_C_0301').delete()
+        self.assertIsNone(current_snapshot())
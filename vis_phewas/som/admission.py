@@ -0,0 +1,212 @@
+"""
+Admission control for SOM training.
+
+Every SOM trained by a web process is first estimated from the number of SNPs or diseases, associations, features and
+neurons, and only admitted while the process has a free training slot and enough of its memory budget left. The
+SOM_MAX_CONCURRENT_TRAININGS and SOM_MEMORY_BUDGET_MB settings are the budgets of the whole server, which the processes
+do not share state to enforce: each of the WEB_WORKERS processes is given an equal share of them instead, so a process
+cannot use the share of an idle one. Every process may train at least one SOM, so with more workers than trainings
+allowed the memory budget is what bounds them. Requests
+that cannot be admitted in time are rejected with a 429 (too many trainings) or 503 (not enough memory) and a
+Retry-After hint. The estimate of every admitted training is logged next to the peak memory it actually used so that
+the cost model can be calibrated.
+
+With SOM_PROFILE_MEMORY, allocations are traced with tracemalloc while at least one training is running, and tracing
+stops when the last one finishes. The peak traced memory is process-wide, so it is only recorded for the trainings that
+ran alone; trainings that overlapped another one log no traced peak.
+"""
+import logging
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger('som.admission')
+
+# Memory used by a training whatever its size, for the interpreter, the figure and the response
+BASE_MEMORY_BYTES = 64 * 1024 ** 2
+
+# Memory of each preprocessed association, with its strings, and its share of the engineered sparse features
+ASSOCIATION_BYTES = 600
+
+# Number of copies of the dense SOM input (reduced, scaled and passed to the SOM) and of the SOM weights (weights,
+# distances and neighbourhood updates) alive at the same time
+INPUT_COPIES = 3
+WEIGHT_COPIES = 4
+
+# Seconds per neuron and feature of a training iteration, and per iteration whatever the SOM size, measured with
+# MiniSom on 20x20 to 60x60 grids of 100 features
+SECONDS_PER_NEURON_FEATURE = 1.5e-8
+SECONDS_PER_ITERATION = 2e-5
+
+
+class SOMAdmissionError(APIException):
+    """
+    Exception raised when a SOM training cannot be admitted, with the number of seconds to wait before retrying
+    """
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The server does not have the capacity to train this SOM right now.'
+    default_code = 'som_capacity'
+
+    def __init__(self, detail=None, wait=None, status_code=None):
+        super().__init__(detail)
+        # The REST framework exception handler sends the wait as the Retry-After header
+        self.wait = None if wait is None else max(int(np.ceil(wait)), 1)
+        if status_code is not None:
+            self.status_code = status_code
+
+
+def estimate_som_cost(n_samples, n_associations, n_features, som_x, som_y, num_iterations):
+    """
+    Function to estimate the peak memory and CPU time of training a SOM.
+
+    :param n_samples: Number of SNPs or diseases the SOM is trained on
+    :param n_associations: Number of associations of the SNPs or diseases
+    :param n_features: Number of features of the SOM input
+    :param som_x: Width of the SOM grid
+    :param som_y: Height of the SOM grid
+    :param num_iterations: Number of training iterations
+    :return: Dictionary with the estimated memory in bytes and CPU time in seconds
+    """
+    neurons = som_x * som_y
+    memory = (BASE_MEMORY_BYTES + n_associations * ASSOCIATION_BYTES + INPUT_COPIES * n_samples * n_features * 8
+              + WEIGHT_COPIES * neurons * n_features * 8)
+    # Each training iteration updates every neuron and mapping the samples finds the winner of each sample
+    cpu_seconds = ((num_iterations + n_samples) * neurons * n_features * SECONDS_PER_NEURON_FEATURE
+                   + num_iterations * SECONDS_PER_ITERATION)
+    return {'memory_bytes': int(memory), 'cpu_seconds': float(cpu_seconds)}
+
+
+def peak_rss_bytes():
+    """
+    Function to get the peak resident memory of the process.
+
+    :return: Peak resident set size in bytes
+    """
+    # Linux reports the peak in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class AdmissionController:
+    """
+    Class to bound the number of SOMs a process trains at the same time and the memory they are estimated to use
+    """
+
+    def __init__(self, max_concurrent, memory_budget_bytes):
+        """
+        :param max_concurrent: Maximum number of SOMs trained at the same time
+        :param memory_budget_bytes: Maximum total estimated memory of the SOMs trained at the same time
+        """
+        self.max_concurrent = max_concurrent
+        self.memory_budget_bytes = memory_budget_bytes
+        self._condition = threading.Condition()
+        # Estimate and expected end time of each admitted training
+        self._running = {}
+        self._next_id = 0
+        # Whether each profiled training has run alone so far, and whether tracing was started for them
+        self._profiled = {}
+        self._started_tracing = False
+
+    def _retry_after(self):
+        # The first running training is expected to free its slot and memory at its estimated end
+        ends = [end for _, end in self._running.values()]
+        return max(min(ends) - time.monotonic(), 1) if ends else 1
+
+    def _has_capacity(self, estimate):
+        reserved = sum(running['memory_bytes'] for running, _ in self._running.values())
+        return (len(self._running) < self.max_concurrent
+                and reserved + estimate['memory_bytes'] <= self.memory_budget_bytes)
+
+    def _start_profiling(self, training_id):
+        # The peak is shared by the whole process, so it only measures a training while no other one is profiled
+        if self._profiled:
+            self._profiled = dict.fromkeys(self._profiled, False)
+        else:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+        self._profiled[training_id] = not self._profiled
+
+    def _stop_profiling(self, training_id):
+        ran_alone = self._profiled.pop(training_id)
+        peak = tracemalloc.get_traced_memory()[1] if ran_alone and tracemalloc.is_tracing() else None
+        # Tracing slows every allocation down, so it stops with the last profiled training
+        if not self._profiled and self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return peak
+
+    @contextmanager
+    def admit(self, estimate, wait=0, description=''):
+        """
+        Method to train a SOM once there is capacity for it, waiting for running trainings to finish if needed.
+
+        :param estimate: Estimated cost of the training, as returned by estimate_som_cost
+        :param wait: Maximum number of seconds to wait for capacity, or None to wait as long as needed
+        :param description: Description of the training logged with its usage
+        """
+        if estimate['memory_bytes'] > self.memory_budget_bytes:
+            raise SOMAdmissionError(
+                f"This selection is estimated to need {estimate['memory_bytes'] / 1024 ** 2:.0f} MB to train, more "
+                f"than the {self.memory_budget_bytes / 1024 ** 2:.0f} MB available. Please select fewer SNPs or "
+                f"diseases.")
+
+        with self._condition:
+            deadline = None if wait is None else time.monotonic() + wait
+            while not self._has_capacity(estimate):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    if len(self._running) >= self.max_concurrent:
+                        raise SOMAdmissionError('Too many SOMs are being trained. Please try again shortly.',
+                                                wait=self._retry_after(), status_code=status.HTTP_429_TOO_MANY_REQUESTS)
+                    raise SOMAdmissionError('Not enough memory is free to train this SOM. Please try again shortly.',
+                                            wait=self._retry_after())
+                self._condition.wait(remaining)
+            training_id = self._next_id
+            self._next_id += 1
+            self._running[training_id] = (estimate, time.monotonic() + estimate['cpu_seconds'])
+
+            # Measure the peak memory allocated while training if memory profiling is enabled
+            profile = getattr(settings, 'SOM_PROFILE_MEMORY', False)
+            if profile:
+                self._start_profiling(training_id)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._condition:
+                usage = {
+                    'seconds': time.monotonic() - start,
+                    'peak_traced_bytes': self._stop_profiling(training_id) if profile else None,
+                    'peak_rss_bytes': peak_rss_bytes(),
+                }
+                del self._running[training_id]
+                self._condition.notify_all()
+            logger.info('SOM training %s: estimated %d bytes and %.2f seconds, used %s traced bytes (peak RSS %d '
+                        'bytes) and %.2f seconds', description, estimate['memory_bytes'], estimate['cpu_seconds'],
+                        usage['peak_traced_bytes'], usage['peak_rss_bytes'], usage['seconds'],
+                        extra={'estimate': estimate, 'usage': usage})
+
+
+def process_budget():
+    """
+    Function to get the share of the server-wide SOM training budgets given to each web worker process.
+
+    :return: Maximum number of SOMs the process trains at the same time, at least one, and the maximum total estimated
+    memory of those SOMs in bytes
+    """
+    workers = max(getattr(settings, 'WEB_WORKERS', 1), 1)
+    max_concurrent = max(getattr(settings, 'SOM_MAX_CONCURRENT_TRAININGS', 2) // workers, 1)
+    memory_budget_bytes = getattr(settings, 'SOM_MEMORY_BUDGET_MB', 2048) * 1024 ** 2 // workers
+    return max_concurrent, memory_budget_bytes
+
+
+# Admission controller shared by the SOM views of the process, with its share of the budgets of the server
+som_admission = AdmissionController(*process_budget())
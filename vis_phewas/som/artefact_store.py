@@ -0,0 +1,283 @@
+"""
+Content-addressed storage of the files generated for download, such as the cluster results of a SOM.
+
+Each file is saved under a key derived from the SHA-256 digest of its content, so saving the same results again
+reuses the saved file and files generated at the same time never collide. The files are saved by a backend, the
+local media directory or an S3-compatible bucket shared by several web nodes, and indexed by the Artefact model with
+their size and last access so that the sweep_artefacts command can evict them without listing the backend.
+"""
+import functools
+import gzip
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from som.models import Artefact
+
+try:
+    import boto3
+except ImportError:  # boto3 is only needed for the S3 backend, installed from requirements-s3.txt
+    boto3 = None
+
+# Permissions of the saved files, readable by the web server serving the media directory
+ARTEFACT_FILE_MODE = 0o644
+
+# Formats a DataFrame can be saved in, with their file extension and MIME type
+DATAFRAME_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'csv.gz': ('.csv.gz', 'application/gzip'),
+}
+
+
+class LocalArtefactBackend:
+    """
+    Backend saving the artefacts in a local directory served as media files
+    """
+
+    def __init__(self, root, base_url):
+        """
+        :param root: Directory the artefacts are saved in
+        :param base_url: URL the directory is served from
+        """
+        self.root = str(root)
+        self.base_url = base_url
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def save(self, key, data, content_type):
+        """
+        Method to save an artefact, replacing the file atomically so that it is never served half written.
+
+        :param key: Key of the artefact
+        :param data: Content of the artefact
+        :param content_type: MIME type of the artefact
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp creates the file readable by its owner only, but the web server serves it as another user
+            os.chmod(temp_path, ARTEFACT_FILE_MODE)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def read(self, key):
+        """
+        :param key: Key of the artefact
+        :return: Content of the artefact
+        """
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        """
+        :param key: Key of the artefact, which may already be deleted
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+        # Remove the directory of the artefact's digest if it is now empty, but never the directories above it
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def url(self, key):
+        """
+        :param key: Key of the artefact
+        :return: URL the artefact is downloaded from
+        """
+        return self.base_url + key
+
+
+class S3ArtefactBackend:
+    """
+    Backend saving the artefacts in a bucket of an S3-compatible object store
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, public_url=None, url_expiry=3600, client=None):
+        """
+        :param bucket: Name of the bucket
+        :param prefix: Prefix of the object keys in the bucket
+        :param endpoint_url: URL of the object store, or None for AWS S3
+        :param public_url: URL the bucket prefix is publicly served from, or None to link to presigned URLs
+        :param url_expiry: Number of seconds presigned URLs are valid for
+        :param client: S3 client to use instead of one created with boto3
+        """
+        if client is None:
+            if boto3 is None:
+                raise ImproperlyConfigured('The S3 artefact backend requires boto3 to be installed.')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url
+        self.url_expiry = url_expiry
+
+    def save(self, key, data, content_type):
+        """
+        Method to save an artefact.
+
+        :param key: Key of the artefact
+        :param data: Content of the artefact
+        :param content_type: MIME type of the artefact
+        """
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type)
+
+    def read(self, key):
+        """
+        :param key: Key of the artefact
+        :return: Content of the artefact
+        """
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+
+    def delete(self, key):
+        """
+        :param key: Key of the artefact, which may already be deleted
+        """
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def url(self, key):
+        """
+        :param key: Key of the artefact
+        :return: URL the artefact is downloaded from
+        """
+        if self.public_url:
+            return self.public_url + key
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket,
+                                                                        'Key': self.prefix + key},
+                                                  ExpiresIn=self.url_expiry)
+
+
+@functools.lru_cache(maxsize=None)
+def _artefact_backend(backend, *options):
+    # Backends are created once per configuration, as creating an S3 client is slow
+    if backend == 'local':
+        return LocalArtefactBackend(*options)
+    if backend == 's3':
+        return S3ArtefactBackend(*options)
+    raise ImproperlyConfigured(f"Unknown artefact backend: {backend}")
+
+
+def artefact_backend():
+    """
+    Function to get the artefact backend configured by the ARTEFACT_BACKEND setting.
+
+    :return: The backend artefacts are saved with
+    """
+    backend = getattr(settings, 'ARTEFACT_BACKEND', 'local')
+    if backend == 's3':
+        return _artefact_backend('s3', settings.ARTEFACT_S3_BUCKET, getattr(settings, 'ARTEFACT_S3_PREFIX', ''),
+                                 getattr(settings, 'ARTEFACT_S3_ENDPOINT_URL', None),
+                                 getattr(settings, 'ARTEFACT_S3_PUBLIC_URL', None),
+                                 getattr(settings, 'ARTEFACT_URL_EXPIRY', 3600))
+    return _artefact_backend(backend, settings.MEDIA_ROOT, settings.MEDIA_URL)
+
+
+def save_artefact(data, name, content_type, backend=None):
+    """
+    Function to save an artefact under a key derived from its content, unless the same content is already saved.
+
+    :param data: Content of the artefact
+    :param name: File name of the artefact, which the key ends with so that downloads keep it
+    :param content_type: MIME type of the artefact
+    :param backend: Backend to save the artefact with, defaulting to the configured backend
+    :return: Key of the artefact
+    """
+    backend = backend or artefact_backend()
+    key = f"artefacts/{hashlib.sha256(data).hexdigest()[:32]}/{name}"
+
+    # The same content is already saved, so only its last access is updated
+    if Artefact.objects.filter(key=key).update(last_accessed_at=timezone.now()):
+        return key
+
+    backend.save(key, data, content_type)
+    try:
+        with transaction.atomic():
+            Artefact.objects.create(key=key, content_type=content_type, size=len(data))
+    except IntegrityError:
+        # Another request saved the same content at the same time
+        Artefact.objects.filter(key=key).update(last_accessed_at=timezone.now())
+    return key
+
+
+def save_dataframe_artefact(df, name, artefact_format='csv', backend=None):
+    """
+    Function to save a DataFrame as an artefact.
+
+    :param df: DataFrame to save
+    :param name: File name of the artefact, without its extension
+    :param artefact_format: Format to save the DataFrame in, one of DATAFRAME_FORMATS
+    :param backend: Backend to save the artefact with, defaulting to the configured backend
+    :return: Key of the artefact
+    """
+    if artefact_format not in DATAFRAME_FORMATS:
+        raise ValueError(f"Invalid artefact format: {artefact_format}")
+    extension, content_type = DATAFRAME_FORMATS[artefact_format]
+
+    data = df.to_csv(index=False).encode()
+    if artefact_format == 'csv.gz':
+        # Compress without a timestamp so that the same results always have the same key
+        data = gzip.compress(data, mtime=0)
+    return save_artefact(data, name + extension, content_type, backend=backend)
+
+
+def artefact_url(key, backend=None):
+    """
+    Function to get the URL an artefact is downloaded from.
+
+    :param key: Key of the artefact
+    :param backend: Backend the artefact is saved with, defaulting to the configured backend
+    :return: URL of the artefact
+    """
+    return (backend or artefact_backend()).url(key)
+
+
+def evict_artefacts(max_age=None, max_bytes=None, backend=None):
+    """
+    Function to delete the artefacts not accessed recently, and then the least recently accessed artefacts until
+    the artefacts fit in the size cap.
+
+    :param max_age: Time since its last access beyond which an artefact is deleted, or None to keep them all
+    :param max_bytes: Maximum total size of the artefacts in bytes, or None for no size cap
+    :param backend: Backend the artefacts are saved with, defaulting to the configured backend
+    :return: Number of artefacts deleted and their total size in bytes
+    """
+    backend = backend or artefact_backend()
+    evicted = []
+    if max_age is not None:
+        evicted.extend(Artefact.objects.filter(last_accessed_at__lt=timezone.now() - max_age)
+                       .values_list('id', 'key', 'size', 'last_accessed_at'))
+
+    if max_bytes is not None:
+        evicted_ids = {artefact[0] for artefact in evicted}
+        remaining = (Artefact.objects.exclude(id__in=evicted_ids).aggregate(total=Sum('size'))['total'] or 0)
+        # Walk the artefacts from the least recently accessed until the rest fit in the cap
+        for artefact in (Artefact.objects.exclude(id__in=evicted_ids).order_by('last_accessed_at', 'id')
+                         .values_list('id', 'key', 'size', 'last_accessed_at').iterator()):
+            if remaining <= max_bytes:
+                break
+            evicted.append(artefact)
+            remaining -= artefact[2]
+
+    deleted, deleted_bytes = 0, 0
+    for artefact_id, key, size, last_accessed_at in evicted:
+        # An artefact saved again since it was selected has a new last access and is kept, along with its file
+        if not Artefact.objects.filter(id=artefact_id, last_accessed_at=last_accessed_at).delete()[0]:
+            continue
+        # The index entry is deleted first so that a file that fails to be deleted is orphaned rather than linked to
+        backend.delete(key)
+        deleted += 1
+        deleted_bytes += size
+    return deleted, deleted_bytes
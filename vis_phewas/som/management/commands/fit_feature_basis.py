@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from som.streaming import save_catalog_feature_bases
+
+
+class Command(BaseCommand):
+    help = 'Fits the SVD bases the SOM inputs are projected onto on the whole catalog and saves them'
+
+    def handle(self, *args, **kwargs):
+        for som_type, saved in save_catalog_feature_bases().items():
+            if saved:
+                self.stdout.write(f"Saved the {som_type} feature basis")
+            else:
+                self.stdout.write(f"The {som_type} features are too few to reduce, so no basis was saved")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from som.som_utils import build_som_input, run_som_evaluation, summarise_som_evaluations, SOM_PARAMS
+
+
+class Command(BaseCommand):
+    help = 'Evaluates the SOM over several random seeds in parallel and saves the summarised metrics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', dest='som_type', choices=['snp', 'disease'], required=True,
+                            help='Type of the SOM to evaluate')
+        parser.add_argument('--filters', default='', help='Filters to apply to the catalog before training')
+        parser.add_argument('--seeds', type=int, default=5, help='Number of random seeds to evaluate')
+        parser.add_argument('--clusters', type=int, default=4, help='Number of clusters')
+        parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals')
+        parser.add_argument('--output', default=None,
+                            help='Output CSV path (defaults to som_evaluation_results_<type>.csv)')
+        parser.add_argument('--jobs', type=int, default=-1, help='Number of worker processes (-1 for all cores)')
+        parser.add_argument('--blas-threads', type=int, default=1, help='BLAS/OpenMP threads per worker')
+
+    def handle(self, *args, **kwargs):
+        som_type = kwargs['som_type']
+        output_csv = kwargs['output'] or f"som_evaluation_results_{som_type}.csv"
+
+        try:
+            x_normalised = build_som_input(kwargs['filters'], som_type)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # Evaluate every seed in parallel and keep the metrics in memory
+        runs_df = run_som_evaluation(x_normalised, SOM_PARAMS[som_type], kwargs['clusters'],
+                                     seeds=range(kwargs['seeds']), n_jobs=kwargs['jobs'],
+                                     blas_threads=kwargs['blas_threads'])
+        summary_df = summarise_som_evaluations(runs_df, confidence=kwargs['confidence'])
+        summary_df.to_csv(output_csv, index=False)
+
+        self.stdout.write(summary_df.to_string(index=False))
+        self.stdout.write(self.style.SUCCESS(f"Evaluation results for {len(runs_df)} seeds saved to {output_csv}"))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from som.som_utils import build_som_input, parallel_grid_search_som
+
+
+class Command(BaseCommand):
+    help = 'Runs the SOM hyperparameter grid search in parallel, resuming from any results already saved'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', dest='som_type', choices=['snp', 'disease'], required=True,
+                            help='Type of the SOM to tune')
+        parser.add_argument('--filters', default='', help='Filters to apply to the catalog before training')
+        parser.add_argument('--output', default=None,
+                            help='Output CSV path (defaults to grid_search_results_<type>.csv)')
+        parser.add_argument('--n-range', type=int, default=6, help='Number of grid sizes to explore')
+        parser.add_argument('--jobs', type=int, default=-1, help='Number of worker processes (-1 for all cores)')
+        parser.add_argument('--blas-threads', type=int, default=1, help='BLAS/OpenMP threads per worker')
+
+    def handle(self, *args, **kwargs):
+        som_type = kwargs['som_type']
+        output_csv = kwargs['output'] or f"grid_search_results_{som_type}.csv"
+
+        try:
+            x_normalised = build_som_input(kwargs['filters'], som_type)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        results_df = parallel_grid_search_som(x_normalised, output_csv=output_csv, n_range=kwargs['n_range'],
+                                              n_jobs=kwargs['jobs'], blas_threads=kwargs['blas_threads'])
+
+        best = results_df.loc[results_df['combined_score'].idxmin()]
+        self.stdout.write(self.style.SUCCESS(
+            f"Grid search complete: best configuration {int(best['som_x'])}x{int(best['som_y'])}, "
+            f"sigma={best['sigma']}, learning_rate={best['learning_rate']}, "
+            f"num_iterations={int(best['num_iterations'])}"
+        ))
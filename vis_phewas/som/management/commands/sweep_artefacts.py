@@ -0,0 +1,37 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from som.artefact_store import evict_artefacts
+
+
+class Command(BaseCommand):
+    help = 'Deletes the generated download files that have not been used recently or do not fit in the size cap'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age-hours', type=float, default=None,
+                            help='Age of the last use beyond which a file is deleted (defaults to '
+                                 'ARTEFACT_MAX_AGE_HOURS)')
+        parser.add_argument('--max-size-mb', type=float, default=None,
+                            help='Total size of the files beyond which the least recently used files are deleted '
+                                 '(defaults to ARTEFACT_MAX_SIZE_MB)')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and sweep every this many seconds instead of sweeping once')
+
+    def handle(self, *args, **kwargs):
+        max_age_hours = kwargs['max_age_hours']
+        if max_age_hours is None:
+            max_age_hours = getattr(settings, 'ARTEFACT_MAX_AGE_HOURS', 24)
+        max_size_mb = kwargs['max_size_mb']
+        if max_size_mb is None:
+            max_size_mb = getattr(settings, 'ARTEFACT_MAX_SIZE_MB', 512)
+
+        while True:
+            deleted, deleted_bytes = evict_artefacts(max_age=timedelta(hours=max_age_hours),
+                                                     max_bytes=int(max_size_mb * 1024 ** 2))
+            self.stdout.write(f"Deleted {deleted} files ({deleted_bytes} bytes)")
+
+            if kwargs['interval'] is None:
+                break
+            time.sleep(kwargs['interval'])
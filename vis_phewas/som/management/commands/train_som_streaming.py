@@ -0,0 +1,49 @@
+import hashlib
+
+from django.core.management.base import BaseCommand, CommandError
+from som.model_store import save_som_model
+from som.som_utils import SOM_PARAMS
+from som.streaming import train_streaming_som, STREAM_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Trains a SOM on the catalog with mini-batches streamed from the database and saves it as a SOM version'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', dest='som_type', choices=['snp', 'disease'], required=True,
+                            help='Type of the SOM to train')
+        parser.add_argument('--filters', default='', help='Filters to apply to the catalog before training')
+        parser.add_argument('--epochs', type=int, default=5, help='Number of passes over the catalog')
+        parser.add_argument('--chunk-size', type=int, default=STREAM_CHUNK_SIZE,
+                            help='Approximate number of associations read from the database at a time')
+        parser.add_argument('--som-x', type=int, default=None, help='SOM grid width (defaults to the SOM view size)')
+        parser.add_argument('--som-y', type=int, default=None, help='SOM grid height (defaults to the SOM view size)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed of the SVD and SOM initialisation')
+
+    def handle(self, *args, **kwargs):
+        som_type = kwargs['som_type']
+        som_params = {
+            'sigma': SOM_PARAMS[som_type]['sigma'],
+            'learning_rate': SOM_PARAMS[som_type]['learning_rate'],
+            'som_x': kwargs['som_x'],
+            'som_y': kwargs['som_y'],
+            'epochs': kwargs['epochs'],
+            'seed': kwargs['seed'],
+        }
+
+        try:
+            positions, som, labels, transforms = train_streaming_som(
+                kwargs['filters'], som_type, som_params, epochs=kwargs['epochs'], chunk_size=kwargs['chunk_size'],
+                random_seed=kwargs['seed'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # Version the SOM by the data and parameters it was trained on, as the SOM view does
+        digest = hashlib.sha256(f"streaming:{som_type}:{kwargs['filters']}:{sorted(som_params.items())}".encode())
+        version = digest.hexdigest()
+        save_som_model(version, som, positions, transforms, som_type, som_params, labels)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Trained a {som.get_weights().shape[0]}x{som.get_weights().shape[1]} SOM on {len(labels)} "
+            f"{som_type}s: version {version}"
+        ))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from som.som_utils import build_som_input, successive_halving_som
+
+
+class Command(BaseCommand):
+    help = 'Tunes the SOM parameters with successive halving and saves the results in the grid search CSV format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', dest='som_type', choices=['snp', 'disease'], required=True,
+                            help='Type of the SOM to tune')
+        parser.add_argument('--filters', default='', help='Filters to apply to the catalog before training')
+        parser.add_argument('--output', default=None,
+                            help='Output CSV path (defaults to grid_search_results_<type>.csv)')
+        parser.add_argument('--n-range', type=int, default=6, help='Number of grid sizes to explore')
+        parser.add_argument('--min-iterations', type=int, default=1250, help='Iteration budget of the first round')
+        parser.add_argument('--max-iterations', type=int, default=20000, help='Full iteration budget')
+        parser.add_argument('--eta', type=int, default=2, help='Budget growth and candidate reduction factor')
+        parser.add_argument('--jobs', type=int, default=-1, help='Number of worker processes (-1 for all cores)')
+        parser.add_argument('--blas-threads', type=int, default=1, help='BLAS/OpenMP threads per worker')
+
+    def handle(self, *args, **kwargs):
+        som_type = kwargs['som_type']
+        output_csv = kwargs['output'] or f"grid_search_results_{som_type}.csv"
+
+        try:
+            x_normalised = build_som_input(kwargs['filters'], som_type)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        try:
+            results_df = successive_halving_som(x_normalised, output_csv=output_csv, n_range=kwargs['n_range'],
+                                                min_iterations=kwargs['min_iterations'],
+                                                max_iterations=kwargs['max_iterations'], eta=kwargs['eta'],
+                                                n_jobs=kwargs['jobs'], blas_threads=kwargs['blas_threads'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # The best candidate is the best scoring one trained for the full budget
+        final_df = results_df[results_df['num_iterations'] == results_df['num_iterations'].max()]
+        best = final_df.loc[final_df['combined_score'].idxmin()]
+        self.stdout.write(self.style.SUCCESS(
+            f"Tuning complete: best configuration {int(best['som_x'])}x{int(best['som_y'])}, "
+            f"sigma={best['sigma']}, learning_rate={best['learning_rate']}, "
+            f"num_iterations={int(best['num_iterations'])}"
+        ))
@@ -0,0 +1,291 @@
+"""
+Versioned storage of trained SOMs.
+
+Each SOM is saved in its own directory under SOM_MODEL_ROOT, named after its version. Training is not seeded, so the
+same data can train to different SOMs; each trained SOM is therefore given a new random version rather than one
+derived from its input, so that a version always refers to the map it was shown with. The weights and the SVD and scaler transforms that produced the SOM input are saved
+as .npy arrays so that they can be memory-mapped rather than read into every process, and the rest of the model is
+described by a metadata.json file.
+"""
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from scipy.sparse import csr_matrix, issparse
+from som.training import occupied_neurons, cluster_neurons
+
+# Arrays saved for each SOM, svd_components being absent if the features were not reduced
+MODEL_ARRAYS = ('weights', 'positions', 'svd_components', 'scale')
+
+# Versions are 64 hex digits, which also stops them being used to escape the model directory
+VERSION_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# Directory under SOM_MODEL_ROOT the SVD bases fitted on the whole catalog are saved in
+FEATURE_BASIS_DIR = 'feature_bases'
+
+
+def new_som_version():
+    """
+    Function to create the version of a newly trained SOM.
+
+    :return: A random version, unique to the SOM
+    """
+    return secrets.token_hex(32)
+
+
+def som_model_dir(version):
+    """
+    Function to get the directory a SOM version is saved in.
+
+    :param version: Version of the SOM
+    :return: Path of the SOM directory
+    """
+    if not VERSION_PATTERN.fullmatch(str(version)):
+        raise ValueError(f"Invalid SOM version: {version}")
+    return os.path.join(settings.SOM_MODEL_ROOT, version)
+
+
+def save_som_model(version, som, positions, transforms, som_type, som_params, labels, warm_started=False):
+    """
+    Function to save a trained SOM and the transforms of its input, unless that version is already saved.
+
+    :param version: Version of the SOM
+    :param som: The trained SOM
+    :param positions: Positions of the winning neuron of each training sample
+    :param transforms: Dictionary with the feature names, SVD components (or None) and scale of the SOM input
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param som_params: SOM training parameters
+    :param labels: SNP or disease of each training sample
+    :param warm_started: Whether the SOM was initialised from the weights of a previous SOM
+    :return: Path of the SOM directory
+    """
+    model_dir = som_model_dir(version)
+    if os.path.exists(model_dir):
+        return model_dir
+
+    arrays = {
+        'weights': som.get_weights(),
+        'positions': np.asarray(positions),
+        'svd_components': transforms['svd_components'],
+        'scale': transforms['scale'],
+    }
+    metadata = {
+        'version': version,
+        'type': som_type,
+        'params': som_params,
+        'feature_names': list(transforms['feature_names']),
+        'labels': [str(label) for label in labels],
+        'warm_started': warm_started,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+    }
+
+    # Write to a temporary directory first so that a SOM is never loaded half written
+    os.makedirs(settings.SOM_MODEL_ROOT, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=settings.SOM_MODEL_ROOT, prefix='.tmp-')
+    try:
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(temp_dir, f"{name}.npy"), np.ascontiguousarray(array))
+        with open(os.path.join(temp_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+        os.rename(temp_dir, model_dir)
+    except OSError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        # Another process saved the same version first
+        if not os.path.exists(model_dir):
+            raise
+    return model_dir
+
+
+def load_som_model(version):
+    """
+    Function to load a saved SOM, with its arrays memory-mapped.
+
+    :param version: Version of the SOM
+    :return: Dictionary with the SOM metadata and arrays, or None if the version is not saved
+    """
+    try:
+        model_dir = som_model_dir(version)
+    except ValueError:
+        return None
+    metadata_path = os.path.join(model_dir, 'metadata.json')
+    if not os.path.exists(metadata_path):
+        return None
+
+    with open(metadata_path) as f:
+        model = json.load(f)
+    for name in MODEL_ARRAYS:
+        array_path = os.path.join(model_dir, f"{name}.npy")
+        model[name] = np.load(array_path, mmap_mode='r') if os.path.exists(array_path) else None
+    return model
+
+
+def list_som_models():
+    """
+    Function to list the saved SOMs, newest first.
+
+    :return: List of dictionaries with the version, type, parameters, grid size and creation time of each SOM
+    """
+    if not os.path.isdir(settings.SOM_MODEL_ROOT):
+        return []
+
+    models = []
+    for version in os.listdir(settings.SOM_MODEL_ROOT):
+        model = load_som_model(version)
+        if model is None:
+            continue
+        models.append({
+            'version': version,
+            'type': model['type'],
+            'params': model['params'],
+            'grid': list(model['weights'].shape[:2]),
+            'samples': len(model['labels']),
+            'created_at': model['created_at'],
+        })
+    return sorted(models, key=lambda m: m['created_at'], reverse=True)
+
+
+def feature_basis_path(dataset_version, som_type):
+    """
+    Function to get the path an SVD basis of the whole catalog is saved at.
+
+    :param dataset_version: Version of the catalog, as returned by get_dataset_version
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Path of the basis file
+    """
+    if not re.fullmatch(r'[0-9a-f]{16}', str(dataset_version)) or som_type not in ('snp', 'disease'):
+        raise ValueError(f"Invalid feature basis: {dataset_version} ({som_type})")
+    return os.path.join(settings.SOM_MODEL_ROOT, FEATURE_BASIS_DIR, f"{som_type}-{dataset_version}.npz")
+
+
+def save_feature_basis(dataset_version, som_type, basis):
+    """
+    Function to save the SVD basis fitted on the whole catalog for a SOM type.
+
+    :param dataset_version: Version of the catalog the basis was fitted on
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param basis: Dictionary with the feature names and the SVD components
+    """
+    path = feature_basis_path(dataset_version, som_type)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that a basis is never loaded half written
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, feature_names=np.array(basis['feature_names'], dtype=str), components=basis['components'])
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def load_feature_basis(dataset_version, som_type):
+    """
+    Function to load the SVD basis fitted on the whole catalog for a SOM type.
+
+    :param dataset_version: Version of the catalog the basis was fitted on
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Dictionary with the feature names and the SVD components, or None if no basis is saved for the version
+    """
+    path = feature_basis_path(dataset_version, som_type)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {'feature_names': data['feature_names'].tolist(), 'components': data['components']}
+
+
+def align_features(features_matrix, feature_names, target_feature_names, mark_absent=True):
+    """
+    Function to map a features matrix onto the feature columns of a saved SOM.
+
+    Features the SOM was not trained on are dropped and features it was trained on that are absent are zero, except
+    for the 'absent' column ('<name>=0') of one-hot encoded indicators, which is set if mark_absent is True.
+
+    :param features_matrix: Features matrix, as returned by SOMView.engineer_features
+    :param feature_names: Name of each column of the features matrix
+    :param target_feature_names: Feature names of the saved SOM
+    :param mark_absent: Whether to set the 'absent' column of indicators missing from the features
+    :return: Sparse features matrix with the columns of the saved SOM
+    """
+    target_index = {name: i for i, name in enumerate(target_feature_names)}
+    columns = np.array([target_index.get(name, -1) for name in feature_names], dtype=int)
+
+    matrix = csr_matrix(features_matrix).tocoo()
+    keep = columns[matrix.col] >= 0 if len(columns) else np.zeros(len(matrix.data), dtype=bool)
+    rows, cols, data = matrix.row[keep], columns[matrix.col[keep]], matrix.data[keep]
+
+    # Indicators that are neither present nor absent in the features were absent from every item
+    present = set(feature_names)
+    absent = [i for name, i in target_index.items()
+              if mark_absent and name.endswith('=0') and name not in present and f"{name[:-2]}=1" not in present]
+    n_rows = matrix.shape[0]
+    rows = np.concatenate([rows, np.repeat(np.arange(n_rows), len(absent))])
+    cols = np.concatenate([cols, np.tile(np.array(absent, dtype=int), n_rows)])
+    data = np.concatenate([data, np.ones(n_rows * len(absent))])
+
+    return csr_matrix((data, (rows, cols)), shape=(n_rows, len(target_feature_names)))
+
+
+def transfer_som_weights(weights, source_transforms, target_transforms):
+    """
+    Function to map the weights of a SOM into the input space of another SOM, so that they can initialise it.
+
+    The weights are mapped back to the engineered features through the source scale and SVD components, aligned on
+    the feature names the two inputs share, and transformed with the target SVD components and scale.
+
+    :param weights: Weights of the source SOM, of shape (x, y, input_len)
+    :param source_transforms: Feature names, SVD components (or None) and scale of the source SOM input
+    :param target_transforms: Feature names, SVD components (or None) and scale of the target SOM input
+    :return: Weights of shape (x, y, target input_len)
+    """
+    weights = np.asarray(weights, dtype=float)
+    flat_weights = weights.reshape(-1, weights.shape[-1]) * np.asarray(source_transforms['scale'])
+    if source_transforms['svd_components'] is not None:
+        flat_weights = flat_weights @ np.asarray(source_transforms['svd_components'])
+
+    x = align_features(flat_weights, source_transforms['feature_names'], target_transforms['feature_names'],
+                       mark_absent=False)
+    if target_transforms['svd_components'] is not None:
+        x = x @ np.asarray(target_transforms['svd_components']).T
+    x = x.toarray() if issparse(x) else np.asarray(x)
+    x = x / np.asarray(target_transforms['scale'])
+    return x.reshape(weights.shape[0], weights.shape[1], -1)
+
+
+def project_onto_som(model, features_matrix, feature_names, num_clusters):
+    """
+    Function to project items onto a saved SOM, applying the same transforms as its training input.
+
+    :param model: Saved SOM, as returned by load_som_model
+    :param features_matrix: Features matrix of the items, as returned by SOMView.engineer_features
+    :param feature_names: Name of each column of the features matrix
+    :param num_clusters: Number of clusters the SOM neurons are grouped into
+    :return: Best matching unit, cluster and distance to the best matching unit of each item
+    """
+    x = align_features(features_matrix, feature_names, model['feature_names'])
+    # Apply the SVD projection and the scaling of the SOM input
+    if model['svd_components'] is not None:
+        x = x @ np.asarray(model['svd_components']).T
+    x = x.toarray() if issparse(x) else np.asarray(x)
+    x = x / np.asarray(model['scale'])
+
+    # Find the best matching unit of each item
+    weights = np.asarray(model['weights'])
+    flat_weights = weights.reshape(-1, weights.shape[-1])
+    distances = np.linalg.norm(x[:, None, :] - flat_weights[None, :, :], axis=-1)
+    winners = distances.argmin(axis=1)
+    bmus = np.column_stack(np.unravel_index(winners, weights.shape[:2]))
+
+    # Cluster the neurons in the same way as the SOM visualisation and assign each item its neuron's cluster
+    features, counts, _ = occupied_neurons(None, model['positions'])
+    kmeans = cluster_neurons(features, counts, num_clusters)
+    clusters = kmeans.predict(bmus.astype(float))
+
+    return bmus, clusters, distances[np.arange(len(x)), winners]
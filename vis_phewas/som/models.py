@@ -1 +1,16 @@
-# Create your models here.
+from django.db import models
+from django.utils import timezone
+
+
+class Artefact(models.Model):
+    """
+    Index of the files saved in the artefact store, used to evict them without listing the storage backend.
+    """
+    key = models.CharField(max_length=255, unique=True)  # Content-addressed path of the file in the backend
+    content_type = models.CharField(max_length=100)  # MIME type the file is served with
+    size = models.BigIntegerField()  # Size of the file in bytes
+    created_at = models.DateTimeField(auto_now_add=True)  # When the file was first saved
+    last_accessed_at = models.DateTimeField(default=timezone.now, db_index=True)  # When the file was last saved or linked
+
+    def __str__(self):
+        return f"Artefact {self.key} ({self.size} bytes)"
@@ -1,95 +1,267 @@
-import datetime
-import glob
+import functools
+import hashlib
 import os
+import threading
 import urllib.parse
-from datetime import datetime, timedelta
-from io import StringIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
+from api.filters import compile_filters
 from django.conf import settings
+from joblib import Parallel, delayed
+from mainapp.analytics import query_catalog_snapshot
 from mainapp.models import HlaPheWasCatalog
 from matplotlib import pyplot as plt
-from minisom import MiniSom
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
+from plotly.offline import get_plotlyjs
+from scipy import stats
 from sklearn.preprocessing import MinMaxScaler
+from som.training import initialise_som, evaluate_som_configuration, continue_som_configuration, occupied_neurons, \
+    cluster_neurons, weighted_cluster_scores, sampled_silhouette_score, som_evaluation_metrics, evaluate_som_seed, \
+    consensus_som_run, co_assignment_matrix, consensus_clusters
+from som.artefact_store import save_dataframe_artefact, artefact_url
+from som.streaming import som_queryset
 
 # Set the transparent colour for the visualisation
 TRANSPARENT = 'rgba(0,0,0,0)'
 
+# Set som parameters based on best grid search results (See grid_search_results_snp.csv
+# and grid_search_results_disease.csv, which can be regenerated with `manage.py tune_som`)
+SOM_PARAMS = {
+    'snp': {
+        'sigma': 1.5,
+        'learning_rate': 0.1,
+        'num_iterations': 10000,
+    },
+    'disease': {
+        'sigma': 1.0,
+        'learning_rate': 0.5,
+        'num_iterations': 20000,
+    },
+}
 
-def cluster_results_to_csv(cluster_results):
-    """
-    Function to save the cluster results to a CSV file and delete old files.
+# Range of cluster counts explored when recommending the number of clusters
+CLUSTER_COUNT_RANGE = range(2, 11)
 
-    :param cluster_results: DataFrame with the cluster results
-    :return: The name of the saved CSV
-    """
-    # Clean up old files
-    clean_up_old_files()
+# Number of points above which the SOM markers are drawn with WebGL rather than SVG
+SCATTERGL_THRESHOLD = 1000
+
+# Number of most significant associations shown in the hover text of each SOM point
+HOVER_TOP_K = 5
+
+# Minimum Jaccard similarity between two SOM input sets for one SOM to warm-start the other
+WARM_START_MIN_SIMILARITY = 0.5
+
+# Maximum number of SNPs or diseases, and number of iterations, of the SOM shown while the full SOM is trained
+PREVIEW_SAMPLE_SIZE = 300
+PREVIEW_ITERATIONS = 1000
+
+# Catalog columns used to engineer the SOM features and describe its points
+SOM_INPUT_COLUMNS = ['snp', 'phewas_string', 'category_string', 'gene_name', 'odds_ratio', 'cases', 'controls', 'p',
+                     'l95', 'u95', 'maf']
+
+# Number of SNPs or diseases above which SOMs are trained coarse to fine rather than on the full grid from scratch
+HIERARCHICAL_SOM_MIN_SAMPLES = 2000
 
-    # Get the current timestamp
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    # Save the cluster results to a CSV file
-    file_name = f"cluster_results_{timestamp}.csv"
-    # Set the file path
-    file_path = os.path.join(settings.MEDIA_ROOT, file_name)
-    cluster_results.to_csv(file_path, index=False)
-    # Return the file name
-    return file_name
+# Number of iterations of the child SOMs trained to drill down into a single neuron
+CHILD_SOM_ITERATIONS = 2000
 
+# Number of SOMs trained on subsamples to find consensus clusters
+CONSENSUS_RUNS = 10
 
-def clean_up_old_files() -> None:
+# Columns identifying a single grid search configuration
+GRID_SEARCH_PARAMS = ['som_x', 'som_y', 'multiplier', 'sigma', 'learning_rate', 'num_iterations']
+
+
+class TrainedSOMCache:
     """
-    Function to delete any cluster results files older than 1 day, but only if the oldest file is past the time delta.
+    In-process LRU cache of trained SOMs, so that the same input can be re-clustered or re-rendered without
+    retraining the SOM.
     """
-    # Define the directory and file pattern for cluster results files
-    file_pattern = os.path.join(settings.MEDIA_ROOT, "cluster_results_*.csv")
-    # Get all matching files
-    files = glob.glob(file_pattern)
 
-    if not files:
-        return  # No files to clean up
+    def __init__(self, max_entries):
+        """
+        :param max_entries: Maximum number of trained SOMs to keep in memory
+        """
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a cached entry and mark it as the most recently used.
+
+        :param key: Cache key of the entry
+        :return: The cached entry or None if it is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry) -> None:
+        """
+        Cache an entry, evicting the least recently used entries if the cache is full.
+
+        :param key: Cache key of the entry
+        :param entry: Dictionary with the trained SOM and its input
+        """
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def items(self):
+        """
+        Get a snapshot of the cached entries, without marking them as used.
+
+        :return: List of (key, entry) pairs, least recently used first
+        """
+        with self._lock:
+            return list(self._entries.items())
+
+
+# Trained SOMs shared by the requests handled by this process
+som_cache = TrainedSOMCache(getattr(settings, 'SOM_CACHE_SIZE', 8))
+
+
+class BackgroundSOMTrainer:
+    """
+    Trains SOMs in background threads, at most once at a time for each cache key, so that a preview can be returned
+    while the full SOM is trained.
+    """
 
-    # Sort files by timestamp (oldest first)
-    files.sort(key=lambda x: get_file_timestamp(x))
+    def __init__(self, max_workers):
+        """
+        :param max_workers: Maximum number of SOMs trained at the same time
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='som-training')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Start training a SOM in the background unless it is already being trained.
+
+        :param key: Cache key of the SOM
+        :param fn: Function training the SOM and storing it in the cache
+        :return: Future of the training job
+        """
+        with self._lock:
+            # Forget finished jobs, whose SOMs are in the cache, but keep failed ones so that they can be reported
+            self._jobs = {k: job for k, job in self._jobs.items() if not job.done() or job.exception() is not None}
+            job = self._jobs.get(key)
+            if job is None or job.done():
+                job = self._executor.submit(fn, *args, **kwargs)
+                self._jobs[key] = job
+            return job
+
+    def status(self, key):
+        """
+        Get the status of the background training of a SOM.
+
+        :param key: Cache key of the SOM
+        :return: 'ready' if the SOM is cached, 'training', 'failed' or 'unknown' if it is not being trained
+        """
+        if som_cache.get(key) is not None:
+            return 'ready'
+        with self._lock:
+            job = self._jobs.get(key)
+        if job is None:
+            return 'unknown'
+        if not job.done():
+            return 'training'
+        return 'failed' if job.exception() is not None else 'ready'
+
+
+# Background SOM training shared by the requests handled by this process
+som_trainer = BackgroundSOMTrainer(getattr(settings, 'SOM_BACKGROUND_WORKERS', 1))
+
+
+def stratified_sample(filtered_df, som_type, max_items=PREVIEW_SAMPLE_SIZE, random_state=42):
+    """
+    Function to sample the SNPs (stratified by gene) or diseases (stratified by category) of the SOM input, keeping
+    every association of the sampled SNPs or diseases.
 
-    # Get the timestamp of the oldest file
-    oldest_file_time = get_file_timestamp(files[0])
+    :param filtered_df: Preprocessed DataFrame containing the input data
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param max_items: Number of SNPs or diseases to sample, which may be exceeded slightly as every stratum is sampled
+    :param random_state: Seed of the sample
+    :return: DataFrame with the associations of the sampled SNPs or diseases
+    """
+    label_column, stratum_column = ('snp', 'gene_name') if som_type == 'snp' else ('phewas_string', 'category_string')
+    item_strata = filtered_df.groupby(label_column, sort=False, observed=True)[stratum_column].first()
+    if len(item_strata) <= max_items:
+        return filtered_df
+
+    # Give each stratum a share of the sample proportional to its size, with at least one item
+    stratum_sizes = item_strata.value_counts()
+    quotas = np.maximum((stratum_sizes * max_items / len(item_strata)).round().astype(int), 1)
+    # Shuffle the items and keep the first ones of each stratum up to its quota
+    shuffled = item_strata.sample(frac=1, random_state=random_state)
+    ranks = shuffled.groupby(shuffled, observed=True).cumcount()
+    sampled = shuffled.index[ranks.to_numpy() < quotas.reindex(shuffled.to_numpy()).to_numpy()]
+    return filtered_df[filtered_df[label_column].isin(sampled)]
+
+
+def find_warm_start_entry(som_type, labels, min_similarity=WARM_START_MIN_SIMILARITY):
+    """
+    Function to find the cached SOM trained on the input set most similar to the given one, to warm-start a new SOM.
 
-    # Calculate the cutoff time for deletion (1 day ago)
-    cutoff_time = datetime.now() - timedelta(days=1)
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param labels: SNPs or diseases of the new SOM input
+    :param min_similarity: Minimum Jaccard similarity of the input sets for a cached SOM to be used
+    :return: The cached entry with the most similar input set, or None if none is similar enough
+    """
+    labels = set(labels)
+    best_entry, best_similarity = None, min_similarity
+    for _, entry in som_cache.items():
+        # Only SOMs of the same type whose input transforms are known can be transferred
+        if entry.get('som_type') != som_type or not entry.get('transforms'):
+            continue
+        cached_labels = entry['labels']
+        similarity = len(labels & cached_labels) / len(labels | cached_labels) if labels | cached_labels else 0
+        if similarity >= best_similarity:
+            best_entry, best_similarity = entry, similarity
+    return best_entry
+
+
+def som_cache_key(som_type, filtered_df, som_params=None):
+    """
+    Function to compute the cache key of a SOM trained on the given preprocessed data.
 
-    # If the oldest file is older than the cutoff time, proceed with cleanup
-    if oldest_file_time < cutoff_time:
-        for file_path in files:
-            file_time = get_file_timestamp(file_path)
-            if file_time < cutoff_time:
-                os.remove(file_path)
-                print(f"Deleted old file: {os.path.basename(file_path)}")
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param filtered_df: Preprocessed DataFrame used as the SOM input
+    :param som_params: SOM training parameters
+    :return: Hex digest identifying the SOM input and parameters
+    """
+    digest = hashlib.sha256(f"{som_type}:{sorted((som_params or {}).items())}".encode())
+    digest.update(pd.util.hash_pandas_object(filtered_df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
 
 
-def get_file_timestamp(file_path):
+def cluster_results_to_csv(cluster_results):
     """
-    Extracts and parses the timestamp from the given file path.
+    Function to save the cluster results to a CSV file in the artefact store.
 
-    :param file_path: Path to the file
-    :return: datetime object representing the file's timestamp
+    :param cluster_results: DataFrame with the cluster results
+    :return: The URL the saved results are downloaded from
     """
-    file_name = os.path.basename(file_path)
-    try:
-        # Extract and parse the timestamp from the filename
-        parts = file_name.split('_')
-        if len(parts) >= 4:  # Ensure there are enough parts to extract a valid timestamp
-            timestamp_str = parts[2] + "_" + parts[3].split('.')[0]
-            return datetime.strptime(timestamp_str, "%Y%m%d_%H%M%S")
-    except ValueError:
-        # In case of any parsing error, return a very recent time to avoid accidental deletion
-        pass
-
-    # Return a recent time if filename format is invalid
-    return datetime.now()
+    # The results are saved under a key derived from their content, so the same results are only saved once and
+    # the sweep_artefacts command deletes the results that are no longer used
+    key = save_dataframe_artefact(cluster_results, 'cluster_results',
+                                  getattr(settings, 'CLUSTER_RESULTS_FORMAT', 'csv'))
+    return artefact_url(key)
 
 
 def preprocess_temp_data(temp_data):
@@ -99,46 +271,71 @@ def preprocess_temp_data(temp_data):
     :param temp_data: TemporaryCSVData object
     :return: Preprocessed DataFrame
     """
-    # Read the CSV content
-    csv_content = temp_data.csv_content
-    df = pd.read_csv(StringIO(csv_content))
-    # Preprocessing
-    filtered_df = df[df['subtype'] != 0]  # Keep only 4-digit HLA alleles
+    # Read the staged rows
+    df = temp_data.to_dataframe()
+    return preprocess_som_data(df)
+
+
+def load_som_data(filters, som_type):
+    """
+    Function to load the preprocessed SOM input straight from the catalog, with the filters and the preprocessing of
+    preprocess_som_data applied by the catalog snapshot engine or the database.
+
+    :param filters: Filters string, URL encoded as sent by the SOM page
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Preprocessed DataFrame with the columns the SOM uses
+    """
+    filters = urllib.parse.unquote(filters or '')
+    # Scan the catalog snapshot if there is one, with the filters of som_queryset pushed into the scan
+    label_column = 'snp' if som_type == 'snp' else 'phewas_string'
+    df = query_catalog_snapshot(compile_filters(filters, show_subtypes=True),
+                                required=[('subtype', 'not in', ['0', '00']), ('p', '<', 0.05)],
+                                columns=SOM_INPUT_COLUMNS, order_by=(label_column, 'id'))
+    if df is None:
+        queryset = som_queryset(filters, som_type)
+        df = pd.DataFrame.from_records(queryset.values_list(*SOM_INPUT_COLUMNS), columns=SOM_INPUT_COLUMNS)
+    df['snp'] = df['snp'].str.replace('HLA_', '').str.strip()  # Remove the prefix "HLA_"
+    return df
+
+
+def preprocess_som_data(df):
+    """
+    Function to preprocess the catalog data used as the input of the SOM.
+
+    :param df: DataFrame with the catalog rows
+    :return: Preprocessed DataFrame
+    """
+    # Subtypes are strings ('00') when read from the database and integers when read back from a CSV
+    subtype = pd.to_numeric(df['subtype'], errors='coerce')
+    filtered_df = df[subtype != 0]  # Keep only 4-digit HLA alleles
     filtered_df = filtered_df[filtered_df['p'] < 0.05]  # Only keep statistically significant associations
     filtered_df['snp'] = filtered_df['snp'].str.replace('HLA_', '').str.strip()  # Remove the prefix "HLA_"
+    # Drop the categories of the catalog columns that were filtered out, so they are not encoded as features
+    for column in filtered_df.select_dtypes('category'):
+        filtered_df[column] = filtered_df[column].cat.remove_unused_categories()
     return filtered_df
 
 
-def initialise_som(x_normalised, som_x=None, som_y=None, sigma=1.0, learning_rate=0.5, num_iterations=20000):
+def build_som_input(filters, som_type):
     """
-    Function to initialise and train the SOM with dynamic parameters.
+    Function to build the normalised SOM input in the same way as the SOM view, for the offline tuning and
+    evaluation commands.
 
-    :param x_normalised: Normalised feature matrix
-    :param som_x: Width of the SOM grid
-    :param som_y: Height of the SOM grid
-    :param sigma: Spread of the neighborhood function
-    :param learning_rate: Initial learning rate
-    :param num_iterations: Number of iterations for training
-    :return: Positions of the winning neurons and the trained SOM
+    :param filters: Filters string applied to the catalog
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Normalised SOM input matrix
+    :raises ValueError: If no associations match the filters
     """
-    # Use rule of 10 sqrt(n) for the number of neurons if not specified
-    if som_x is None:
-        som_x = int(np.sqrt(10 * np.sqrt(x_normalised.shape[0])))
-    if som_y is None:
-        som_y = int(np.sqrt(10 * np.sqrt(x_normalised.shape[0])))
+    # Imported here as the views import this module
+    from api.views import get_filtered_df
+    from som.views import SOMView
 
-    print(f"Training SOM with {som_x}x{som_y} grid, sigma={sigma}, learning_rate={learning_rate}, "
-          f"num_iterations={num_iterations}")
-
-    # Initialise the SOM
-    input_len = x_normalised.shape[1]
-    som = MiniSom(x=som_x, y=som_y, input_len=input_len, sigma=sigma, learning_rate=learning_rate)
-    som.random_weights_init(x_normalised)
-    som.train_random(x_normalised, num_iterations)
-
-    # Get the positions of the winning neurons
-    positions = np.array([som.winner(x) for x in x_normalised])
-    return positions, som
+    df = get_filtered_df(filters)
+    if df.empty:
+        raise ValueError('No associations match the given filters')
+    filtered_df = preprocess_som_data(df)
+    x_normalised, _ = SOMView().prepare_som_input(filtered_df, som_type)
+    return x_normalised
 
 
 def clean_filters(filters, som_type):
@@ -258,6 +455,28 @@ def style_visualisation(cleaned_filters, fig, title_text) -> None:
     )
 
 
+def figure_to_json(fig):
+    """
+    Function to serialise a plotly figure to JSON that is safe to embed in a script element.
+
+    :param fig: Plotly figure object
+    :return: JSON string with the figure data and layout
+    """
+    # Escape the characters that could close the script element or start an entity
+    return fig.to_json().replace('<', '\\u003C').replace('>', '\\u003E').replace('&', '\\u0026')
+
+
+@functools.lru_cache(maxsize=1)
+def plotly_js_bundle():
+    """
+    Function to get the plotly.js bundle shipped with the installed plotly version and its content hash.
+
+    :return: The plotly.js source and the first 16 characters of its SHA-256 digest
+    """
+    js = get_plotlyjs()
+    return js, hashlib.sha256(js.encode()).hexdigest()[:16]
+
+
 def plot_metrics_on_som(positions, som_type):
     """
     Function to plot the Elbow Method and Silhouette Score graphs for a range of clusters based on the SOM grid positions.
@@ -267,15 +486,18 @@ def plot_metrics_on_som(positions, som_type):
     """
     wcss = []
     silhouette_scores = []
-    range_n_clusters = range(2, 11)  # Trying 2 to 10 clusters
+    range_n_clusters = CLUSTER_COUNT_RANGE  # Trying 2 to 10 clusters
+
+    # Collapse the samples onto the neurons they were mapped to
+    features, counts, sample_neurons = occupied_neurons(None, positions)
 
-    # Perform KMeans clustering for each number of clusters
+    # Perform KMeans clustering of the neurons for each number of clusters
     for n_clusters in range_n_clusters:
-        kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-        cluster_labels = kmeans.fit_predict(positions)  # Use the SOM positions for clustering
+        kmeans = cluster_neurons(features, counts, n_clusters)
+        cluster_labels = kmeans.labels_[sample_neurons]  # Map the neuron clusters back to the samples
 
         wcss.append(kmeans.inertia_)
-        silhouette_avg = silhouette_score(positions, cluster_labels, random_state=42)
+        silhouette_avg = sampled_silhouette_score(positions, cluster_labels)
         silhouette_scores.append(silhouette_avg)
 
     # Plotting the Elbow Method graph (WCSS)
@@ -295,18 +517,65 @@ def plot_metrics_on_som(positions, som_type):
     plt.show()
 
 
-def grid_search_som(x_normalised, output_csv='som_grid_search_results.csv', n_range=6):
+def evaluate_cluster_count(features, counts, sample_neurons, positions, n_clusters):
     """
-    Function to perform grid search for the best SOM parameters and save all results to a CSV file.
+    Function to cluster the occupied neurons into n_clusters and compute the cluster quality metrics.
+
+    :param features: Features of the occupied neurons
+    :param counts: Number of samples mapped to each neuron
+    :param sample_neurons: Index of the neuron each sample was mapped to
+    :param positions: Positions of the winning neuron of each sample
+    :param n_clusters: Number of clusters
+    :return: Dictionary with the WCSS, silhouette, Davies-Bouldin and Calinski-Harabasz scores
+    """
+    kmeans = cluster_neurons(features, counts, n_clusters)
+    dbi, ch = weighted_cluster_scores(features, kmeans.labels_, counts)
+    return {
+        'k': n_clusters,
+        'wcss': float(kmeans.inertia_),
+        'silhouette': float(sampled_silhouette_score(positions, kmeans.labels_[sample_neurons])),
+        'davies_bouldin': float(dbi),
+        'calinski_harabasz': float(ch),
+    }
+
+
+def cluster_count_sweep(positions, range_n_clusters=CLUSTER_COUNT_RANGE, n_jobs=-1):
+    """
+    Function to compute the cluster quality metrics for a range of cluster counts in parallel and suggest a number
+    of clusters.
+
+    :param positions: Positions of the winning neuron of each sample
+    :param range_n_clusters: Cluster counts to evaluate
+    :param n_jobs: Number of threads (-1 uses all available cores)
+    :return: List of the metrics for each cluster count and the suggested number of clusters
+    """
+    features, counts, sample_neurons = occupied_neurons(None, positions)
+    # Each count needs at least one more occupied neuron than clusters for the metrics to be defined
+    range_n_clusters = [k for k in range_n_clusters if 1 < k < len(features)]
+    if not range_n_clusters:
+        return [], None
+
+    # The neuron set is small so threads avoid the cost of copying it to worker processes
+    metrics = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(evaluate_cluster_count)(features, counts, sample_neurons, positions, k) for k in range_n_clusters
+    )
+
+    # Suggest the number of clusters with the best silhouette score (the smallest in case of a tie)
+    suggested_k = max(metrics, key=lambda m: (m['silhouette'], -m['k']))['k']
+    return metrics, suggested_k
+
+
+def grid_search_configurations(n_samples, n_range=6):
+    """
+    Function to build the list of SOM parameter configurations explored by the grid search.
 
+    :param n_samples: Number of samples in the normalised feature matrix
     :param n_range: Number of values to generate within the range for x and y dimensions
-    :param x_normalised: Normalised feature matrix
-    :param output_csv: The output CSV file path to save the grid search results
-    :return: Best parameters and the corresponding quantisation error
+    :return: List of dictionaries with the som_x, som_y, multiplier, sigma, learning_rate and num_iterations keys
     """
     # Define parameter ranges for the grid search
-    lower_bound = int(np.sqrt(5 * np.sqrt(x_normalised.shape[0])))
-    upper_bound = int(np.sqrt(10 * np.sqrt(x_normalised.shape[0])))
+    lower_bound = int(np.sqrt(5 * np.sqrt(n_samples)))
+    upper_bound = int(np.sqrt(10 * np.sqrt(n_samples)))
 
     # Generate n_range values between lower_bound and upper_bound using linspace
     som_grid_range = np.linspace(lower_bound, upper_bound, n_range, dtype=int)
@@ -315,42 +584,37 @@ def grid_search_som(x_normalised, output_csv='som_grid_search_results.csv', n_ra
     learning_rate_range = [0.1, 0.5, 0.9]
     num_iterations_range = [5000, 10000, 20000]
 
-    # Create a list to store all results
-    results = []
-
+    configurations = []
     # Set a label column for n times
     grid_multiplier = 5
-    # Perform grid search
     for som_size in som_grid_range:
         for sigma in sigma_range:
             for learning_rate in learning_rate_range:
                 for num_iterations in num_iterations_range:
-                    # Train the SOM with the current set of parameters
-                    _, som = initialise_som(
-                        x_normalised,
-                        som_x=som_size,
-                        som_y=som_size,
-                        sigma=sigma,
-                        learning_rate=learning_rate,
-                        num_iterations=num_iterations
-                    )
-
-                    # Calculate quantisation error
-                    qe = som.quantization_error(x_normalised)
-                    te = som.topographic_error(x_normalised)
-
-                    # Append the result to the results list
-                    results.append({
-                        'som_x': som_size,
-                        'som_y': som_size,
+                    configurations.append({
+                        'som_x': int(som_size),
+                        'som_y': int(som_size),
                         'multiplier': grid_multiplier,
                         'sigma': sigma,
                         'learning_rate': learning_rate,
                         'num_iterations': num_iterations,
-                        'quantisation_error': qe,
-                        'topographic_error': te,
                     })
         grid_multiplier += 1  # Increment the grid multiplier for labelling
+    return configurations
+
+
+def grid_search_som(x_normalised, output_csv='som_grid_search_results.csv', n_range=6):
+    """
+    Function to perform grid search for the best SOM parameters and save all results to a CSV file.
+
+    :param n_range: Number of values to generate within the range for x and y dimensions
+    :param x_normalised: Normalised feature matrix
+    :param output_csv: The output CSV file path to save the grid search results
+    :return: Best parameters and the corresponding quantisation error
+    """
+    # Perform grid search, training the SOM with each set of parameters in turn
+    results = [evaluate_som_configuration(x_normalised, config)
+               for config in grid_search_configurations(x_normalised.shape[0], n_range)]
 
     # Convert results to a DataFrame
     results_df = pd.DataFrame(results)
@@ -363,6 +627,126 @@ def grid_search_som(x_normalised, output_csv='som_grid_search_results.csv', n_ra
     print(f"Grid search results saved to {output_csv}")
 
 
+def parallel_grid_search_som(x_normalised, output_csv='som_grid_search_results.csv', n_range=6, n_jobs=-1,
+                             blas_threads=1):
+    """
+    Function to perform the SOM grid search over a process pool, appending each result to the output CSV as soon as
+    it completes so that an interrupted search can be resumed.
+
+    Configurations already present in the output CSV are skipped. Once every configuration has been evaluated, the
+    combined score is computed over all results and the CSV is rewritten with the combined_score column.
+
+    :param x_normalised: Normalised feature matrix
+    :param output_csv: The output CSV file path to append the grid search results to
+    :param n_range: Number of values to generate within the range for x and y dimensions
+    :param n_jobs: Number of worker processes (-1 uses all available cores)
+    :param blas_threads: Maximum number of BLAS/OpenMP threads used by each worker
+    :return: DataFrame with the results of every configuration and their combined score
+    """
+    configurations = grid_search_configurations(x_normalised.shape[0], n_range)
+
+    # Load the results of a previous (possibly interrupted) run so completed configurations are not repeated
+    completed = set()
+    if os.path.exists(output_csv):
+        previous_df = pd.read_csv(output_csv)
+        if 'combined_score' in previous_df.columns:
+            # The combined score is relative to the whole grid so drop it and rewrite the raw results to append to
+            previous_df = previous_df.drop(columns=['combined_score'])
+            previous_df.to_csv(output_csv, index=False)
+        completed = set(previous_df[GRID_SEARCH_PARAMS].itertuples(index=False, name=None))
+
+    pending = [config for config in configurations
+               if tuple(config[param] for param in GRID_SEARCH_PARAMS) not in completed]
+    print(f"Grid search: {len(configurations) - len(pending)} configurations already completed, "
+          f"{len(pending)} remaining")
+
+    if pending:
+        # Evaluate the remaining configurations in parallel, yielding results in completion order
+        results = Parallel(n_jobs=n_jobs, return_as='generator_unordered')(
+            delayed(evaluate_som_configuration)(x_normalised, config, blas_threads) for config in pending
+        )
+        for result in results:
+            # Append the result straight away so a crash only loses the configurations still in flight
+            pd.DataFrame([result]).to_csv(output_csv, mode='a', header=not os.path.exists(output_csv), index=False)
+
+    # Compute the combined score for each set of parameters over the full set of results
+    results_df = pd.read_csv(output_csv)
+    results_df['combined_score'] = compute_combined_score(results_df['quantisation_error'],
+                                                          results_df['topographic_error'])
+    results_df.to_csv(output_csv, index=False)
+    print(f"Grid search results saved to {output_csv}")
+    return results_df
+
+
+def successive_halving_som(x_normalised, output_csv='som_successive_halving_results.csv', n_range=6,
+                           min_iterations=1250, max_iterations=20000, eta=2, n_jobs=-1, blas_threads=1):
+    """
+    Function to tune the SOM parameters with successive halving rather than an exhaustive grid search.
+
+    Every grid size, sigma and learning rate candidate is trained for min_iterations, scored with the combined QE/TE
+    score, and only the best 1/eta of the candidates keep training (from their current weights) for eta times the
+    budget, until max_iterations is reached. The learning rate and sigma decay always follows the max_iterations
+    schedule, so a survivor ends up trained exactly as if it had been trained for max_iterations in one go.
+
+    The results are saved with the same columns as the grid search, with one row per candidate and budget. The
+    combined score is computed between the candidates evaluated at the same budget.
+
+    :param x_normalised: Normalised feature matrix
+    :param output_csv: The output CSV file path to save the tuning results
+    :param n_range: Number of values to generate within the range for x and y dimensions
+    :param min_iterations: Iteration budget of the first round
+    :param max_iterations: Full iteration budget trained by the final survivors
+    :param eta: Factor by which the budget grows and the number of candidates shrinks each round
+    :param n_jobs: Number of worker processes (-1 uses all available cores)
+    :param blas_threads: Maximum number of BLAS/OpenMP threads used by each worker
+    :return: DataFrame with the results of every round
+    """
+    if eta < 2:
+        raise ValueError("eta must be at least 2.")
+
+    # Every grid search configuration except the number of iterations is a candidate
+    candidates = []
+    for config in grid_search_configurations(x_normalised.shape[0], n_range):
+        candidate = {param: config[param] for param in GRID_SEARCH_PARAMS if param != 'num_iterations'}
+        if candidate not in candidates:
+            candidates.append(candidate)
+    soms = [None] * len(candidates)
+
+    results = []
+    trained = 0
+    budget = min(min_iterations, max_iterations)
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while True:
+            print(f"Successive halving: training {len(candidates)} candidates up to {budget} iterations")
+            rung = parallel(
+                delayed(continue_som_configuration)(x_normalised, candidate, som, trained, budget, max_iterations,
+                                                    blas_threads)
+                for candidate, som in zip(candidates, soms)
+            )
+            soms = [som for som, _ in rung]
+            rung_df = pd.DataFrame([result for _, result in rung])
+            rung_df['combined_score'] = compute_combined_score(rung_df['quantisation_error'],
+                                                               rung_df['topographic_error'])
+            results.append(rung_df)
+
+            if budget >= max_iterations:
+                break
+
+            # Keep the best scoring fraction of the candidates and continue training them from their current weights
+            n_survivors = max(1, int(np.ceil(len(candidates) / eta)))
+            survivors = np.argsort(rung_df['combined_score'].to_numpy(), kind='stable')[:n_survivors]
+            candidates = [candidates[i] for i in survivors]
+            soms = [soms[i] for i in survivors]
+            trained = budget
+            budget = min(budget * eta, max_iterations)
+
+    results_df = pd.concat(results, ignore_index=True)[GRID_SEARCH_PARAMS + ['quantisation_error',
+                                                                            'topographic_error', 'combined_score']]
+    results_df.to_csv(output_csv, index=False)
+    print(f"Successive halving results saved to {output_csv}")
+    return results_df
+
+
 def compute_combined_score(qe, te):
     """
     Compute the combined score for quantisation error (QE) and topographic error (TE) after normalisation.
@@ -384,108 +768,143 @@ def compute_combined_score(qe, te):
     return combined_score
 
 
-def evaluate_som(positions, positions_df, som, x_normalised, som_type):
+def evaluate_som(positions, positions_df, som, x_normalised):
     """
-    Helper function to evaluate the SOM using various metrics and save the results to a CSV file.
+    Helper function to evaluate the SOM using various metrics.
     :param positions: The SOM positions
-    :param positions_df: The positions DataFrame
+    :param positions_df: The positions DataFrame, with the cluster of each sample
     :param som: The trained SOM object
     :param x_normalised: The normalised input data
-    :param som_type: Type of the SOM ('snp' or 'disease')
-    :return:
-    """
-    # Evaluate the SOM using various metrics
-    qe = som.quantization_error(x_normalised)
-    te = som.topographic_error(x_normalised)
-    silhouette = silhouette_score(positions, positions_df['cluster'], random_state=42)
-    dbi = davies_bouldin_score(positions, positions_df['cluster'])
-    ch = calinski_harabasz_score(positions, positions_df['cluster'])
-
-    # Save the results to a CSV file
-    results = {
-        'Quantization Error': qe,
-        'Topographic Error': te,
-        'Silhouette Score': silhouette,
-        'Davies-Bouldin Index': dbi,
-        'Calinski-Harabasz Index': ch
-    }
-    results_df = pd.DataFrame(results, index=[0])
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-    results_df.to_csv(f'som_evaluation_results_{som_type}_{timestamp}.csv', index=False)
+    :return: Dictionary with the evaluation metrics
+    """
+    return som_evaluation_metrics(som, positions, positions_df['cluster'], x_normalised)
 
 
-def compute_mean_som_results(som_types=None):
+def run_som_evaluation(x_normalised, som_params, num_clusters, seeds, n_jobs=-1, blas_threads=1):
     """
-    Compute the mean of all the SOM evaluation results for each SOM type and save to a new CSV file.
+    Function to train, cluster and evaluate a SOM with several random seeds in parallel worker processes.
 
-    :param som_types: List of SOM types (e.g., ['snp', 'disease'])
-    :return: Dictionary of DataFrames with mean results for each SOM type
+    :param x_normalised: Normalised feature matrix
+    :param som_params: Dictionary with the SOM training parameters
+    :param num_clusters: Number of clusters
+    :param seeds: Random seeds to evaluate the SOM with
+    :param n_jobs: Number of worker processes (-1 uses all available cores)
+    :param blas_threads: Maximum number of BLAS/OpenMP threads used by each worker
+    :return: DataFrame with the metrics of each seed
     """
-    # If no SOM types are provided, use the default list
-    if som_types is None:
-        som_types = ['snp', 'disease']
-    mean_results = {}
-
-    for som_type in som_types:
-        # Find all CSV files matching the pattern for the given som_type
-        file_pattern = f'som_evaluation_results_{som_type}_*.csv'
-        files = glob.glob(file_pattern)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(evaluate_som_seed)(x_normalised, som_params, num_clusters, seed, blas_threads) for seed in seeds
+    )
+    return pd.DataFrame(results).sort_values('Seed', ignore_index=True)
 
-        # List to store dataframes for each file
-        dataframes = []
 
-        # Read each CSV file and add it to the list
-        for file in files:
-            df = pd.read_csv(file)
-            dataframes.append(df)
+def run_consensus_clustering(x_normalised, som_params, num_clusters, n_runs=CONSENSUS_RUNS, n_jobs=-1,
+                             blas_threads=1):
+    """
+    Function to cluster the samples by consensus over SOMs trained on random subsamples in parallel worker processes.
 
-        # If there are files to process, compute the mean
-        if dataframes:
-            # Concatenate all DataFrames into one
-            all_data = pd.concat(dataframes, ignore_index=True)
+    :param x_normalised: Normalised feature matrix
+    :param som_params: Dictionary with the SOM training parameters
+    :param num_clusters: Number of clusters
+    :param n_runs: Number of SOMs to train
+    :param n_jobs: Number of worker processes (-1 uses all available cores)
+    :param blas_threads: Maximum number of BLAS/OpenMP threads used by each worker
+    :return: Consensus cluster of each sample and its stability between 0 and 1
+    """
+    runs = Parallel(n_jobs=n_jobs)(
+        delayed(consensus_som_run)(x_normalised, som_params, num_clusters, seed, blas_threads=blas_threads)
+        for seed in range(n_runs)
+    )
+    consensus = co_assignment_matrix(runs, x_normalised.shape[0])
+    return consensus_clusters(consensus, num_clusters)
 
-            # Compute the mean for each column
-            mean_df = all_data.mean().to_frame().T
 
-            # Add the result to the dictionary
-            mean_results[som_type] = mean_df
+def summarise_som_evaluations(runs_df, confidence=0.95):
+    """
+    Function to summarise the metrics of several SOM evaluation runs.
 
-            # Save the mean results to a new CSV file
-            mean_df.to_csv(f'som_evaluation_results_{som_type}_mean.csv', index=False)
-        else:
-            print(f"No files found for SOM type '{som_type}'")
+    :param runs_df: DataFrame with the metrics of each run, as returned by run_som_evaluation
+    :param confidence: Confidence level of the intervals around the means
+    :return: DataFrame with the number of runs, mean, standard deviation and confidence interval of each metric
+    """
+    metrics_df = runs_df.drop(columns=['Seed'], errors='ignore')
+    n_runs = len(metrics_df)
+    mean = metrics_df.mean()
+    std = metrics_df.std()
+    # Use the t distribution as the number of runs is small (the interval is undefined for a single run)
+    margin = stats.t.ppf((1 + confidence) / 2, n_runs - 1) * std / np.sqrt(n_runs)
+
+    summary_df = pd.DataFrame({
+        'Metric': metrics_df.columns,
+        'Runs': n_runs,
+        'Mean': mean.to_numpy(),
+        'Std': std.to_numpy(),
+        'CI Lower': (mean - margin).to_numpy(),
+        'CI Upper': (mean + margin).to_numpy(),
+    })
+    return summary_df
+
+
+def compute_mean_som_results(results_by_type):
+    """
+    Compute the mean of the SOM evaluation results of each SOM type.
 
+    :param results_by_type: Dictionary of SOM type (e.g., 'snp' or 'disease') to the evaluation results of its SOMs,
+    as a list of DataFrames or of metric dictionaries returned by evaluate_som
+    :return: Dictionary of DataFrames with mean results for each SOM type that has results
+    """
+    mean_results = {}
+    for som_type, results in results_by_type.items():
+        dataframes = [result if isinstance(result, pd.DataFrame) else pd.DataFrame([result]) for result in results]
+        if not dataframes:
+            continue
+        # Compute the mean of each metric over all the results of the SOM type
+        mean_results[som_type] = pd.concat(dataframes, ignore_index=True).mean().to_frame().T
     return mean_results
 
 
-def create_hover_text(cluster_data, som_type):
+def create_hover_text(cluster_data, som_type, top_k=HOVER_TOP_K):
     """
     Function to create the hover text for the SOM clusters based on the SOM type.
+
+    Only the top_k most significant associations of each point are shown, the full details being served on demand
+    by the SOM point view.
+
     :param cluster_data: DataFrame with the cluster data
     :param som_type: Type of the SOM ('snp' or 'disease')
+    :param top_k: Maximum number of associations shown for each point
     :return: List of hover texts for each node
     """
-    hover_texts = []
-    # Create the hover text based on the SOM type
     if som_type == 'snp':
-        for _, row in cluster_data.iterrows():
-            phenotype_details = "<br>".join([
-                f"Phenotype: {phewas_string[:10]}..., Odds Ratio: {or_value:.2f}, P-Value: {p:.4f}"
-                for phewas_string, or_value, p in zip(row['phenotypes'], row['odds_ratios'], row['p_values'])
-            ])
-            # Show only top 5 phenotypes based on odds ratio
-            reduced_details = "<br>".join(phenotype_details.split("<br>")[:5])
-
-            hover_text = f"SNP: {row['snp']}<br>{reduced_details}"
-            hover_texts.append(hover_text)
+        label_column, item_column, label_name, item_name = 'snp', 'phenotypes', 'SNP', 'Phenotype'
     else:
-        for _, row in cluster_data.iterrows():
-            snp_details = "<br>".join([
-                f"SNP: {snp}, Odds Ratio: {or_value:.2f}, P-Value: {p:.4f}"
-                for snp, or_value, p in zip(row['snps'], row['odds_ratios'], row['p_values'])
-            ])
-            hover_text = f"Disease: {row['phewas_string']}<br>{snp_details}"
-            hover_texts.append(hover_text)
-    return hover_texts
+        label_column, item_column, label_name, item_name = 'phewas_string', 'snps', 'Disease', 'SNP'
+    if cluster_data.empty:
+        return []
+
+    # One row per association, indexed by the position of its point in the cluster data
+    associations = cluster_data[[item_column, 'odds_ratios', 'p_values']].reset_index(drop=True)
+    associations = associations.explode([item_column, 'odds_ratios', 'p_values']).dropna(subset=['p_values'])
+    associations = associations.astype({'odds_ratios': float, 'p_values': float})
+    associations['point'] = associations.index
+
+    # Keep the most significant associations of each point with a single sort
+    associations = associations.sort_values(['point', 'p_values'], kind='stable')
+    associations = associations[associations.groupby('point').cumcount() < top_k]
+
+    # Format all the associations at once, truncating the long phenotype names of SNP hovers
+    items = associations[item_column].astype(str)
+    if som_type == 'snp':
+        items = items.str.slice(0, 10) + '...'
+    lines = (f"{item_name}: " + items
+             + ", Odds Ratio: " + np.char.mod('%.2f', associations['odds_ratios'].to_numpy())
+             + ", P-Value: " + np.char.mod('%.4f', associations['p_values'].to_numpy()))
+    details = lines.groupby(associations['point']).agg('<br>'.join).reindex(range(len(cluster_data)), fill_value='')
+
+    # Note how many associations were left out of the hover text
+    hidden = cluster_data[item_column].str.len().to_numpy() - top_k
+    more = np.where(hidden > 0, np.char.mod('<br>+%d more (click for details)', np.maximum(hidden, 0)), '')
+
+    hover_texts = (f"{label_name}: " + cluster_data[label_column].astype(str).to_numpy() + "<br>"
+                   + details.to_numpy() + more)
+    return hover_texts.tolist()
@@ -0,0 +1,335 @@
+"""
+Out-of-core SOM training streamed from the catalog.
+
+The associations are read from the database in chunks of whole SNPs or diseases, turned into sparse feature rows
+with the same layout and feature names as SOMView.engineer_features, and fed to a mini-batch SOM, so that neither the
+catalog nor the dense feature matrix ever has to be held in memory at once. Only the labels and the winning neuron of
+each SNP or disease are kept.
+"""
+import functools
+import os
+
+import numpy as np
+import pandas as pd
+from api.filters import apply_filters
+from mainapp.dataset import get_dataset_version
+from mainapp.models import HlaPheWasCatalog
+from scipy.sparse import csr_matrix, vstack
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import StandardScaler
+from sklearn.utils import check_random_state
+from som.model_store import load_feature_basis, save_feature_basis, feature_basis_path
+from som.training import som_grid_size, train_minibatch_som, best_matching_units
+
+# Number of catalog rows read from the database at a time
+STREAM_CHUNK_SIZE = 20000
+
+# Maximum number of SNPs or diseases the SVD projection is fitted on
+STREAM_SVD_SAMPLE_SIZE = 5000
+
+# Catalog columns the features are engineered from
+STREAM_COLUMNS = ['snp', 'phewas_string', 'category_string', 'gene_name', 'odds_ratio', 'cases', 'controls']
+
+
+def som_queryset(filters, som_type):
+    """
+    Function to get the catalog associations used as the SOM input, preprocessed in the database as
+    preprocess_som_data does in memory.
+
+    :param filters: Filters to apply to the catalog
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Queryset of the associations, ordered so that the associations of each SNP or disease are contiguous
+    """
+    queryset = apply_filters(HlaPheWasCatalog.objects.all(), filters, show_subtypes=True, export=True)
+    # Keep only the significant associations of 4-digit HLA alleles
+    queryset = queryset.exclude(subtype__in=['0', '00']).filter(p__lt=0.05)
+    return queryset.order_by('snp' if som_type == 'snp' else 'phewas_string', 'id')
+
+
+def feature_vocabulary(queryset, som_type):
+    """
+    Function to get the names of the features of the SOM input, in the order SOMView.engineer_features uses.
+
+    :param queryset: Queryset of the associations used as the SOM input
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: List of feature names
+    """
+
+    def distinct(column):
+        return sorted(queryset.order_by().values_list(column, flat=True).distinct())
+
+    categories = [f"category:{category}" for category in distinct('category_string')]
+    if som_type == 'snp':
+        phenotypes = distinct('phewas_string')
+        return [f"odds_ratio:{phenotype}" for phenotype in phenotypes] + \
+            [f"phenotype:{phenotype}" for phenotype in phenotypes] + categories
+    genes = distinct('gene_name')
+    return ['allele:0', 'allele:1'] + [f"gene:{gene}={value}" for gene in genes for value in (0, 1)] + categories
+
+
+def iter_item_chunks(queryset, som_type, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Function to read the associations in chunks that never split the associations of a SNP or disease.
+
+    :param queryset: Queryset of the associations, as returned by som_queryset
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param chunk_size: Approximate number of associations in each chunk
+    :return: Iterator over DataFrames of associations
+    """
+    label_index = STREAM_COLUMNS.index('snp' if som_type == 'snp' else 'phewas_string')
+    rows = []
+    for row in queryset.values_list(*STREAM_COLUMNS).iterator(chunk_size=chunk_size):
+        # Only cut the chunk between two SNPs or diseases
+        if len(rows) >= chunk_size and row[label_index] != rows[-1][label_index]:
+            yield pd.DataFrame(rows, columns=STREAM_COLUMNS)
+            rows = []
+        rows.append(row)
+    if rows:
+        yield pd.DataFrame(rows, columns=STREAM_COLUMNS)
+
+
+def chunk_features(chunk_df, som_type, vocabulary_index):
+    """
+    Function to engineer the sparse feature rows of the SNPs or diseases of a chunk, with the same values as
+    SOMView.engineer_features.
+
+    :param chunk_df: DataFrame with every association of the SNPs or diseases of the chunk
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param vocabulary_index: Dictionary of the column index of each feature name
+    :return: Sparse features matrix and the SNP or disease of each row
+    """
+    chunk_df = chunk_df.assign(snp=chunk_df['snp'].str.replace('HLA_', '').str.strip())
+    label_column = 'snp' if som_type == 'snp' else 'phewas_string'
+    items, labels = pd.factorize(chunk_df[label_column], sort=True)
+    shape = (len(labels), len(vocabulary_index))
+
+    def column(prefix, values):
+        return np.array([vocabulary_index[f"{prefix}{value}"] for value in values], dtype=int)
+
+    if som_type == 'snp':
+        # Odds ratio weighted by the share of cases, keeping the last association of repeated phenotypes
+        weighted = chunk_df['odds_ratio'] * chunk_df['cases'] / (chunk_df['cases'] + chunk_df['controls'] + 1e-5)
+        last = ~pd.DataFrame({'item': items, 'phenotype': chunk_df['phewas_string']}).duplicated(keep='last')
+        odds_ratios = csr_matrix((weighted[last].to_numpy(dtype=float),
+                                  (items[last.to_numpy()], column('odds_ratio:', chunk_df['phewas_string'][last]))),
+                                 shape=shape)
+        # The phenotypes and categories of each SNP are counted once for every association of the SNP, as the
+        # exploded phenotype and category lists are in engineer_features
+        associations = np.bincount(items)[items].astype(float)
+        indicators = csr_matrix((np.concatenate([associations, associations]),
+                                 (np.concatenate([items, items]),
+                                  np.concatenate([column('phenotype:', chunk_df['phewas_string']),
+                                                  column('category:', chunk_df['category_string'])]))),
+                                shape=shape)
+        return (odds_ratios + indicators).tocsr(), list(labels)
+
+    # Each disease has its genes marked present (=1) and every other gene absent (=0), and its first category
+    genes = [name[len('gene:'):-2] for name in vocabulary_index if name.startswith('gene:') and name.endswith('=1')]
+    present = np.zeros((len(labels), len(genes)), dtype=bool)
+    gene_position = {gene: i for i, gene in enumerate(genes)}
+    present[items, [gene_position[gene] for gene in chunk_df['gene_name']]] = True
+    gene_columns = np.where(present, column('gene:', [f"{gene}=1" for gene in genes]),
+                            column('gene:', [f"{gene}=0" for gene in genes]))
+    first_category = chunk_df.groupby(items)['category_string'].first()
+    rows = np.concatenate([np.repeat(np.arange(len(labels)), len(genes)), np.arange(len(labels))])
+    cols = np.concatenate([gene_columns.ravel(), column('category:', first_category)])
+    return csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape), list(labels)
+
+
+def iter_feature_chunks(queryset, som_type, vocabulary_index, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Function to stream the sparse feature rows of the SOM input.
+
+    :param queryset: Queryset of the associations, as returned by som_queryset
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param vocabulary_index: Dictionary of the column index of each feature name
+    :param chunk_size: Approximate number of associations in each chunk
+    :return: Iterator over the sparse features matrix and labels of each chunk
+    """
+    for chunk_df in iter_item_chunks(queryset, som_type, chunk_size):
+        yield chunk_features(chunk_df, som_type, vocabulary_index)
+
+
+def reservoir_sample_rows(feature_chunks, sample_size, random_state=42):
+    """
+    Function to draw a uniform sample of the rows of streamed sparse chunks, without replacement. Each row is given a
+    uniform random key and the rows with the sample_size smallest keys are kept, which is done a chunk at a time.
+
+    :param feature_chunks: Iterator over the sparse features matrix and labels of each chunk
+    :param sample_size: Maximum number of rows to keep
+    :param random_state: Seed of the sample
+    :return: Sparse matrix with the sampled rows, in no particular order
+    """
+    rng = check_random_state(random_state)
+    reservoir, keys = None, np.empty(0)
+    for features, _ in feature_chunks:
+        features = features.tocsr()
+        chunk_keys = rng.random_sample(features.shape[0])
+        if len(keys) == sample_size:
+            # Once the reservoir is full, only the rows with a smaller key than one it holds can enter it
+            candidates = np.flatnonzero(chunk_keys < keys.max())
+            features, chunk_keys = features[candidates], chunk_keys[candidates]
+        if reservoir is not None:
+            features = vstack([reservoir, features]).tocsr()
+            chunk_keys = np.concatenate([keys, chunk_keys])
+        if len(chunk_keys) > sample_size:
+            keep = np.argpartition(chunk_keys, sample_size - 1)[:sample_size]
+            features, chunk_keys = features[keep], chunk_keys[keep]
+        reservoir, keys = features, chunk_keys
+    return reservoir
+
+
+def fit_streaming_svd(feature_chunks, n_features, sample_size=STREAM_SVD_SAMPLE_SIZE, random_state=42):
+    """
+    Function to fit the SVD projection of the SOM input on a uniform reservoir sample of the feature rows.
+
+    :param feature_chunks: Iterator over the sparse features matrix and labels of each chunk
+    :param n_features: Number of features
+    :param sample_size: Maximum number of rows the SVD is fitted on
+    :param random_state: Seed of the sample and the SVD
+    :return: The fitted TruncatedSVD, or None if there are too few features to reduce, as in
+    SOMView.perform_dimensionality_reduction
+    """
+    if n_features <= 100:
+        return None
+    reservoir = reservoir_sample_rows(feature_chunks, sample_size, random_state)
+    # The randomized solver on single precision input needs half the memory of the default double precision
+    svd = TruncatedSVD(n_components=min(100, n_features - 1), algorithm='randomized', random_state=random_state)
+    return svd.fit(reservoir.astype(np.float32))
+
+
+def fit_feature_basis(som_type, random_state=42):
+    """
+    Function to fit the SVD basis of the SOM input on the whole catalog, streamed from the database.
+
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param random_state: Seed of the sample and the SVD
+    :return: Dictionary with the feature names and the single precision SVD components, or None if the catalog has
+    too few features to reduce
+    """
+    queryset = som_queryset('', som_type)
+    feature_names = feature_vocabulary(queryset, som_type)
+    vocabulary_index = {name: i for i, name in enumerate(feature_names)}
+    svd = fit_streaming_svd(iter_feature_chunks(queryset, som_type, vocabulary_index), len(feature_names),
+                            random_state=random_state)
+    if svd is None:
+        return None
+    return {'feature_names': feature_names, 'components': svd.components_.astype(np.float32)}
+
+
+def save_catalog_feature_bases():
+    """
+    Function to fit the SVD bases of both SOM types on the current catalog and save them, which is done when the
+    catalog is loaded so that SOM requests never fit them.
+
+    :return: Dictionary of the SOM type to whether a basis was saved for it (False if the catalog has too few features
+    to reduce)
+    """
+    dataset_version = get_dataset_version()
+    saved = {}
+    for som_type in ('snp', 'disease'):
+        basis = fit_feature_basis(som_type)
+        if basis is not None:
+            save_feature_basis(dataset_version, som_type, basis)
+        saved[som_type] = basis is not None
+    return saved
+
+
+@functools.lru_cache(maxsize=4)
+def cached_feature_basis(dataset_version, som_type):
+    """
+    Function to load the saved SVD basis of a catalog version.
+
+    :param dataset_version: Version of the catalog
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Dictionary with the feature names and SVD components
+    """
+    return load_feature_basis(dataset_version, som_type)
+
+
+def feature_basis(som_type):
+    """
+    Function to get the SVD basis of the current catalog, which every SOM input of the type is projected onto. The
+    basis is only loaded, never fitted, so a request does not stream the whole catalog.
+
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :return: Dictionary with the feature names and SVD components, or None if no basis is saved for the catalog, in
+    which case each selection is reduced with an SVD of its own
+    """
+    dataset_version = get_dataset_version()
+    # Missing bases are not cached, so a basis saved later is picked up
+    if not os.path.exists(feature_basis_path(dataset_version, som_type)):
+        return None
+    return cached_feature_basis(dataset_version, som_type)
+
+
+def train_streaming_som(filters, som_type, som_params, epochs=5, chunk_size=STREAM_CHUNK_SIZE, random_seed=42):
+    """
+    Function to train a SOM on the catalog without loading the whole input into memory.
+
+    The catalog is read once to fit the SVD projection, once to fit the scaler, once per epoch to train the SOM and
+    once to map the SNPs or diseases onto the trained SOM.
+
+    :param filters: Filters to apply to the catalog
+    :param som_type: Type of the SOM ('snp' or 'disease')
+    :param som_params: SOM training parameters (sigma and learning_rate, and optionally som_x and som_y)
+    :param epochs: Number of passes over the input to train the SOM for
+    :param chunk_size: Approximate number of associations read at a time
+    :param random_seed: Seed of the SVD and the SOM initialisation
+    :return: Positions of the winning neurons, the trained SOM, the SNP or disease of each position and the input
+    transforms
+    """
+    queryset = som_queryset(filters, som_type)
+    feature_names = feature_vocabulary(queryset, som_type)
+    vocabulary_index = {name: i for i, name in enumerate(feature_names)}
+
+    def feature_chunks():
+        return iter_feature_chunks(queryset, som_type, vocabulary_index, chunk_size)
+
+    svd = fit_streaming_svd(feature_chunks(), len(feature_names), random_state=random_seed)
+
+    def reduce(features):
+        return svd.transform(features) if svd is not None else features
+
+    # Fit the scaler on the reduced features and count the SNPs or diseases
+    scaler = StandardScaler(with_mean=False)
+    n_items, n_batches = 0, 0
+    for features, _ in feature_chunks():
+        scaler.partial_fit(reduce(features))
+        n_items += features.shape[0]
+        n_batches += 1
+    if n_items == 0:
+        raise ValueError('No associations match the given filters')
+
+    def normalised_chunks():
+        # Only a single chunk of the normalised input is dense at a time
+        for features, chunk_labels in feature_chunks():
+            x = scaler.transform(reduce(features))
+            yield (x.toarray() if not isinstance(x, np.ndarray) else x), chunk_labels
+
+    def batches():
+        return (x for x, _ in normalised_chunks())
+
+    default_x, default_y = som_grid_size(n_items)
+    som_x, som_y = som_params.get('som_x') or default_x, som_params.get('som_y') or default_y
+    # The SVD has fewer components than requested if it was fitted on fewer rows
+    input_len = svd.components_.shape[0] if svd is not None else len(feature_names)
+    print(f"Streaming SOM training with {som_x}x{som_y} grid on {n_items} samples in {n_batches} batches "
+          f"for {epochs} epochs")
+    som = train_minibatch_som(batches, n_batches, input_len, som_x, som_y, sigma=som_params['sigma'],
+                              learning_rate=som_params['learning_rate'], epochs=epochs, random_seed=random_seed)
+
+    # Map every SNP or disease onto the trained SOM
+    positions, labels = [], []
+    weights = som.get_weights()
+    for x, chunk_labels in normalised_chunks():
+        winners, _ = best_matching_units(weights, x)
+        positions.append(np.column_stack(np.unravel_index(winners, (som_x, som_y))))
+        labels.extend(chunk_labels)
+
+    transforms = {
+        'feature_names': feature_names,
+        'svd_components': svd.components_ if svd is not None else None,
+        'scale': scaler.scale_,
+    }
+    return np.vstack(positions), som, labels, transforms
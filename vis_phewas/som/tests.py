@@ -1,20 +1,45 @@
+import json
 import os
-from datetime import datetime, timedelta
+import shutil
+import stat
+import tempfile
+import urllib.parse
+import threading
+import tracemalloc
+from datetime import timedelta
+from io import BytesIO, StringIO
 from unittest.mock import patch, MagicMock
 
 import numpy as np
 import pandas as pd
-from django.conf import settings
-from django.test import TestCase
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
+from minisom import MiniSom
 from rest_framework.test import APIClient
 from scipy.sparse import csr_matrix
+from sklearn.metrics import davies_bouldin_score, calinski_harabasz_score
 from sklearn.preprocessing import OneHotEncoder, MinMaxScaler
 
 from api.models import TemporaryCSVData
+from mainapp.models import HlaPheWasCatalog
 from som.som_utils import preprocess_temp_data, initialise_som, clean_filters, \
-    prepare_categories_for_context, create_title, cluster_results_to_csv, clean_up_old_files, get_file_timestamp, \
-    compute_mean_som_results, evaluate_som, compute_combined_score
+    prepare_categories_for_context, create_title, cluster_results_to_csv, \
+    compute_mean_som_results, evaluate_som, compute_combined_score, parallel_grid_search_som, \
+    successive_halving_som, som_cache, run_som_evaluation, summarise_som_evaluations, plotly_js_bundle, \
+    create_hover_text, preprocess_som_data, som_cache_key, SOM_PARAMS, find_warm_start_entry, \
+    stratified_sample, BackgroundSOMTrainer, run_consensus_clustering, load_som_data, build_som_input
+from som.artefact_store import LocalArtefactBackend, S3ArtefactBackend, save_artefact, save_dataframe_artefact, \
+    artefact_url, evict_artefacts, _artefact_backend
+from som.admission import AdmissionController, SOMAdmissionError, estimate_som_cost, process_budget
+from som.model_store import save_som_model, load_som_model, align_features, transfer_som_weights
+from som.streaming import som_queryset, feature_vocabulary, iter_feature_chunks, train_streaming_som, \
+    cached_feature_basis, feature_basis, fit_streaming_svd, reservoir_sample_rows
+from som.training import train_som_iterations, cluster_som_neurons, weighted_cluster_scores, resize_som_weights, \
+    warm_start_som, best_matching_units, train_minibatch_som, hierarchical_grid_sizes, hierarchical_som, \
+    train_child_som, co_assignment_matrix, consensus_clusters
+from som.models import Artefact
 from som.views import SOMView
 
 
@@ -23,11 +48,9 @@ class TestSOMFunctions(TestCase):
     Test the functions in the views.py file of the som app.
     """
 
-    @patch('api.models.TemporaryCSVData')
-    def test_preprocess_temp_data(self, MockTemporaryCSVData):
+    def test_preprocess_temp_data(self):
         """
-        Test the preprocess_temp_data function.
-        :param MockTemporaryCSVData: Mock object for the TemporaryCSVData model
+        Test the preprocess_temp_data function with data staged as CSV text.
         :return: None
         """
         # Define a mock CSV content string
@@ -37,10 +60,8 @@ class TestSOMFunctions(TestCase):
         HLA_3,0.10,0,1.5,1.0,2.0,0.05,Phenotype_C,Category_Z,Gene3
         """
 
-        # Mock the TemporaryCSVData object to return the mock CSV content
-        mock_temp_data = MockTemporaryCSVData()
-        mock_temp_data.csv_content = mock_csv_content
-        MockTemporaryCSVData.objects.get.return_value = mock_temp_data
+        # Rows staged before payloads were introduced only have the CSV content
+        mock_temp_data = TemporaryCSVData(csv_content=mock_csv_content)
 
         # Run the function and assert the result
         result_df = preprocess_temp_data(mock_temp_data)
@@ -206,59 +227,128 @@ class TestSOMFunctions(TestCase):
         except ValueError as e:
             self.assertEqual(str(e), "Invalid SOM type. Please provide a valid type ('snp' or 'disease').")
 
-    @patch('som.som_utils.clean_up_old_files')
-    @patch('som.som_utils.pd.DataFrame.to_csv')
-    def test_cluster_results_to_csv(self, mock_to_csv, mock_clean_up):
-        # Create a mock DataFrame
-        mock_df = pd.DataFrame({'col1': [1, 2], 'col2': [3, 4]})
-
-        # Run the function
-        file_name = cluster_results_to_csv(mock_df)
+    def test_cluster_results_to_csv(self):
+        """
+        Test that the cluster results are saved once in the artefact store under a key derived from their content.
+        """
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        df = pd.DataFrame({'col1': [1, 2], 'col2': [3, 4]})
+
+        with override_settings(MEDIA_ROOT=media_root.name, MEDIA_URL='/media/'):
+            url = cluster_results_to_csv(df)
+            # Saving the same results again links to the same file
+            self.assertEqual(cluster_results_to_csv(df), url)
+            self.assertNotEqual(cluster_results_to_csv(df.iloc[:1]), url)
+
+        self.assertRegex(url, r'^/media/artefacts/[0-9a-f]{32}/cluster_results\.csv$')
+        path = os.path.join(media_root.name, url[len('/media/'):])
+        pd.testing.assert_frame_equal(pd.read_csv(path), df)
+        # The file can be read by the web server serving the media directory
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o644)
+        self.assertEqual(Artefact.objects.count(), 2)
+
+    def test_save_dataframe_artefact_formats(self):
+        """
+        Test that DataFrames are saved compressed without a timestamp, so the same results keep the same key.
+        """
+        backend = LocalArtefactBackend(tempfile.mkdtemp(), '/media/')
+        self.addCleanup(shutil.rmtree, backend.root)
+        df = pd.DataFrame({'snp': ['A_01', 'B_01'], 'cluster': [0, 1]})
 
-        # Check that the cleanup function was called
-        mock_clean_up.assert_called_once()
+        key = save_dataframe_artefact(df, 'cluster_results', 'csv.gz', backend=backend)
 
-        # Check that the CSV was saved with the correct filename
-        mock_to_csv.assert_called_once_with(os.path.join(settings.MEDIA_ROOT, file_name), index=False)
-        self.assertTrue(file_name.startswith("cluster_results_") and file_name.endswith(".csv"))
+        self.assertTrue(key.endswith('/cluster_results.csv.gz'))
+        self.assertEqual(save_dataframe_artefact(df, 'cluster_results', 'csv.gz', backend=backend), key)
+        pd.testing.assert_frame_equal(pd.read_csv(BytesIO(backend.read(key)), compression='gzip'), df)
+        self.assertEqual(Artefact.objects.get(key=key).content_type, 'application/gzip')
+        with self.assertRaises(ValueError):
+            save_dataframe_artefact(df, 'cluster_results', 'xlsx', backend=backend)
 
-    @patch('som.som_utils.os.remove')
-    @patch('som.som_utils.glob.glob')
-    @patch('som.som_utils.get_file_timestamp')
-    def test_clean_up_old_files(self, mock_get_file_timestamp, mock_glob, mock_remove):
-        # Mock files and their timestamps
-        mock_glob.return_value = ['file1.csv', 'file2.csv']
+    def test_evict_artefacts(self):
+        """
+        Test that artefacts not accessed recently are evicted, and then the least recently accessed ones beyond the
+        size cap.
+        """
+        backend = LocalArtefactBackend(tempfile.mkdtemp(), '/media/')
+        self.addCleanup(shutil.rmtree, backend.root)
+        keys = [save_artefact(bytes([i]) * 100, f'file_{i}.csv', 'text/csv', backend=backend) for i in range(4)]
+        # The first artefact was last accessed two days ago and the others in order over the last hours
+        for i, key in enumerate(keys):
+            Artefact.objects.filter(key=key).update(
+                last_accessed_at=timezone.now() - (timedelta(days=2) if i == 0 else timedelta(hours=4 - i)))
+        # Saving the second artefact again makes it the most recently accessed
+        save_artefact(bytes([1]) * 100, 'file_1.csv', 'text/csv', backend=backend)
+
+        deleted, deleted_bytes = evict_artefacts(max_age=timedelta(days=1), max_bytes=200, backend=backend)
+
+        self.assertEqual((deleted, deleted_bytes), (2, 200))
+        self.assertEqual(set(Artefact.objects.values_list('key', flat=True)), {keys[1], keys[3]})
+        for key in keys:
+            self.assertEqual(os.path.exists(os.path.join(backend.root, key)), key in (keys[1], keys[3]))
+        # The emptied digest directories are removed, but not the directories above them
+        self.assertEqual(len(os.listdir(os.path.join(backend.root, 'artefacts'))), 2)
+        evict_artefacts(max_bytes=0, backend=backend)
+        self.assertEqual(os.listdir(os.path.join(backend.root, 'artefacts')), [])
+
+    def test_evict_artefacts_keeps_artefacts_saved_again(self):
+        """
+        Test that an artefact saved again after eviction selected it is kept with its file.
+        """
+        backend = LocalArtefactBackend(tempfile.mkdtemp(), '/media/')
+        self.addCleanup(shutil.rmtree, backend.root)
+        contents = {save_artefact(bytes([i]) * 100, f'file_{i}.csv', 'text/csv', backend=backend): bytes([i]) * 100
+                    for i in range(2)}
+        Artefact.objects.update(last_accessed_at=timezone.now() - timedelta(days=2))
+        delete = backend.delete
+
+        def delete_and_save_other(key):
+            # The other artefact is saved again while the first one is being deleted
+            delete(key)
+            for other_key, data in contents.items():
+                if other_key != key and Artefact.objects.filter(key=other_key).exists():
+                    save_artefact(data, other_key.rsplit('/', 1)[1], 'text/csv', backend=backend)
+
+        with patch.object(backend, 'delete', side_effect=delete_and_save_other):
+            self.assertEqual(evict_artefacts(max_age=timedelta(days=1), backend=backend), (1, 100))
+        kept = Artefact.objects.get()
+        self.assertTrue(os.path.exists(os.path.join(backend.root, kept.key)))
+
+    def test_s3_artefact_backend(self):
+        """
+        Test the S3 artefact backend against an in-memory stand-in for an S3-compatible object store.
+        """
 
-        # Define a function to simulate the side effect
-        def side_effect(file_path):
-            if file_path == 'file1.csv':
-                return datetime.now() - timedelta(days=2)  # 2 days old
-            elif file_path == 'file2.csv':
-                return datetime.now() - timedelta(hours=12)  # 12 hours old
+        class LocalS3Client:
+            # Implements the S3 client calls used by the backend on a dictionary
+            def __init__(self):
+                self.objects = {}
 
-        # Set the side effect function
-        mock_get_file_timestamp.side_effect = side_effect
+            def put_object(self, Bucket, Key, Body, ContentType):
+                self.objects[(Bucket, Key)] = (Body, ContentType)
 
-        # Run the function
-        clean_up_old_files()
+            def get_object(self, Bucket, Key):
+                return {'Body': BytesIO(self.objects[(Bucket, Key)][0])}
 
-        # Verify that only the old file is removed
-        mock_remove.assert_called_once_with('file1.csv')
+            def delete_object(self, Bucket, Key):
+                self.objects.pop((Bucket, Key), None)
 
-    def test_get_file_timestamp_valid(self):
-        # Valid file name
-        file_path = "cluster_results_20230830_123456.csv"
-        expected_timestamp = datetime.strptime("20230830_123456", "%Y%m%d_%H%M%S")
+            def generate_presigned_url(self, method, Params, ExpiresIn):
+                return f"https://s3.test/{Params['Bucket']}/{Params['Key']}?expires={ExpiresIn}"
 
-        # Assert the function returns the correct timestamp
-        self.assertEqual(get_file_timestamp(file_path), expected_timestamp)
+        client = LocalS3Client()
+        backend = S3ArtefactBackend('results', prefix='vis-phewas/', client=client)
+        key = save_artefact(b'snp,cluster\nA_01,0\n', 'cluster_results.csv', 'text/csv', backend=backend)
 
-    def test_get_file_timestamp_invalid(self):
-        # Invalid file name
-        file_path = "invalid_file_name.csv"
+        self.assertEqual(client.objects[('results', 'vis-phewas/' + key)], (b'snp,cluster\nA_01,0\n', 'text/csv'))
+        self.assertEqual(backend.read(key), b'snp,cluster\nA_01,0\n')
+        self.assertEqual(artefact_url(key, backend=backend),
+                         f"https://s3.test/results/vis-phewas/{key}?expires=3600")
+        self.assertEqual(S3ArtefactBackend('results', public_url='https://cdn.test/', client=client).url(key),
+                         f"https://cdn.test/{key}")
 
-        # Assert that the function returns a very recent time
-        self.assertGreaterEqual(get_file_timestamp(file_path), datetime.now() - timedelta(seconds=1))
+        self.assertEqual(evict_artefacts(max_bytes=0, backend=backend), (1, 19))
+        self.assertEqual(client.objects, {})
 
     def test_clean_filters_empty(self):
         # Test with empty filter
@@ -288,92 +378,46 @@ class TestSOMFunctions(TestCase):
         self.assertEqual(title_text, expected_title)
 
 
-    @patch('glob.glob')
-    @patch('som.views.pd.read_csv')
-    @patch('som.views.pd.DataFrame.to_csv')
-    def test_compute_mean_som_results_with_files(self, mock_to_csv, mock_read_csv, mock_glob):
+    def test_compute_mean_som_results(self):
         """
-        Test compute_mean_som_results when CSV files are present.
+        Test compute_mean_som_results on evaluation results held in memory, for several SOM types.
         """
-        # Mock the return value of glob to simulate existing files
-        mock_glob.return_value = ['som_evaluation_results_snp_1.csv', 'som_evaluation_results_snp_2.csv']
-
-        # Mock the DataFrame returned by read_csv for each file
-        df1 = pd.DataFrame({'Quantization Error': [0.1, 0.2], 'Topographic Error': [0.3, 0.4]})
-        df2 = pd.DataFrame({'Quantization Error': [0.2, 0.3], 'Topographic Error': [0.4, 0.5]})
-        mock_read_csv.side_effect = [df1, df2]
-
-        # Call the function under test
-        mean_results = compute_mean_som_results(['snp'])
+        results = {
+            'snp': [pd.DataFrame({'Quantization Error': [0.1, 0.2], 'Topographic Error': [0.3, 0.4]}),
+                    pd.DataFrame({'Quantization Error': [0.2, 0.3], 'Topographic Error': [0.4, 0.5]})],
+            'disease': [{'Quantization Error': 0.15, 'Topographic Error': 0.35},
+                        {'Quantization Error': 0.25, 'Topographic Error': 0.45}],
+        }
 
-        # Verify that the correct number of CSV files were read
-        mock_read_csv.assert_any_call('som_evaluation_results_snp_1.csv')
-        mock_read_csv.assert_any_call('som_evaluation_results_snp_2.csv')
+        with patch('pandas.DataFrame.to_csv') as mock_to_csv:
+            mean_results = compute_mean_som_results(results)
 
-        # Verify that the concatenated DataFrame and the mean computation were correct
         expected_mean_df = pd.DataFrame({'Quantization Error': [0.2], 'Topographic Error': [0.4]})
         pd.testing.assert_frame_equal(mean_results['snp'], expected_mean_df)
+        pd.testing.assert_frame_equal(mean_results['disease'], expected_mean_df)
+        # Nothing is written to disk
+        mock_to_csv.assert_not_called()
 
-        # Verify that to_csv was called to save the result
-        mock_to_csv.assert_called_once_with('som_evaluation_results_snp_mean.csv', index=False)
-
-
-    @patch('glob.glob')
-    @patch('som.views.pd.read_csv')
-    def test_compute_mean_som_results_no_files(self, mock_read_csv, mock_glob):
+    def test_compute_mean_som_results_no_results(self):
         """
-        Test compute_mean_som_results when no CSV files are present.
+        Test compute_mean_som_results when a SOM type has no evaluation results.
         """
-        # Mock the return value of glob to simulate no files found
-        mock_glob.return_value = []
-
-        # Call the function under test
-        mean_results = compute_mean_som_results(['snp'])
+        self.assertEqual(compute_mean_som_results({'snp': []}), {})
 
-        # Verify that no CSV files were read
-        mock_read_csv.assert_not_called()
-
-        # Verify that mean_results is empty
-        self.assertEqual(mean_results, {})
-
-
-    @patch('glob.glob')
-    @patch('som.views.pd.read_csv')
-    @patch('som.views.pd.DataFrame.to_csv')
-    def test_compute_mean_som_results_multiple_som_types(self, mock_to_csv, mock_read_csv, mock_glob):
+    def test_evaluate_som_returns_metrics(self):
         """
-        Test compute_mean_som_results for multiple SOM types.
+        Test that evaluate_som returns the metrics of the SOM without writing them to a file.
         """
-        # Mock the return value of glob to simulate files for both types
-        mock_glob.side_effect = [
-            ['som_evaluation_results_snp_1.csv', 'som_evaluation_results_snp_2.csv'],
-            ['som_evaluation_results_disease_1.csv']
-        ]
+        x_normalised = np.random.default_rng(0).random((12, 3))
+        positions, som = initialise_som(x_normalised, som_x=3, som_y=3, num_iterations=50)
+        positions_df = pd.DataFrame(positions, columns=['x', 'y'])
+        positions_df['cluster'] = np.arange(12) % 2
 
-        # Mock the DataFrame returned by read_csv for each file
-        df_snp1 = pd.DataFrame({'Quantization Error': [0.1, 0.2], 'Topographic Error': [0.3, 0.4]})
-        df_snp2 = pd.DataFrame({'Quantization Error': [0.2, 0.3], 'Topographic Error': [0.4, 0.5]})
-        df_disease = pd.DataFrame({'Quantization Error': [0.15, 0.25], 'Topographic Error': [0.35, 0.45]})
-        mock_read_csv.side_effect = [df_snp1, df_snp2, df_disease]
+        with patch('pandas.DataFrame.to_csv') as mock_to_csv:
+            metrics = evaluate_som(positions, positions_df, som, x_normalised)
 
-        # Call the function under test
-        mean_results = compute_mean_som_results(['snp', 'disease'])
-
-        # Verify that the correct number of CSV files were read
-        mock_read_csv.assert_any_call('som_evaluation_results_snp_1.csv')
-        mock_read_csv.assert_any_call('som_evaluation_results_snp_2.csv')
-        mock_read_csv.assert_any_call('som_evaluation_results_disease_1.csv')
-
-        # Verify that the concatenated DataFrame and the mean computation were correct
-        expected_mean_snp_df = pd.DataFrame({'Quantization Error': [0.2], 'Topographic Error': [0.4]})
-        expected_mean_disease_df = pd.DataFrame({'Quantization Error': [0.2], 'Topographic Error': [0.4]})
-
-        pd.testing.assert_frame_equal(mean_results['snp'], expected_mean_snp_df)
-        pd.testing.assert_frame_equal(mean_results['disease'], expected_mean_disease_df)
-
-        # Verify that to_csv was called to save the results
-        mock_to_csv.assert_any_call('som_evaluation_results_snp_mean.csv', index=False)
-        mock_to_csv.assert_any_call('som_evaluation_results_disease_mean.csv', index=False)
+        mock_to_csv.assert_not_called()
+        self.assertGreaterEqual(metrics['Quantization Error'], 0)
 
     def test_compute_combined_score(self):
         # Test with normal input values
@@ -390,6 +434,452 @@ class TestSOMFunctions(TestCase):
         # Check if the result matches the expected output
         np.testing.assert_array_almost_equal(result, expected)
 
+    @patch('som.som_utils.evaluate_som_configuration')
+    @patch('som.som_utils.grid_search_configurations')
+    def test_parallel_grid_search_som_resumes(self, mock_configurations, mock_evaluate):
+        """
+        Test that parallel_grid_search_som skips configurations already saved and adds the combined score.
+        """
+        configurations = [
+            {'som_x': 2, 'som_y': 2, 'multiplier': 5, 'sigma': sigma, 'learning_rate': 0.5, 'num_iterations': 10}
+            for sigma in [0.5, 1.0, 1.5]
+        ]
+        mock_configurations.return_value = configurations
+        mock_evaluate.side_effect = lambda x, config, blas_threads: {**config, 'quantisation_error': config['sigma'],
+                                                                     'topographic_error': 0.1}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_csv = os.path.join(tmp_dir, 'results.csv')
+            # Simulate a previous run that was interrupted after the first configuration
+            pd.DataFrame([{**configurations[0], 'quantisation_error': 0.5, 'topographic_error': 0.1}]).to_csv(
+                output_csv, index=False)
+
+            results_df = parallel_grid_search_som(np.zeros((4, 2)), output_csv=output_csv, n_jobs=1)
+
+            # Only the two remaining configurations should have been trained
+            self.assertEqual(mock_evaluate.call_count, 2)
+            self.assertEqual(len(results_df), 3)
+            self.assertIn('combined_score', pd.read_csv(output_csv).columns)
+
+            # A rerun with every configuration complete should not train anything
+            mock_evaluate.reset_mock()
+            parallel_grid_search_som(np.zeros((4, 2)), output_csv=output_csv, n_jobs=1)
+            mock_evaluate.assert_not_called()
+
+
+    def test_train_som_iterations_matches_single_schedule(self):
+        """
+        Test that training a SOM in two parts of a schedule gives the same weights as training it in one call.
+        """
+        x_normalised = np.random.RandomState(0).rand(20, 3)
+        som_once = MiniSom(3, 3, 3, random_seed=1)
+        som_split = MiniSom(3, 3, 3, random_seed=1)
+
+        train_som_iterations(som_once, x_normalised, 0, 100, 100, random_state=np.random.RandomState(2))
+        random_state = np.random.RandomState(2)
+        train_som_iterations(som_split, x_normalised, 0, 40, 100, random_state=random_state)
+        train_som_iterations(som_split, x_normalised, 40, 100, 100, random_state=random_state)
+
+        np.testing.assert_array_almost_equal(som_once.get_weights(), som_split.get_weights())
+
+    @patch('som.som_utils.grid_search_configurations')
+    def test_successive_halving_som(self, mock_configurations):
+        """
+        Test that successive halving keeps halving the candidates until the full budget and keeps the CSV schema.
+        """
+        mock_configurations.return_value = [
+            {'som_x': 2, 'som_y': 2, 'multiplier': 5, 'sigma': sigma, 'learning_rate': learning_rate,
+             'num_iterations': num_iterations}
+            for sigma in [0.5, 1.0] for learning_rate in [0.1, 0.5] for num_iterations in [5000, 10000]
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_csv = os.path.join(tmp_dir, 'results.csv')
+            results_df = successive_halving_som(np.random.RandomState(0).rand(10, 3), output_csv=output_csv,
+                                                min_iterations=10, max_iterations=40, n_jobs=1)
+            saved_df = pd.read_csv(output_csv)
+
+        # 4 candidates at 10 iterations, 2 at 20 and 1 at 40
+        self.assertEqual(results_df.groupby('num_iterations').size().to_dict(), {10: 4, 20: 2, 40: 1})
+        self.assertEqual(list(saved_df.columns), ['som_x', 'som_y', 'multiplier', 'sigma', 'learning_rate',
+                                                  'num_iterations', 'quantisation_error', 'topographic_error',
+                                                  'combined_score'])
+
+
+    def test_cluster_som_neurons(self):
+        """
+        Test that samples mapped to the same neuron are always given the same cluster.
+        """
+        positions = np.array([[0, 0], [0, 0], [0, 1], [5, 5], [5, 5], [5, 4]])
+        labels = cluster_som_neurons(MagicMock(), positions, 2)
+
+        self.assertEqual(len(labels), len(positions))
+        self.assertEqual(labels[0], labels[1])
+        self.assertEqual(labels[0], labels[2])
+        self.assertEqual(labels[3], labels[4])
+        self.assertNotEqual(labels[0], labels[3])
+
+    def test_weighted_cluster_scores_match_unweighted(self):
+        """
+        Test that the weighted indices match the sklearn indices computed on the repeated points.
+        """
+        features = np.array([[0.0, 0.0], [0.0, 1.0], [4.0, 4.0], [5.0, 4.0], [9.0, 0.0]])
+        labels = np.array([0, 0, 1, 1, 2])
+        counts = np.array([3, 1, 2, 4, 1])
+
+        dbi, ch = weighted_cluster_scores(features, labels, counts)
+
+        repeated_features = np.repeat(features, counts, axis=0)
+        repeated_labels = np.repeat(labels, counts)
+        self.assertAlmostEqual(dbi, davies_bouldin_score(repeated_features, repeated_labels))
+        self.assertAlmostEqual(ch, calinski_harabasz_score(repeated_features, repeated_labels))
+
+
+    def test_run_som_evaluation_is_reproducible(self):
+        """
+        Test that each seed is evaluated once and that the same seed gives the same metrics.
+        """
+        x_normalised = np.random.RandomState(0).rand(30, 3)
+        som_params = {'sigma': 1.0, 'learning_rate': 0.5, 'num_iterations': 50}
+
+        runs_df = run_som_evaluation(x_normalised, som_params, 2, seeds=[1, 0, 1], n_jobs=1)
+
+        self.assertEqual(list(runs_df['Seed']), [0, 1, 1])
+        self.assertIn('Silhouette Score', runs_df.columns)
+        pd.testing.assert_series_equal(runs_df.iloc[1].drop('Seed'), runs_df.iloc[2].drop('Seed'), check_names=False)
+
+    def test_summarise_som_evaluations(self):
+        """
+        Test the mean, standard deviation and confidence interval of the summarised metrics.
+        """
+        runs_df = pd.DataFrame({'Seed': [0, 1, 2], 'Quantization Error': [1.0, 2.0, 3.0]})
+
+        summary_df = summarise_som_evaluations(runs_df)
+
+        row = summary_df.iloc[0]
+        self.assertEqual(row['Metric'], 'Quantization Error')
+        self.assertEqual(row['Runs'], 3)
+        self.assertAlmostEqual(row['Mean'], 2.0)
+        self.assertAlmostEqual(row['Std'], 1.0)
+        # t(0.975, 2) = 4.303, so the interval is 2 +/- 4.303 / sqrt(3)
+        self.assertAlmostEqual(row['CI Lower'], 2.0 - 2.4842, places=3)
+        self.assertAlmostEqual(row['CI Upper'], 2.0 + 2.4842, places=3)
+
+    def test_create_hover_text_shows_most_significant(self):
+        """
+        Test that the hover text shows the most significant associations of each point and counts the others.
+        """
+        cluster_data = pd.DataFrame({
+            'phewas_string': ['Disease_A', 'Disease_B'],
+            'snps': [['A_01', 'B_01', 'C_01'], ['D_01']],
+            'odds_ratios': [[1.0, 2.0, 3.0], [1.5]],
+            'p_values': [[0.03, 0.01, 0.02], [0.04]],
+        }, index=[5, 9])
+
+        hover_texts = create_hover_text(cluster_data, 'disease', top_k=2)
+
+        self.assertEqual(hover_texts, [
+            'Disease: Disease_A<br>SNP: B_01, Odds Ratio: 2.00, P-Value: 0.0100<br>'
+            'SNP: C_01, Odds Ratio: 3.00, P-Value: 0.0200<br>+1 more (click for details)',
+            'Disease: Disease_B<br>SNP: D_01, Odds Ratio: 1.50, P-Value: 0.0400',
+        ])
+        self.assertEqual(create_hover_text(cluster_data.iloc[:0], 'disease'), [])
+
+    def test_save_and_load_som_model(self):
+        """
+        Test that a saved SOM is loaded back with memory-mapped arrays.
+        """
+        som = MiniSom(3, 3, 2, random_seed=0)
+        transforms = {'feature_names': ['a', 'b'], 'svd_components': None, 'scale': np.array([1.0, 2.0])}
+        with tempfile.TemporaryDirectory() as model_root, override_settings(SOM_MODEL_ROOT=model_root):
+            save_som_model('a' * 64, som, [[0, 0], [1, 2]], transforms, 'snp', {'sigma': 1.0}, ['A_01', 'B_01'])
+            model = load_som_model('a' * 64)
+
+            self.assertIsInstance(model['weights'], np.memmap)
+            np.testing.assert_array_equal(model['weights'], som.get_weights())
+            self.assertIsNone(model['svd_components'])
+            self.assertEqual(model['labels'], ['A_01', 'B_01'])
+            # Unknown and invalid versions are not loaded
+            self.assertIsNone(load_som_model('b' * 64))
+            self.assertIsNone(load_som_model('../' + 'a' * 64))
+
+    def test_align_features(self):
+        """
+        Test that features are mapped onto the columns of a saved SOM, with unseen indicators marked as absent.
+        """
+        aligned = align_features(csr_matrix([[2.0, 1.0, 5.0]]), ['odds_ratio:A', 'gene:G1=1', 'category:new'],
+                                 ['gene:G1=0', 'gene:G1=1', 'gene:G2=0', 'gene:G2=1', 'odds_ratio:A'])
+
+        np.testing.assert_array_equal(aligned.toarray(), [[0, 1, 1, 0, 2]])
+
+    def test_warm_start_som(self):
+        """
+        Test that a SOM warm-started from trained weights only needs a short refinement to fit the data.
+        """
+        rng = np.random.RandomState(0)
+        x_normalised = np.vstack([rng.normal(centre, 0.1, size=(20, 2)) for centre in [(0, 0), (3, 3), (0, 3)]])
+        _, trained = initialise_som(x_normalised, som_x=4, som_y=4, num_iterations=2000, random_seed=0)
+
+        # Resizing keeps the corner neurons and interpolates the others
+        resized = resize_som_weights(trained.get_weights(), 6, 6)
+        self.assertEqual(resized.shape, (6, 6, 2))
+        np.testing.assert_allclose(resized[0, 0], trained.get_weights()[0, 0])
+
+        positions, som = warm_start_som(x_normalised, trained.get_weights(), som_x=4, som_y=4, num_iterations=2000,
+                                        refine_fraction=0.05, random_seed=0)
+        _, cold = initialise_som(x_normalised, som_x=4, som_y=4, num_iterations=100, random_seed=0)
+        self.assertEqual(len(positions), len(x_normalised))
+        self.assertLess(som.quantization_error(x_normalised), cold.quantization_error(x_normalised))
+
+    def test_transfer_som_weights(self):
+        """
+        Test that SOM weights are mapped between inputs through their shared features.
+        """
+        weights = np.arange(8, dtype=float).reshape(2, 2, 2)
+        source = {'feature_names': ['a', 'b'], 'svd_components': None, 'scale': np.array([1.0, 2.0])}
+        target = {'feature_names': ['b', 'c'], 'svd_components': None, 'scale': np.array([4.0, 1.0])}
+
+        transferred = transfer_som_weights(weights, source, target)
+
+        # Feature b is unscaled by 2 and rescaled by 4, and the new feature c starts at zero
+        np.testing.assert_allclose(transferred[..., 0], weights[..., 1] / 2)
+        np.testing.assert_allclose(transferred[..., 1], 0)
+        np.testing.assert_allclose(transfer_som_weights(weights, source, source), weights)
+
+    def test_find_warm_start_entry(self):
+        """
+        Test that the cached SOM of the same type with the most similar input set is used to warm-start a SOM.
+        """
+        som_cache.clear()
+        self.addCleanup(som_cache.clear)
+        transforms = {'feature_names': []}
+        som_cache.set('close', {'som_type': 'snp', 'labels': frozenset('ABCD'), 'transforms': transforms})
+        som_cache.set('far', {'som_type': 'snp', 'labels': frozenset('AXYZ'), 'transforms': transforms})
+        som_cache.set('other', {'som_type': 'disease', 'labels': frozenset('ABCDE'), 'transforms': transforms})
+
+        self.assertEqual(find_warm_start_entry('snp', 'ABCDE')['labels'], frozenset('ABCD'))
+        self.assertIsNone(find_warm_start_entry('snp', 'EFGH'))
+
+    def test_stratified_sample(self):
+        """
+        Test that the preview sample keeps every stratum and every association of the sampled SNPs.
+        """
+        filtered_df = pd.DataFrame({
+            'snp': [f'{gene}_{i:02d}' for gene, n in [('A', 80), ('B', 19), ('C', 1)] for i in range(n)] * 2,
+            'gene_name': [gene for gene, n in [('A', 80), ('B', 19), ('C', 1)] for _ in range(n)] * 2,
+        })
+
+        sample_df = stratified_sample(filtered_df, 'snp', max_items=10)
+
+        self.assertEqual(sample_df.groupby('gene_name')['snp'].nunique().to_dict(), {'A': 8, 'B': 2, 'C': 1})
+        self.assertTrue((sample_df['snp'].value_counts() == 2).all())
+        # Small inputs are not sampled
+        self.assertIs(stratified_sample(filtered_df, 'snp', max_items=100), filtered_df)
+
+    def test_background_som_trainer(self):
+        """
+        Test that a SOM is trained in the background once and that its status is reported.
+        """
+        som_cache.clear()
+        self.addCleanup(som_cache.clear)
+        trainer = BackgroundSOMTrainer(max_workers=1)
+        calls = []
+
+        def train(key):
+            calls.append(key)
+            som_cache.set(key, {'som': None})
+
+        trainer.submit('key', train, 'key').result()
+        self.assertEqual(trainer.status('key'), 'ready')
+        self.assertEqual(trainer.status('other'), 'unknown')
+
+        def fail():
+            raise ValueError('Training failed')
+
+        job = trainer.submit('failing', fail)
+        self.assertRaises(ValueError, job.result)
+        self.assertEqual(trainer.status('failing'), 'failed')
+        self.assertEqual(calls, ['key'])
+
+    def test_train_minibatch_som(self):
+        """
+        Test that a mini-batch SOM is reproducible and that its best matching units are the nearest neurons.
+        """
+        rng = np.random.default_rng(0)
+        data = rng.random((60, 4))
+
+        def batches():
+            return (data[i:i + 20] for i in range(0, len(data), 20))
+
+        som = train_minibatch_som(batches, 3, 4, 3, 3, epochs=3, random_seed=1)
+        weights = som.get_weights()
+        self.assertEqual(weights.shape, (3, 3, 4))
+        np.testing.assert_allclose(
+            weights, train_minibatch_som(batches, 3, 4, 3, 3, epochs=3, random_seed=1).get_weights())
+
+        winners, distances = best_matching_units(weights, data)
+        brute_force = np.linalg.norm(data[:, None, :] - weights.reshape(-1, 4)[None, :, :], axis=-1)
+        np.testing.assert_array_equal(winners, brute_force.argmin(axis=1))
+        np.testing.assert_allclose(distances, brute_force.min(axis=1))
+
+    def test_hierarchical_som(self):
+        """
+        Test that a hierarchical SOM is trained coarse to fine up to the requested grid.
+        """
+        self.assertEqual(hierarchical_grid_sizes(26, 26), [(7, 7), (13, 13), (26, 26)])
+        self.assertEqual(hierarchical_grid_sizes(5, 9, min_size=4), [(2, 3), (3, 5), (5, 9)])
+        self.assertEqual(hierarchical_grid_sizes(6, 6), [(6, 6)])
+
+        x_normalised = np.random.default_rng(0).random((40, 3))
+        positions, som = hierarchical_som(x_normalised, 6, 6, num_iterations=100, min_size=3, random_seed=0)
+        self.assertEqual(som.get_weights().shape, (6, 6, 3))
+        self.assertEqual([tuple(p) for p in positions], [som.winner(x) for x in x_normalised])
+
+    def test_train_child_som(self):
+        """
+        Test that a child SOM is trained on the samples of a single neuron only.
+        """
+        x_normalised = np.random.default_rng(0).random((10, 3))
+        positions = np.array([[0, 0]] * 6 + [[1, 1]] * 4)
+
+        indices, child_positions, child_som = train_child_som(x_normalised, positions, (0, 0), num_iterations=20,
+                                                              random_seed=0)
+        np.testing.assert_array_equal(indices, np.arange(6))
+        self.assertEqual(len(child_positions), 6)
+        self.assertTrue((child_positions < child_som.get_weights().shape[:2]).all())
+        self.assertRaises(ValueError, train_child_som, x_normalised, positions, (2, 2))
+
+    def test_co_assignment_matrix(self):
+        """
+        Test that the sparse consensus matrix matches the co-assignment fractions computed densely.
+        """
+        rng = np.random.default_rng(0)
+        runs = [(np.sort(rng.choice(12, size=9, replace=False)), rng.integers(3, size=9)) for _ in range(5)]
+
+        co_assigned, co_sampled = np.zeros((12, 12)), np.zeros((12, 12))
+        for indices, labels in runs:
+            sampled = np.zeros(12, dtype=bool)
+            sampled[indices] = True
+            co_sampled += np.outer(sampled, sampled)
+            assigned = np.full(12, -1)
+            assigned[indices] = labels
+            co_assigned += (assigned[:, None] == assigned[None, :]) & sampled[:, None] & sampled[None, :]
+        expected = np.divide(co_assigned, co_sampled, out=np.zeros((12, 12)), where=co_sampled > 0)
+
+        consensus = co_assignment_matrix(runs, 12)
+        np.testing.assert_allclose(consensus.toarray(), expected)
+        # Pairs never clustered together are not stored
+        self.assertEqual(consensus.nnz, np.count_nonzero(co_assigned))
+
+    def test_consensus_clusters(self):
+        """
+        Test that consensus clusters split samples that are never clustered together and score their stability.
+        """
+        runs = [(np.arange(6), np.array([0, 0, 0, 1, 1, 1]))] * 3 + [(np.arange(6), np.array([0, 0, 1, 1, 1, 1]))]
+        labels, stability = consensus_clusters(co_assignment_matrix(runs, 6), 2)
+
+        self.assertEqual(len(set(labels[:3])), 1)
+        self.assertEqual(len(set(labels[3:])), 1)
+        self.assertNotEqual(labels[0], labels[3])
+        # The third sample left its group in one of the four runs
+        np.testing.assert_allclose(stability, [0.875, 0.875, 0.75, 1, 1, 1])
+
+    def test_run_consensus_clustering(self):
+        """
+        Test that consensus clustering over SOMs trained in worker processes recovers well separated groups.
+        """
+        rng = np.random.default_rng(0)
+        x_normalised = np.vstack([rng.normal(0, 0.1, (15, 2)), rng.normal(5, 0.1, (15, 2))])
+        som_params = {'sigma': 1.0, 'learning_rate': 0.5, 'num_iterations': 200}
+
+        labels, stability = run_consensus_clustering(x_normalised, som_params, 2, n_runs=4, n_jobs=2)
+        self.assertEqual(len(set(labels[:15])), 1)
+        self.assertNotEqual(labels[0], labels[15])
+        self.assertTrue(((stability >= 0) & (stability <= 1)).all())
+
+    def test_estimate_som_cost(self):
+        """
+        Test that the estimated cost of training a SOM grows with its input and grid.
+        """
+        small = estimate_som_cost(100, 1000, 50, 5, 5, 1000)
+        self.assertGreater(estimate_som_cost(10000, 1000, 50, 5, 5, 1000)['memory_bytes'], small['memory_bytes'])
+        self.assertGreater(estimate_som_cost(100, 1000, 50, 20, 20, 1000)['cpu_seconds'], small['cpu_seconds'])
+        self.assertGreater(estimate_som_cost(100, 1000, 50, 5, 5, 10000)['cpu_seconds'], small['cpu_seconds'])
+
+    def test_admission_controller(self):
+        """
+        Test that SOM trainings beyond the concurrency or memory budget wait and are then rejected with a retry hint.
+        """
+        controller = AdmissionController(max_concurrent=1, memory_budget_bytes=100)
+        estimate = {'memory_bytes': 40, 'cpu_seconds': 30}
+
+        with controller.admit(estimate):
+            # A second training has no free slot
+            with self.assertRaises(SOMAdmissionError) as cm:
+                with controller.admit(estimate, wait=0.01):
+                    pass
+            self.assertEqual(cm.exception.status_code, 429)
+            self.assertGreater(cm.exception.wait, 1)
+
+        # Trainings that could never fit in the budget are rejected straight away
+        with self.assertRaises(SOMAdmissionError) as cm:
+            with controller.admit({'memory_bytes': 200, 'cpu_seconds': 1}, wait=None):
+                pass
+        self.assertEqual(cm.exception.status_code, 503)
+
+        # A waiting training is admitted as soon as the running one finishes
+        controller = AdmissionController(max_concurrent=2, memory_budget_bytes=100)
+        admitted = []
+
+        def train():
+            with controller.admit(estimate, wait=None):
+                admitted.append(True)
+
+        with controller.admit({'memory_bytes': 70, 'cpu_seconds': 1}):
+            waiting = threading.Thread(target=train)
+            waiting.start()
+            waiting.join(0.05)
+            self.assertEqual(admitted, [])
+        waiting.join(1)
+        self.assertEqual(admitted, [True])
+
+    def test_process_budget(self):
+        """
+        Test that the server-wide training budgets are shared equally between the web worker processes.
+        """
+        with self.settings(WEB_WORKERS=4, SOM_MAX_CONCURRENT_TRAININGS=8, SOM_MEMORY_BUDGET_MB=1024):
+            self.assertEqual(process_budget(), (2, 256 * 1024 ** 2))
+        with self.settings(WEB_WORKERS=4, SOM_MAX_CONCURRENT_TRAININGS=2, SOM_MEMORY_BUDGET_MB=1024):
+            self.assertEqual(process_budget(), (1, 256 * 1024 ** 2))
+        with self.settings(WEB_WORKERS=1, SOM_MAX_CONCURRENT_TRAININGS=2, SOM_MEMORY_BUDGET_MB=1024):
+            self.assertEqual(process_budget(), (2, 1024 ** 3))
+
+    def test_admission_controller_memory_profiling(self):
+        """
+        Test that the peak traced memory is only recorded for trainings that ran alone, and tracing stops with the last
+        profiled training.
+        """
+        controller = AdmissionController(max_concurrent=2, memory_budget_bytes=100)
+        estimate = {'memory_bytes': 40, 'cpu_seconds': 1}
+        with self.settings(SOM_PROFILE_MEMORY=True), self.assertLogs('som.admission', level='INFO') as logs:
+            with controller.admit(estimate, description='alone'):
+                self.assertTrue(tracemalloc.is_tracing())
+                allocated = bytearray(1024 ** 2)
+            del allocated
+            self.assertFalse(tracemalloc.is_tracing())
+
+            with controller.admit(estimate, description='first'):
+                with controller.admit(estimate, description='second'):
+                    pass
+                self.assertTrue(tracemalloc.is_tracing())
+            self.assertFalse(tracemalloc.is_tracing())
+
+        peaks = {record.args[0]: record.usage['peak_traced_bytes'] for record in logs.records}
+        self.assertGreaterEqual(peaks['alone'], 1024 ** 2)
+        self.assertEqual(peaks['first'], None)
+        self.assertEqual(peaks['second'], None)
+
+
 class SOMViewTestCase(TestCase):
     """
     Test cases for the SOMView class.
@@ -398,6 +888,21 @@ class SOMViewTestCase(TestCase):
     def setUp(self):
         # Set up the test client
         self.client = APIClient()
+        # Start every test without any trained SOMs cached, and save trained SOMs in a temporary directory
+        som_cache.clear()
+        model_root = tempfile.TemporaryDirectory()
+        self.addCleanup(model_root.cleanup)
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(SOM_MODEL_ROOT=model_root.name, MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Save the cluster results in the temporary media directory rather than with a backend cached before
+        _artefact_backend.cache_clear()
+        self.addCleanup(_artefact_backend.cache_clear)
+        # Fit the catalog SVD bases again for the catalog of each test
+        cached_feature_basis.cache_clear()
+        self.addCleanup(cached_feature_basis.cache_clear)
 
         # Create a TemporaryCSVData object for testing
         self.temp_data = TemporaryCSVData.objects.create(
@@ -420,17 +925,19 @@ class SOMViewTestCase(TestCase):
         response = self.client.get(reverse('SOM'), {'data_id': self.temp_data.id, 'type': 'snp'})
 
         # Check that the view calls process_and_visualise_som with correct parameters
-        mock_process_and_visualise_som.assert_called_with(str(self.temp_data.id), 4, None, 'snp', testing=False)
+        mock_process_and_visualise_som.assert_called_with(str(self.temp_data.id), 4, None, 'snp', warm_start=False,
+                                                          consensus=False)
 
         # Check that the response has a 200 status code
         self.assertEqual(response.status_code, 200)
 
+    @patch('som.views.save_som_model')
     @patch('som.views.cluster_results_to_csv')
     @patch('som.views.initialise_som')
     @patch('som.views.preprocess_temp_data')
     @patch('som.views.SOMView.perform_dimensionality_reduction')
     def test_process_and_visualise_som(self, mock_dimensionality_reduction, mock_preprocess, mock_initialise_som,
-                                       mock_cluster_results_to_csv):
+                                       mock_cluster_results_to_csv, mock_save_som_model):
         """
         Test the process_and_visualise_som method.
         """
@@ -454,20 +961,480 @@ class SOMViewTestCase(TestCase):
         mock_initialise_som.return_value = (np.array([[0, 1], [1, 0], [1, 1], [0, 0]]), mock_som_instance)
 
         # Mock the return value for cluster_results_to_csv
-        mock_cluster_results_to_csv.return_value = 'test_file.csv'
+        mock_cluster_results_to_csv.return_value = '/media/test_file.csv'
 
         # Mock the return value for perform_dimensionality_reduction
-        mock_dimensionality_reduction.return_value = np.array([[0, 1], [1, 0], [1, 1], [0, 0]])
+        mock_dimensionality_reduction.return_value = (np.array([[0, 1], [1, 0], [1, 1], [0, 0]]), None)
 
         # Create an instance of SOMView
         som_view = SOMView()
 
         # Call process_and_visualise_som method
-        context = som_view.process_and_visualise_som(self.temp_data.id, 4, None, 'snp', testing=False)
+        context = som_view.process_and_visualise_som(self.temp_data.id, 4, None, 'snp')
 
         # Check that the cluster results CSV file is set correctly
         self.assertIn('csv_path', context)
         self.assertEqual(context['csv_path'], '/media/test_file.csv')
+        # Check that only the figure specification is returned, without the plotly.js library
+        self.assertIn('figure_json', context)
+        self.assertNotIn('<script', context['figure_json'])
+        # Check that the figure points at the details of the cached SOM
+        point_url = json.loads(context['figure_json'])['layout']['meta']['point_url']
+        self.assertTrue(point_url.startswith(reverse('SOM_point')))
+        # Check that the trained SOM is saved under the version returned in the context
+        self.assertEqual(mock_save_som_model.call_args[0][0], context['model_version'])
+
+    @patch('som.views.SOMView.process_and_visualise_som')
+    def test_get_async_renders_without_training(self, mock_process_and_visualise_som):
+        """
+        Test that the asynchronous SOM page is rendered without training the SOM and points to the figure endpoint.
+        """
+        response = self.client.get(reverse('SOM'), {'data_id': self.temp_data.id, 'type': 'snp', 'async': 'true'})
+
+        self.assertEqual(response.status_code, 200)
+        mock_process_and_visualise_som.assert_not_called()
+        self.assertTrue(response.context['figure_url'].startswith(reverse('SOM_figure')))
+        self.assertNotIn('async', response.context['figure_url'])
+        self.assertContains(response, response.context['plotly_js_url'])
+
+    @patch('som.views.SOMView.process_and_visualise_som')
+    def test_som_figure_view(self, mock_process_and_visualise_som):
+        """
+        Test that the figure view returns the figure specification and the cluster results path as JSON.
+        """
+        mock_process_and_visualise_som.return_value = {'figure_json': '{"data": [], "layout": {}}',
+                                                       'csv_path': '/media/test_file.csv', 'warm_started': True}
+
+        response = self.client.get(reverse('SOM_figure'), {'data_id': self.temp_data.id, 'type': 'snp'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'figure': {'data': [], 'layout': {}}, 'csv_path': '/media/test_file.csv',
+                                           'warm_started': True, 'preview': False, 'status_url': None})
+
+    @patch('som.views.som_admission', AdmissionController(max_concurrent=0, memory_budget_bytes=1024 ** 3))
+    @override_settings(SOM_ADMISSION_WAIT=0)
+    @patch('som.views.preprocess_temp_data')
+    def test_som_figure_view_at_capacity(self, mock_preprocess):
+        """
+        Test that a SOM the server has no capacity to train is rejected with a Retry-After hint.
+        """
+        mock_preprocess.return_value = pd.DataFrame({'snp': ['A_01'], 'phewas_string': ['Phenotype_A']})
+
+        response = self.client.get(reverse('SOM_figure'), {'data_id': self.temp_data.id, 'type': 'snp'})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertIn('Too many SOMs', response.json()['detail'])
+
+    def test_plotly_js(self):
+        """
+        Test that plotly.js is served with a long-lived cache header and that stale URLs are redirected.
+        """
+        digest = plotly_js_bundle()[1]
+
+        response = self.client.get(reverse('plotly_js', args=[digest]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get(reverse('plotly_js', args=['stale']))
+        self.assertRedirects(response, reverse('plotly_js', args=[digest]), fetch_redirect_response=False)
+
+    @patch('som.views.save_som_model')
+    @patch('som.views.initialise_som')
+    @patch('som.views.SOMView.prepare_som_input')
+    def test_train_som_uses_cache(self, mock_prepare_som_input, mock_initialise_som, mock_save_som_model):
+        """
+        Test that a SOM trained on the same data is reused rather than retrained.
+        """
+        filtered_df = pd.DataFrame({'snp': ['A_01', 'B_01'], 'phewas_string': ['A', 'B'], 'p': [0.01, 0.02]})
+        mock_prepare_som_input.return_value = (np.zeros((2, 2)), filtered_df, {})
+        mock_initialise_som.return_value = (np.array([[0, 0], [1, 1]]), MagicMock())
+
+        som_view = SOMView()
+        first = som_view.train_som(filtered_df, 'snp')
+        second = som_view.train_som(filtered_df.copy(), 'snp')
+
+        mock_initialise_som.assert_called_once()
+        self.assertIs(first[1], second[1])
+
+        # A different SOM type is trained separately
+        som_view.train_som(filtered_df, 'disease')
+        self.assertEqual(mock_initialise_som.call_count, 2)
+
+        # Training the same data again once it has left the cache saves the new SOM under a version of its own
+        som_cache.clear()
+        som_view.train_som(filtered_df, 'snp')
+        versions = [call[0][0] for call in mock_save_som_model.call_args_list]
+        self.assertEqual(len(versions), 3)
+        self.assertEqual(len(set(versions)), 3)
+        self.assertEqual(som_cache.get(som_cache_key('snp', filtered_df, SOM_PARAMS['snp']))['model_version'],
+                         versions[-1])
+
+    @patch('som.views.SOMView.train_som')
+    def test_cluster_metrics_view(self, mock_train_som):
+        """
+        Test that the cluster metrics view returns the metrics for each number of clusters and a suggestion.
+        """
+        positions = np.array([[x, y] for x in range(4) for y in range(4)] * 2)
+        mock_train_som.return_value = (positions, MagicMock(), pd.DataFrame(), np.zeros((32, 2)))
+
+        response = self.client.get(reverse('cluster_metrics'), {'data_id': self.temp_data.id, 'type': 'snp'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['k'] for m in response.data['metrics']], list(range(2, 11)))
+        self.assertIn(response.data['suggested_k'], range(2, 11))
+        self.assertEqual(set(response.data['metrics'][0]),
+                         {'k', 'wcss', 'silhouette', 'davies_bouldin', 'calinski_harabasz'})
+
+    @patch('som.views.som_trainer')
+    @patch('som.views.preprocess_temp_data')
+    def test_process_and_visualise_som_progressive(self, mock_preprocess, mock_som_trainer):
+        """
+        Test that a preview is returned and the full SOM trained in the background when the SOM is not cached.
+        """
+        mock_preprocess.return_value = pd.DataFrame([{
+            'snp': f'{gene}_0{allele}', 'phewas_string': f'Phenotype_{phenotype}', 'p': 0.01,
+            'odds_ratio': 1 + allele + phenotype, 'category_string': f'Category_{phenotype % 2}', 'l95': 0.5,
+            'u95': 3.0, 'maf': 0.1, 'cases': 100, 'controls': 1000, 'gene_name': gene,
+        } for gene in 'AB' for allele in range(3) for phenotype in range(3)])
+
+        context = SOMView().process_and_visualise_som(self.temp_data.id, 2, None, 'snp', progressive=True)
+
+        self.assertTrue(context['preview'])
+        self.assertIsNone(context['csv_path'])
+        self.assertTrue(context['status_url'].startswith(reverse('SOM_status')))
+        mock_som_trainer.submit.assert_called_once()
+
+        # Once the process has the SOM, the progressive request the page retries when the status of the training is
+        # unknown returns the full figure without training again
+        SOMView().process_and_visualise_som(self.temp_data.id, 2, None, 'snp')
+        context = SOMView().process_and_visualise_som(self.temp_data.id, 2, None, 'snp', progressive=True)
+        self.assertFalse(context.get('preview', False))
+        self.assertIsNotNone(context['csv_path'])
+        mock_som_trainer.submit.assert_called_once()
+
+    @patch('som.views.som_trainer')
+    def test_som_status_view(self, mock_som_trainer):
+        """
+        Test that the status view reports the status of the background training.
+        """
+        mock_som_trainer.status.return_value = 'training'
+
+        response = self.client.get(reverse('SOM_status'), {'key': 'key'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'status': 'training'})
+        mock_som_trainer.status.assert_called_once_with('key')
+
+    def test_som_point_detail_view(self):
+        """
+        Test that the point view returns every association of a point of a cached SOM, most significant first.
+        """
+        grouped_df = pd.DataFrame({
+            'snp': ['A_01', 'B_01'],
+            'phewas_string': [['Phenotype_A', 'Phenotype_B'], ['Phenotype_C']],
+            'p': [[0.04, 0.01], [0.02]],
+            'odds_ratio': [[1.2, 2.5], [1.7]],
+        })
+        som_cache.set('key', {'positions': None, 'som': None, 'grouped_df': grouped_df, 'x_normalised': None,
+                              'som_type': 'snp'})
+        self.addCleanup(som_cache.clear)
+
+        response = self.client.get(reverse('SOM_point'), {'key': 'key', 'point': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['snp'], 'A_01')
+        self.assertEqual([a['phewas_string'] for a in response.data['associations']], ['Phenotype_B', 'Phenotype_A'])
+
+        # The type of the request cannot make the view read the columns of the other type
+        mismatched = self.client.get(reverse('SOM_point'), {'key': 'key', 'type': 'disease', 'point': 0})
+        self.assertEqual(mismatched.status_code, 200)
+        self.assertEqual(mismatched.data, response.data)
+
+        # Unknown SOMs and points are reported rather than raising
+        response = self.client.get(reverse('SOM_point'), {'key': 'missing', 'point': 0})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('SOM_point'), {'key': 'key', 'point': 5})
+        self.assertEqual(response.status_code, 400)
+
+    def test_som_projection_view(self):
+        """
+        Test that SNPs from the catalog are projected onto a saved SOM where their training samples were mapped.
+        """
+        for i, snp in enumerate(['HLA_A_01', 'HLA_A_02', 'HLA_B_01', 'HLA_B_02']):
+            for j, phenotype in enumerate(['Phenotype_A', 'Phenotype_B', 'Phenotype_C']):
+                HlaPheWasCatalog.objects.create(
+                    snp=snp, phewas_code=j, phewas_string=phenotype, cases=100 + 10 * i, controls=1000,
+                    category_string=f'Category_{j % 2}', odds_ratio=1 + i + j, p=0.01 * (1 + (i + j) % 4),
+                    l95=0.5, u95=3.0, gene_name=snp.split('_')[1], maf=0.1, a1='A', a2='G', chromosome=6,
+                    nchrobs=1000, gene_class=1, serotype='0', subtype='01')
+        filtered_df = preprocess_som_data(pd.DataFrame(list(HlaPheWasCatalog.objects.values())))
+        positions, _, grouped_df, _ = SOMView().train_som(filtered_df, 'snp')
+        version = som_cache.get(som_cache_key('snp', filtered_df, SOM_PARAMS['snp']))['model_version']
+        self.assertIsNotNone(load_som_model(version))
+
+        response = self.client.get(reverse('SOM_project', args=[version]),
+                                   {'items': 'A_02,HLA_B_01,C_01', 'num_clusters': 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['missing'], ['C_01'])
+        expected = {snp: list(positions[i]) for i, snp in enumerate(grouped_df['snp'])}
+        for result in response.data['results']:
+            self.assertEqual(result['bmu'], expected[result['snp']])
+            self.assertIn(result['cluster'], [0, 1])
+
+        # Unknown versions are not found
+        response = self.client.get(reverse('SOM_project', args=['0' * 64]), {'items': 'A_02'})
+        self.assertEqual(response.status_code, 404)
+
+        # Numbers of clusters that are not positive integers are rejected
+        for num_clusters in ['four', '0', '-2', '']:
+            response = self.client.get(reverse('SOM_project', args=[version]),
+                                       {'items': 'A_02', 'num_clusters': num_clusters})
+            self.assertEqual(response.status_code, 400)
+
+    def test_reservoir_sample_rows(self):
+        """
+        Test that the rows of streamed chunks are sampled without replacement, and all kept if there are few enough.
+        """
+        def chunks(n_chunks, rows):
+            for c in range(n_chunks):
+                yield csr_matrix(np.arange(c * rows, (c + 1) * rows, dtype=float).reshape(-1, 1) + 1), None
+
+        sample = reservoir_sample_rows(chunks(20, 50), sample_size=100)
+        values = sample.toarray().ravel()
+        self.assertEqual(len(values), 100)
+        self.assertEqual(len(set(values)), 100)
+        self.assertTrue(set(values) <= set(range(1, 1001)))
+        # The sample is spread over the stream rather than taken from its start or end
+        self.assertTrue(values.min() <= 250 and values.max() > 750)
+
+        self.assertEqual(sorted(reservoir_sample_rows(chunks(2, 30), sample_size=100).toarray().ravel()),
+                         list(range(1, 61)))
+
+    def test_streaming_features_match_engineer_features(self):
+        """
+        Test that the features streamed from the catalog in chunks are those engineered from the whole DataFrame.
+        """
+        for i, snp in enumerate(['HLA_A_01', 'HLA_A_02', 'HLA_B_01', 'HLA_B_02', 'HLA_C_01']):
+            for j, phenotype in enumerate(['Phenotype_A', 'Phenotype_B', 'Phenotype_C']):
+                HlaPheWasCatalog.objects.create(
+                    snp=snp, phewas_code=j, phewas_string=phenotype, cases=100 + 10 * i, controls=1000,
+                    category_string=f'Category_{j % 2}', odds_ratio=1 + i + j, p=0.01 * (1 + (i + j) % 4),
+                    l95=0.5, u95=3.0, gene_name=snp.split('_')[1], maf=0.1, a1='A', a2='G', chromosome=6,
+                    nchrobs=1000, gene_class=1, serotype='0', subtype='01')
+        filtered_df = preprocess_som_data(pd.DataFrame(list(HlaPheWasCatalog.objects.values())))
+
+        for som_type, label_column in [('snp', 'snp'), ('disease', 'phewas_string')]:
+            features_matrix, grouped_df, feature_names = SOMView().engineer_features(
+                filtered_df, som_type, return_feature_names=True)
+            queryset = som_queryset('', som_type)
+            vocabulary_index = {name: i for i, name in enumerate(feature_vocabulary(queryset, som_type))}
+            # Chunks of a few associations must not split any SNP or disease
+            chunks = list(iter_feature_chunks(queryset, som_type, vocabulary_index, chunk_size=4))
+            self.assertGreater(len(chunks), 1)
+            streamed = np.vstack([features.toarray() for features, _ in chunks])
+            labels = [label for _, chunk_labels in chunks for label in chunk_labels]
+
+            self.assertEqual(labels, list(grouped_df[label_column]))
+            columns = [vocabulary_index[name] for name in feature_names]
+            np.testing.assert_allclose(streamed[:, columns], features_matrix.toarray())
+
+        positions, som, labels, transforms = train_streaming_som(
+            '', 'snp', {'sigma': 1.0, 'learning_rate': 0.5}, epochs=2, chunk_size=4)
+        self.assertEqual(labels, ['A_01', 'A_02', 'B_01', 'B_02', 'C_01'])
+        self.assertTrue((positions < som.get_weights().shape[:2]).all())
+        self.assertEqual(transforms['feature_names'], feature_vocabulary(som_queryset('', 'snp'), 'snp'))
+        self.assertEqual(som.get_weights().shape[2], len(transforms['scale']))
+
+    @patch('som.views.run_consensus_clustering')
+    def test_consensus_clusters_are_cached(self, mock_run_consensus_clustering):
+        """
+        Test that the consensus clusters of a cached SOM are only computed once per number of clusters.
+        """
+        mock_run_consensus_clustering.return_value = (np.array([1, 0]), np.array([1.0, 0.5]))
+        som_cache.set('key', {'positions': None, 'som': None, 'grouped_df': None, 'x_normalised': None})
+        self.addCleanup(som_cache.clear)
+        som_view = SOMView()
+
+        for _ in range(2):
+            labels, stability = som_view.consensus_clusters(np.zeros((2, 2)), 'snp', 2, 'key')
+        mock_run_consensus_clustering.assert_called_once()
+        np.testing.assert_array_equal(stability, [1.0, 0.5])
+        som_view.consensus_clusters(np.zeros((2, 2)), 'snp', 3, 'key')
+        self.assertEqual(mock_run_consensus_clustering.call_count, 2)
+
+    @patch('som.views.HIERARCHICAL_SOM_MIN_SAMPLES', 5)
+    @patch('som.views.hierarchical_som')
+    @patch('som.views.initialise_som')
+    def test_train_som_hierarchical(self, mock_initialise_som, mock_hierarchical_som):
+        """
+        Test that large SOM inputs are trained coarse to fine.
+        """
+        mock_hierarchical_som.return_value = (np.zeros((6, 2), dtype=int), MagicMock())
+        with patch.object(SOMView, 'prepare_som_input') as mock_prepare_som_input:
+            mock_prepare_som_input.return_value = (np.zeros((6, 2)), pd.DataFrame({'snp': list('abcdef')}),
+                                                   None)
+            SOMView().train_som(pd.DataFrame({'snp': list('abcdef')}), 'snp', use_cache=False)
+
+        mock_hierarchical_som.assert_called_once()
+        mock_initialise_som.assert_not_called()
+
+    def test_som_neuron_view(self):
+        """
+        Test that drilling into a neuron trains a child SOM on its SNPs only, once.
+        """
+        grouped_df = pd.DataFrame({'snp': ['A_01', 'A_02', 'B_01', 'B_02']})
+        x_normalised = np.random.default_rng(0).random((4, 3))
+        positions = np.array([[0, 0], [1, 1], [0, 0], [0, 0]])
+        som_cache.set('key', {'positions': positions, 'som': None, 'grouped_df': grouped_df,
+                              'x_normalised': x_normalised, 'som_type': 'snp'})
+        self.addCleanup(som_cache.clear)
+
+        with patch('som.views.train_child_som', wraps=train_child_som) as mock_train_child_som:
+            for _ in range(2):
+                response = self.client.get(reverse('SOM_neuron'), {'key': 'key', 'x': 0, 'y': 0})
+                self.assertEqual(response.status_code, 200)
+        mock_train_child_som.assert_called_once()
+        self.assertEqual([p['snp'] for p in response.data['points']], ['A_01', 'B_01', 'B_02'])
+        self.assertEqual([p['point'] for p in response.data['points']], [0, 2, 3])
+
+        # The type of the request cannot make the view read the SOM as the other type
+        response = self.client.get(reverse('SOM_neuron'), {'key': 'key', 'type': 'disease', 'x': 0, 'y': 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['snp'] for p in response.data['points']], ['A_01', 'B_01', 'B_02'])
+
+        # Neurons with too few SNPs and unknown SOMs are reported rather than raising
+        response = self.client.get(reverse('SOM_neuron'), {'key': 'key', 'x': 1, 'y': 1})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('SOM_neuron'), {'key': 'missing', 'x': 0, 'y': 0})
+        self.assertEqual(response.status_code, 404)
+
+    def test_train_som_warm_start(self):
+        """
+        Test that a SOM trained on a slightly different selection is warm-started from the cached SOM.
+        """
+        filtered_df = pd.DataFrame([{
+            'snp': f'{gene}_0{allele}', 'phewas_string': f'Phenotype_{phenotype}', 'p': 0.01,
+            'odds_ratio': 1 + allele + phenotype, 'category_string': f'Category_{phenotype % 2}', 'l95': 0.5,
+            'u95': 3.0, 'maf': 0.1, 'cases': 100, 'controls': 1000, 'gene_name': gene,
+        } for gene in 'ABC' for allele in range(3) for phenotype in range(4) if (allele + phenotype) % 3])
+        som_view = SOMView()
+
+        som_view.train_som(filtered_df, 'snp')
+        subset_df = filtered_df[filtered_df['snp'] != 'C_02']
+        som_view.train_som(subset_df, 'snp', warm_start=True)
+
+        cached = som_cache.get(som_cache_key('snp', subset_df, SOM_PARAMS['snp']))
+        self.assertTrue(cached['warm_started'])
+        self.assertFalse(som_cache.get(som_cache_key('snp', filtered_df, SOM_PARAMS['snp']))['warm_started'])
+
+    def test_cluster_metrics_view_invalid_type(self):
+        """
+        Test that the cluster metrics view rejects an invalid SOM type.
+        """
+        response = self.client.get(reverse('cluster_metrics'), {'data_id': self.temp_data.id, 'type': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_load_som_data(self):
+        """
+        Test that the SOM input loaded from the catalog with the filters is the filtered catalog, preprocessed.
+        """
+        for i, snp in enumerate(['HLA_A_01', 'HLA_A_02', 'HLA_B_01', 'HLA_B_0']):
+            for j, phenotype in enumerate(['Phenotype_A', 'Phenotype_B']):
+                HlaPheWasCatalog.objects.create(
+                    snp=snp, phewas_code=j, phewas_string=phenotype, cases=100, controls=1000,
+                    category_string='Category_A', odds_ratio=1 + i + j, p=0.03 * (1 + j) + 0.001 * i, l95=0.5, u95=3.0,
+                    gene_name=snp.split('_')[1], maf=0.1, a1='A', a2='G', chromosome=6, nchrobs=1000, gene_class=1,
+                    serotype='0', subtype='0' if snp == 'HLA_B_0' else '01')
+        filters = 'gene_name:==:A OR gene_name:==:B'
+        expected = preprocess_som_data(pd.DataFrame(list(
+            HlaPheWasCatalog.objects.filter(gene_name__in=['A', 'B']).order_by('snp', 'id').values())))
+
+        filtered_df = load_som_data(urllib.parse.quote(filters), 'snp')
+
+        pd.testing.assert_frame_equal(filtered_df.reset_index(drop=True),
+                                      expected[filtered_df.columns].reset_index(drop=True), check_dtype=False)
+        self.assertEqual(list(filtered_df['snp'].unique()), ['A_01', 'A_02', 'B_01'])
+
+    @patch('som.views.SOMView.train_som')
+    def test_cluster_metrics_view_with_filters(self, mock_train_som):
+        """
+        Test that the cluster metrics view loads the SOM input from the catalog when no temporary data is given, and
+        rejects filters that match no associations.
+        """
+        HlaPheWasCatalog.objects.create(
+            snp='HLA_A_01', phewas_code=1, phewas_string='Phenotype_A', cases=100, controls=1000,
+            category_string='Category_A', odds_ratio=1.5, p=0.01, l95=0.5, u95=3.0, gene_name='A', maf=0.1,
+            a1='A', a2='G', chromosome=6, nchrobs=1000, gene_class=1, serotype='0', subtype='01')
+        positions = np.array([[x, y] for x in range(4) for y in range(4)] * 2)
+        mock_train_som.return_value = (positions, MagicMock(), pd.DataFrame(), np.zeros((32, 2)))
+
+        response = self.client.get(reverse('cluster_metrics'), {'filters': 'gene_name:==:A', 'type': 'snp'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(mock_train_som.call_args[0][0]['snp']), ['A_01'])
+
+        response = self.client.get(reverse('cluster_metrics'), {'filters': 'gene_name:==:B', 'type': 'snp'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_build_som_input(self):
+        """
+        Test that the commands build the SOM input from the filtered catalog, and stop when nothing matches.
+        """
+        for snp in ['HLA_A_01', 'HLA_A_02']:
+            HlaPheWasCatalog.objects.create(
+                snp=snp, phewas_code=1, phewas_string='Phenotype_A', cases=100, controls=1000,
+                category_string='Category_A', odds_ratio=1.5, p=0.01, l95=0.5, u95=3.0, gene_name='A', maf=0.1,
+                a1='A', a2='G', chromosome=6, nchrobs=1000, gene_class=1, serotype='0', subtype='01')
+
+        x_normalised = build_som_input('gene_name:==:A', 'snp')
+        self.assertEqual(x_normalised.shape[0], 2)  # One row for each SNP
+
+        with self.assertRaises(ValueError):
+            build_som_input('gene_name:==:B', 'snp')
+        with self.assertRaisesMessage(CommandError, 'No associations match the given filters'):
+            call_command('run_som_evaluation', '--type', 'snp', filters='gene_name:==:B', stdout=StringIO())
+
+    def test_prepare_som_input_uses_catalog_basis(self):
+        """
+        Test that SOM inputs are projected onto an SVD basis fitted once on the whole catalog and saved.
+        """
+        for i, snp in enumerate(['HLA_A_01', 'HLA_A_02', 'HLA_B_01', 'HLA_B_02']):
+            for j in range(60):
+                HlaPheWasCatalog.objects.create(
+                    snp=snp, phewas_code=j, phewas_string=f'Phenotype_{j}', cases=100 + 10 * i, controls=1000,
+                    category_string=f'Category_{j % 3}', odds_ratio=1 + (i * j) % 5, p=0.01, l95=0.5, u95=3.0,
+                    gene_name=snp.split('_')[1], maf=0.1, a1='A', a2='G', chromosome=6, nchrobs=1000,
+                    gene_class=1, serotype='0', subtype='01')
+        filtered_df = preprocess_som_data(pd.DataFrame(list(HlaPheWasCatalog.objects.values())))
+        subset_df = filtered_df[filtered_df['gene_name'] == 'A']
+        som_view = SOMView()
+
+        # Without a saved basis, each selection is reduced on its own and nothing is fitted on the catalog
+        with patch('som.streaming.fit_streaming_svd') as mock_fit_streaming_svd:
+            som_view.prepare_som_input(subset_df, 'snp')
+        mock_fit_streaming_svd.assert_not_called()
+        self.assertIsNone(feature_basis('snp'))
+
+        # The basis is fitted and saved when the catalog is loaded, and only loaded by the requests
+        with patch('som.streaming.fit_streaming_svd', wraps=fit_streaming_svd) as mock_fit_streaming_svd:
+            call_command('fit_feature_basis', stdout=StringIO())
+            x_normalised, _, transforms = som_view.prepare_som_input(filtered_df, 'snp', return_transforms=True)
+            x_subset, _, subset_transforms = som_view.prepare_som_input(subset_df, 'snp', return_transforms=True)
+        self.assertEqual(mock_fit_streaming_svd.call_count, 2)  # Once for each SOM type
+
+        # Both selections share the basis of the whole catalog, in single precision
+        self.assertEqual(transforms['svd_components'].dtype, np.float32)
+        np.testing.assert_array_equal(transforms['svd_components'], subset_transforms['svd_components'])
+        self.assertEqual(subset_transforms['feature_names'], transforms['feature_names'])
+        self.assertEqual(x_subset.shape, (2, transforms['svd_components'].shape[0]))
+
+        # The saved basis is reused by other processes rather than fitted again
+        cached_feature_basis.cache_clear()
+        with patch('som.streaming.fit_streaming_svd') as mock_fit_streaming_svd:
+            _, _, reloaded_transforms = som_view.prepare_som_input(subset_df, 'snp', return_transforms=True)
+        mock_fit_streaming_svd.assert_not_called()
+        np.testing.assert_array_equal(reloaded_transforms['svd_components'], transforms['svd_components'])
 
     def test_perform_dimensionality_reduction(self):
         """
@@ -525,6 +1492,13 @@ class SOMViewTestCase(TestCase):
         self.assertTrue(isinstance(features_matrix, csr_matrix))
         self.assertEqual(features_matrix.shape[0], len(mock_filtered_df))
 
+        # Check that every feature is named, for both SOM types
+        for som_type in ['snp', 'disease']:
+            features_matrix, _, feature_names = som_view.engineer_features(
+                mock_filtered_df.assign(gene_name=['A', 'B', 'A']), som_type, return_feature_names=True)
+            self.assertEqual(features_matrix.shape[1], len(feature_names))
+            self.assertEqual(len(set(feature_names)), len(feature_names))
+
     def test_construct_results_df(self):
         """
         Test the construct_results_df method.
@@ -0,0 +1,597 @@
+"""
+SOM training and clustering helpers that are safe to run inside worker processes.
+
+This module deliberately avoids importing Django models so that joblib/loky workers can unpickle and run the
+functions defined here without setting up the Django application registry.
+"""
+import numpy as np
+from minisom import MiniSom
+from scipy.ndimage import zoom
+from scipy.sparse import csr_matrix, hstack
+from sklearn.cluster import KMeans, SpectralClustering
+from sklearn.metrics import silhouette_score
+from sklearn.utils import check_random_state
+from threadpoolctl import threadpool_limits
+
+# Maximum number of samples used to compute silhouette scores, which are quadratic in the number of samples
+SILHOUETTE_SAMPLE_SIZE = 2000
+
+# Fraction of the training schedule run to refine a SOM initialised from the weights of a previous SOM
+WARM_START_FRACTION = 0.2
+
+# Width and height below which a hierarchical SOM stops halving its grid to find the coarsest level
+HIERARCHICAL_MIN_SIZE = 8
+
+# Fraction of the samples each SOM of a consensus clustering is trained on
+CONSENSUS_SUBSAMPLE = 0.8
+
+# Number of sample pairs whose co-sampling counts are computed at a time
+CONSENSUS_PAIR_CHUNK_SIZE = 1000000
+
+
+def som_grid_size(n_samples):
+    """
+    Function to get the default size of the SOM grid, using the rule of 10 sqrt(n) neurons.
+
+    :param n_samples: Number of samples
+    :return: Width and height of the SOM grid
+    """
+    size = int(np.sqrt(10 * np.sqrt(n_samples)))
+    return size, size
+
+
+def initialise_som(x_normalised, som_x=None, som_y=None, sigma=1.0, learning_rate=0.5, num_iterations=20000,
+                   random_seed=None):
+    """
+    Function to initialise and train the SOM with dynamic parameters.
+
+    :param x_normalised: Normalised feature matrix
+    :param som_x: Width of the SOM grid
+    :param som_y: Height of the SOM grid
+    :param sigma: Spread of the neighborhood function
+    :param learning_rate: Initial learning rate
+    :param num_iterations: Number of iterations for training
+    :param random_seed: Seed of the SOM weight initialisation and sample order
+    :return: Positions of the winning neurons and the trained SOM
+    """
+    # Use rule of 10 sqrt(n) for the number of neurons if not specified
+    default_x, default_y = som_grid_size(x_normalised.shape[0])
+    som_x = default_x if som_x is None else som_x
+    som_y = default_y if som_y is None else som_y
+
+    print(f"Training SOM with {som_x}x{som_y} grid, sigma={sigma}, learning_rate={learning_rate}, "
+          f"num_iterations={num_iterations}")
+
+    # Initialise the SOM
+    input_len = x_normalised.shape[1]
+    som = MiniSom(x=som_x, y=som_y, input_len=input_len, sigma=sigma, learning_rate=learning_rate,
+                  random_seed=random_seed)
+    som.random_weights_init(x_normalised)
+    som.train_random(x_normalised, num_iterations)
+
+    # Get the positions of the winning neurons
+    positions = np.array([som.winner(x) for x in x_normalised])
+    return positions, som
+
+
+def resize_som_weights(weights, som_x, som_y):
+    """
+    Function to resize the weights of a SOM to a different grid size by interpolating between neighbouring neurons.
+
+    :param weights: Weights of the SOM, of shape (x, y, input_len)
+    :param som_x: Width of the new grid
+    :param som_y: Height of the new grid
+    :return: Weights of shape (som_x, som_y, input_len)
+    """
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape[:2] == (som_x, som_y):
+        return weights.copy()
+    return zoom(weights, (som_x / weights.shape[0], som_y / weights.shape[1], 1), order=1, mode='nearest')
+
+
+def warm_start_som(x_normalised, initial_weights, som_x=None, som_y=None, sigma=1.0, learning_rate=0.5,
+                   num_iterations=20000, refine_fraction=WARM_START_FRACTION, random_seed=None):
+    """
+    Function to initialise a SOM from the weights of a previous SOM and refine it on new data.
+
+    Only the end of the training schedule is run, where the neighbourhood and learning rate have decayed, so the
+    previous SOM's organisation is kept and fine-tuned rather than retrained from scratch.
+
+    :param x_normalised: Normalised feature matrix
+    :param initial_weights: Weights of the previous SOM, in the feature space of x_normalised
+    :param som_x: Width of the SOM grid
+    :param som_y: Height of the SOM grid
+    :param sigma: Spread of the neighborhood function
+    :param learning_rate: Initial learning rate
+    :param num_iterations: Number of iterations of the full training schedule
+    :param refine_fraction: Fraction of the schedule run to refine the SOM
+    :param random_seed: Seed of the sample order
+    :return: Positions of the winning neurons and the trained SOM
+    """
+    default_x, default_y = som_grid_size(x_normalised.shape[0])
+    som_x = default_x if som_x is None else som_x
+    som_y = default_y if som_y is None else som_y
+    refine_iterations = max(int(num_iterations * refine_fraction), 1)
+
+    print(f"Warm-starting SOM with {som_x}x{som_y} grid, sigma={sigma}, learning_rate={learning_rate}, "
+          f"refining for {refine_iterations} of {num_iterations} iterations")
+
+    som = MiniSom(x=som_x, y=som_y, input_len=x_normalised.shape[1], sigma=sigma, learning_rate=learning_rate,
+                  random_seed=random_seed)
+    # MiniSom has no public setter for the weights, so the previous weights replace the random initialisation
+    som._weights = resize_som_weights(initial_weights, som_x, som_y)
+    train_som_iterations(som, x_normalised, num_iterations - refine_iterations, num_iterations, num_iterations,
+                         random_state=random_seed)
+
+    # Get the positions of the winning neurons
+    positions = np.array([som.winner(x) for x in x_normalised])
+    return positions, som
+
+
+def hierarchical_grid_sizes(som_x, som_y, min_size=HIERARCHICAL_MIN_SIZE):
+    """
+    Function to get the grid sizes of a coarse-to-fine SOM, halving the final grid until it is no larger than
+    min_size.
+
+    :param som_x: Width of the final grid
+    :param som_y: Height of the final grid
+    :param min_size: Largest width and height of the coarsest grid
+    :return: List of the width and height of each level, coarsest first
+    """
+    sizes = [(som_x, som_y)]
+    while max(sizes[-1]) > min_size:
+        x, y = sizes[-1]
+        sizes.append((max((x + 1) // 2, 2), max((y + 1) // 2, 2)))
+    return sizes[::-1]
+
+
+def hierarchical_som(x_normalised, som_x=None, som_y=None, sigma=1.0, learning_rate=0.5, num_iterations=20000,
+                     min_size=HIERARCHICAL_MIN_SIZE, refine_fraction=WARM_START_FRACTION, random_seed=None):
+    """
+    Function to train a large SOM coarse to fine.
+
+    The full training schedule is only run on a small grid, which is cheap since the cost of each iteration grows
+    with the number of neurons. Each finer level doubles the grid, is initialised by interpolating the weights of
+    the level before and only runs the end of the schedule, as a warm-started SOM does.
+
+    :param x_normalised: Normalised feature matrix
+    :param som_x: Width of the final SOM grid
+    :param som_y: Height of the final SOM grid
+    :param sigma: Spread of the neighborhood function
+    :param learning_rate: Initial learning rate
+    :param num_iterations: Number of iterations of the full training schedule
+    :param min_size: Largest width and height of the coarsest grid
+    :param refine_fraction: Fraction of the schedule run to refine each finer level
+    :param random_seed: Seed of the SOM weight initialisation and sample order
+    :return: Positions of the winning neurons and the trained SOM
+    """
+    default_x, default_y = som_grid_size(x_normalised.shape[0])
+    som_x = default_x if som_x is None else som_x
+    som_y = default_y if som_y is None else som_y
+    sizes = hierarchical_grid_sizes(som_x, som_y, min_size)
+    refine_iterations = max(int(num_iterations * refine_fraction), 1)
+
+    print(f"Training hierarchical SOM with {' -> '.join(f'{x}x{y}' for x, y in sizes)} grids, sigma={sigma}, "
+          f"learning_rate={learning_rate}, num_iterations={num_iterations}, refining for {refine_iterations}")
+
+    input_len = x_normalised.shape[1]
+    som = None
+    for level_x, level_y in sizes:
+        level = MiniSom(x=level_x, y=level_y, input_len=input_len, sigma=sigma, learning_rate=learning_rate,
+                        random_seed=random_seed)
+        if som is None:
+            # Train the coarsest level from scratch
+            level.random_weights_init(x_normalised)
+            level.train_random(x_normalised, num_iterations)
+        else:
+            # MiniSom has no public setter for the weights, so the coarser weights replace the random initialisation
+            level._weights = resize_som_weights(som.get_weights(), level_x, level_y)
+            train_som_iterations(level, x_normalised, num_iterations - refine_iterations, num_iterations,
+                                 num_iterations, random_state=random_seed)
+        som = level
+
+    # Get the positions of the winning neurons
+    winners, _ = best_matching_units(som.get_weights(), np.asarray(x_normalised))
+    positions = np.column_stack(np.unravel_index(winners, (som_x, som_y)))
+    return positions, som
+
+
+def train_child_som(x_normalised, positions, neuron, sigma=1.0, learning_rate=0.5, num_iterations=2000,
+                    random_seed=None):
+    """
+    Function to train a SOM on the samples mapped to a single neuron of a SOM, to drill down into that neuron.
+
+    :param x_normalised: Normalised feature matrix the parent SOM was trained on
+    :param positions: Positions of the winning neuron of each sample in the parent SOM
+    :param neuron: Position of the neuron to drill down into
+    :param sigma: Spread of the neighborhood function
+    :param learning_rate: Initial learning rate
+    :param num_iterations: Number of iterations for training
+    :param random_seed: Seed of the SOM weight initialisation and sample order
+    :return: Indices of the samples of the neuron, their positions in the child SOM and the child SOM
+    """
+    indices = np.flatnonzero((np.asarray(positions) == np.asarray(neuron)).all(axis=1))
+    if len(indices) < 2:
+        raise ValueError(f"Neuron {tuple(neuron)} has fewer than 2 samples to train a child SOM on")
+    child_x, child_y = (max(size, 2) for size in som_grid_size(len(indices)))
+    child_positions, child_som = initialise_som(x_normalised[indices], child_x, child_y, sigma=sigma,
+                                                learning_rate=learning_rate, num_iterations=num_iterations,
+                                                random_seed=random_seed)
+    return indices, child_positions, child_som
+
+
+def best_matching_units(weights, x):
+    """
+    Function to find the best matching unit of each sample without looping over the samples.
+
+    :param weights: Weights of the SOM, of shape (x, y, input_len)
+    :param x: Dense samples, of shape (n_samples, input_len)
+    :return: Flat index of the best matching unit of each sample and its distance to the sample
+    """
+    flat_weights = weights.reshape(-1, weights.shape[-1])
+    # Squared distances expanded as |x|^2 - 2 x.w + |w|^2 to avoid materialising every difference
+    distances = (np.einsum('ij,ij->i', x, x)[:, None] - 2 * x @ flat_weights.T
+                 + np.einsum('ij,ij->i', flat_weights, flat_weights)[None, :])
+    winners = distances.argmin(axis=1)
+    return winners, np.sqrt(np.maximum(distances[np.arange(len(x)), winners], 0))
+
+
+def train_minibatch_som(batches, n_batches, input_len, som_x, som_y, sigma=1.0, learning_rate=0.5, epochs=5,
+                        random_seed=None):
+    """
+    Function to train a SOM with mini-batch updates, so that only one batch of the input has to be in memory.
+
+    Each batch moves the weights towards the batch SOM solution for that batch (the neighbourhood-weighted mean of
+    the samples mapped around each neuron), with the learning rate and sigma decaying over the whole schedule as in
+    MiniSom.
+
+    :param batches: Function returning an iterator over the dense batches of normalised samples, called once an epoch
+    :param n_batches: Number of batches in an epoch
+    :param input_len: Number of features of the samples
+    :param som_x: Width of the SOM grid
+    :param som_y: Height of the SOM grid
+    :param sigma: Initial spread of the neighborhood function
+    :param learning_rate: Initial learning rate
+    :param epochs: Number of passes over the batches
+    :param random_seed: Seed of the weight initialisation
+    :return: The trained SOM
+    """
+    som = MiniSom(x=som_x, y=som_y, input_len=input_len, sigma=sigma, learning_rate=learning_rate,
+                  random_seed=random_seed)
+    random_state = check_random_state(random_seed)
+    # Squared grid distances between every pair of neurons
+    grid = np.array([(i, j) for i in range(som_x) for j in range(som_y)], dtype=float)
+    grid_distances = np.sum((grid[:, None, :] - grid[None, :, :]) ** 2, axis=-1)
+
+    weights = None
+    total_steps = max(epochs * n_batches, 1)
+    step = 0
+    for _ in range(epochs):
+        for batch in batches():
+            if weights is None:
+                # Initialise the weights with random samples of the first batch, as random_weights_init does
+                weights = batch[random_state.randint(len(batch), size=som_x * som_y)].astype(float)
+            decay = 1 / (1 + step / (total_steps / 2))
+            neighbourhood = np.exp(-grid_distances / (2 * (sigma * decay) ** 2))
+
+            winners, _ = best_matching_units(weights.reshape(som_x, som_y, -1), batch)
+            influence = neighbourhood[winners]
+            numerator = influence.T @ batch
+            denominator = influence.sum(axis=0)
+            updated = denominator > 1e-12
+            batch_weights = numerator[updated] / denominator[updated, None]
+            weights[updated] += learning_rate * decay * (batch_weights - weights[updated])
+            step += 1
+
+    if weights is None:
+        raise ValueError('Cannot train a SOM without any samples')
+    # MiniSom has no public setter for the weights
+    som._weights = weights.reshape(som_x, som_y, input_len)
+    return som
+
+
+def evaluate_som_configuration(x_normalised, config, blas_threads=1):
+    """
+    Function to train a SOM for a single grid search configuration and measure its errors.
+
+    :param x_normalised: Normalised feature matrix
+    :param config: Dictionary with the som_x, som_y, multiplier, sigma, learning_rate and num_iterations keys
+    :param blas_threads: Maximum number of BLAS/OpenMP threads the worker may use
+    :return: The configuration extended with the quantisation and topographic errors
+    """
+    # Limit the native thread pools so that parallel workers do not oversubscribe the CPU
+    with threadpool_limits(limits=blas_threads):
+        _, som = initialise_som(
+            x_normalised,
+            som_x=config['som_x'],
+            som_y=config['som_y'],
+            sigma=config['sigma'],
+            learning_rate=config['learning_rate'],
+            num_iterations=config['num_iterations']
+        )
+        qe = som.quantization_error(x_normalised)
+        te = som.topographic_error(x_normalised)
+
+    return {**config, 'quantisation_error': qe, 'topographic_error': te}
+
+
+def train_som_iterations(som, x_normalised, start, stop, max_iteration, random_state=None):
+    """
+    Function to train a SOM for the iterations in [start, stop) of a schedule of max_iteration iterations.
+
+    Unlike MiniSom.train_random, the learning rate and sigma decay is computed against the full schedule, so training
+    a SOM in several calls produces the same schedule as a single call of max_iteration iterations.
+
+    :param som: The MiniSom object to train in place
+    :param x_normalised: Normalised feature matrix
+    :param start: First iteration of the schedule to run
+    :param stop: Iteration of the schedule to stop before
+    :param max_iteration: Total number of iterations in the schedule
+    :param random_state: Seed or RandomState used to pick the training samples
+    :return: The trained SOM
+    """
+    random_state = check_random_state(random_state)
+    # Pick the samples for this part of the schedule at random, as train_random does
+    sample_indexes = random_state.randint(len(x_normalised), size=max(stop - start, 0))
+    for t, index in zip(range(start, stop), sample_indexes):
+        som.update(x_normalised[index], som.winner(x_normalised[index]), t, max_iteration)
+    return som
+
+
+def continue_som_configuration(x_normalised, config, som, start, stop, max_iteration, blas_threads=1):
+    """
+    Function to train a SOM for a configuration up to a given iteration budget, continuing from its current weights.
+
+    :param x_normalised: Normalised feature matrix
+    :param config: Dictionary with the som_x, som_y, multiplier, sigma and learning_rate keys
+    :param som: The partially trained SOM, or None to initialise a new one
+    :param start: Number of iterations the SOM has already been trained for
+    :param stop: Iteration budget to train the SOM up to
+    :param max_iteration: Full iteration budget used for the learning rate and sigma decay
+    :param blas_threads: Maximum number of BLAS/OpenMP threads the worker may use
+    :return: The trained SOM and the configuration extended with its budget and errors
+    """
+    with threadpool_limits(limits=blas_threads):
+        if som is None:
+            som = MiniSom(x=config['som_x'], y=config['som_y'], input_len=x_normalised.shape[1],
+                          sigma=config['sigma'], learning_rate=config['learning_rate'])
+            som.random_weights_init(x_normalised)
+        # Seed the sample order from the budget so that repeated runs are reproducible
+        train_som_iterations(som, x_normalised, start, stop, max_iteration, random_state=stop)
+        qe = som.quantization_error(x_normalised)
+        te = som.topographic_error(x_normalised)
+
+    return som, {**config, 'num_iterations': stop, 'quantisation_error': qe, 'topographic_error': te}
+
+
+def occupied_neurons(som, positions, use_weights=False):
+    """
+    Function to collapse the samples onto the SOM neurons they were mapped to.
+
+    :param som: The trained SOM
+    :param positions: Positions of the winning neuron of each sample
+    :param use_weights: Whether to describe the neurons by their weight vectors rather than their grid positions
+    :return: Features and hit counts of the occupied neurons, and the index of each sample's neuron
+    """
+    neurons, sample_neurons, counts = np.unique(np.asarray(positions), axis=0, return_inverse=True,
+                                                return_counts=True)
+    if use_weights:
+        features = som.get_weights()[neurons[:, 0], neurons[:, 1]]
+    else:
+        features = neurons.astype(float)
+    return features, counts, sample_neurons.reshape(-1)
+
+
+def cluster_neurons(features, counts, num_clusters, random_state=42):
+    """
+    Function to cluster the occupied neurons with K-Means, weighting each neuron by its number of hits.
+
+    Clustering the weighted neurons minimises the same objective as clustering every sample mapped to them, at a cost
+    that is bounded by the size of the SOM grid instead of the number of samples.
+
+    :param features: Features of the occupied neurons
+    :param counts: Number of samples mapped to each neuron
+    :param num_clusters: Number of clusters (capped at the number of occupied neurons)
+    :param random_state: Random state of the K-Means initialisation
+    :return: The fitted KMeans object
+    """
+    kmeans = KMeans(n_clusters=min(int(num_clusters), len(features)), random_state=random_state)
+    return kmeans.fit(features, sample_weight=counts)
+
+
+def cluster_som_neurons(som, positions, num_clusters, use_weights=False, random_state=42):
+    """
+    Function to cluster the samples mapped onto a SOM by clustering the neurons they were mapped to.
+
+    :param som: The trained SOM
+    :param positions: Positions of the winning neuron of each sample
+    :param num_clusters: Number of clusters
+    :param use_weights: Whether to cluster the neurons on their weight vectors rather than their grid positions
+    :param random_state: Random state of the K-Means initialisation
+    :return: Cluster label of each sample
+    """
+    features, counts, sample_neurons = occupied_neurons(som, positions, use_weights)
+    kmeans = cluster_neurons(features, counts, num_clusters, random_state)
+    return kmeans.labels_[sample_neurons]
+
+
+def weighted_cluster_scores(features, labels, counts):
+    """
+    Function to compute the Davies-Bouldin and Calinski-Harabasz indices of weighted points.
+
+    The result is the same as computing the indices over every sample, with each point repeated counts times.
+
+    :param features: Features of the points (e.g. the occupied neurons)
+    :param labels: Cluster label of each point
+    :param counts: Weight of each point
+    :return: Davies-Bouldin index and Calinski-Harabasz index
+    """
+    features = np.asarray(features, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    clusters, labels = np.unique(labels, return_inverse=True)
+    n_clusters = len(clusters)
+    n_samples = counts.sum()
+    if not 1 < n_clusters < n_samples:
+        raise ValueError(f"Number of labels is {n_clusters}. Valid values are 2 to n_samples - 1 (inclusive)")
+
+    # Weighted centroid, size and spread of each cluster
+    cluster_counts = np.bincount(labels, weights=counts, minlength=n_clusters)
+    centroids = np.stack([np.bincount(labels, weights=counts * features[:, i], minlength=n_clusters)
+                          for i in range(features.shape[1])], axis=1) / cluster_counts[:, None]
+    distances = np.linalg.norm(features - centroids[labels], axis=1)
+    intra_dispersion = np.bincount(labels, weights=counts * distances, minlength=n_clusters) / cluster_counts
+
+    # Davies-Bouldin index: mean over clusters of the worst ratio of spreads to centroid separation
+    centroid_distances = np.linalg.norm(centroids[:, None, :] - centroids[None, :, :], axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = (intra_dispersion[:, None] + intra_dispersion[None, :]) / centroid_distances
+    ratios[~np.isfinite(ratios)] = 0
+    dbi = ratios.max(axis=1).mean() if np.any(intra_dispersion) and np.any(centroid_distances) else 0.0
+
+    # Calinski-Harabasz index: ratio of between-cluster to within-cluster dispersion
+    mean = np.average(features, axis=0, weights=counts)
+    between = np.sum(cluster_counts * np.sum((centroids - mean) ** 2, axis=1))
+    within = np.sum(counts * distances ** 2)
+    ch = 1.0 if within == 0 else between * (n_samples - n_clusters) / (within * (n_clusters - 1))
+    return dbi, ch
+
+
+def sampled_silhouette_score(points, labels, sample_size=SILHOUETTE_SAMPLE_SIZE, random_state=42):
+    """
+    Function to compute the silhouette score on a bounded random sample of the points.
+
+    :param points: Features of the samples
+    :param labels: Cluster label of each sample
+    :param sample_size: Maximum number of samples used to compute the score
+    :param random_state: Random state used to draw the sample
+    :return: Silhouette score
+    """
+    sample_size = min(sample_size, len(points))
+    return silhouette_score(points, labels, sample_size=sample_size, random_state=random_state)
+
+
+def som_evaluation_metrics(som, positions, labels, x_normalised):
+    """
+    Function to evaluate a trained and clustered SOM using various metrics.
+
+    :param som: The trained SOM
+    :param positions: Positions of the winning neuron of each sample
+    :param labels: Cluster label of each sample
+    :param x_normalised: The normalised input data
+    :return: Dictionary with the quantisation and topographic errors and the cluster quality indices
+    """
+    labels = np.asarray(labels)
+    # Silhouette needs the raw points so is computed on a bounded sample of them
+    silhouette = sampled_silhouette_score(positions, labels)
+    # The other indices are computed exactly on the occupied neurons weighted by their number of hits
+    features, counts, sample_neurons = occupied_neurons(som, positions)
+    neuron_labels = np.zeros(len(features), dtype=int)
+    neuron_labels[sample_neurons] = labels
+    dbi, ch = weighted_cluster_scores(features, neuron_labels, counts)
+
+    return {
+        'Quantization Error': som.quantization_error(x_normalised),
+        'Topographic Error': som.topographic_error(x_normalised),
+        'Silhouette Score': silhouette,
+        'Davies-Bouldin Index': dbi,
+        'Calinski-Harabasz Index': ch
+    }
+
+
+def evaluate_som_seed(x_normalised, som_params, num_clusters, seed, blas_threads=1):
+    """
+    Function to train, cluster and evaluate a SOM with a given random seed.
+
+    :param x_normalised: Normalised feature matrix
+    :param som_params: Dictionary with the SOM training parameters
+    :param num_clusters: Number of clusters
+    :param seed: Seed of the SOM training and the K-Means initialisation
+    :param blas_threads: Maximum number of BLAS/OpenMP threads the worker may use
+    :return: Dictionary with the seed and the evaluation metrics
+    """
+    with threadpool_limits(limits=blas_threads):
+        positions, som = initialise_som(x_normalised, random_seed=seed, **som_params)
+        labels = cluster_som_neurons(som, positions, num_clusters, random_state=seed)
+        return {'Seed': seed, **som_evaluation_metrics(som, positions, labels, x_normalised)}
+
+
+def consensus_som_run(x_normalised, som_params, num_clusters, seed, subsample=CONSENSUS_SUBSAMPLE, blas_threads=1):
+    """
+    Function to train and cluster a SOM on a random subsample of the samples, as one run of a consensus clustering.
+
+    :param x_normalised: Normalised feature matrix
+    :param som_params: Dictionary with the SOM training parameters
+    :param num_clusters: Number of clusters
+    :param seed: Seed of the subsample, the SOM training and the K-Means initialisation
+    :param subsample: Fraction of the samples the SOM is trained on
+    :param blas_threads: Maximum number of BLAS/OpenMP threads the worker may use
+    :return: Indices of the samples the SOM was trained on and their clusters
+    """
+    n_samples = x_normalised.shape[0]
+    indices = np.arange(n_samples)
+    if subsample < 1:
+        size = min(max(int(n_samples * subsample), num_clusters), n_samples)
+        indices = np.sort(check_random_state(seed).choice(n_samples, size=size, replace=False))
+
+    with threadpool_limits(limits=blas_threads):
+        positions, som = initialise_som(x_normalised[indices], random_seed=seed, **som_params)
+        return indices, cluster_som_neurons(som, positions, num_clusters, random_state=seed)
+
+
+def co_assignment_matrix(runs, n_samples):
+    """
+    Function to build the consensus matrix of several clusterings of subsamples of the same samples.
+
+    Each entry is the fraction of the runs that sampled both samples in which they were put in the same cluster.
+    Only pairs clustered together at least once are stored, so the matrix stays sparse when the clusters are small
+    relative to the samples.
+
+    :param runs: List of the sample indices and clusters of each run
+    :param n_samples: Number of samples
+    :return: Sparse symmetric consensus matrix of shape (n_samples, n_samples)
+    """
+    # One indicator column per cluster of each run, so that a single product counts the co-assignments of every run
+    indicators = []
+    sampled = np.zeros((n_samples, len(runs)), dtype=bool)
+    for run, (indices, labels) in enumerate(runs):
+        labels = np.asarray(labels)
+        indicators.append(csr_matrix((np.ones(len(indices)), (indices, labels)),
+                                     shape=(n_samples, labels.max() + 1 if len(labels) else 0)))
+        sampled[indices, run] = True
+    memberships = hstack(indicators).tocsr()
+    co_assigned = (memberships @ memberships.T).tocoo()
+
+    # Count the runs that sampled both samples of each stored pair, with the runs of each sample packed into bits
+    sampled_bits = np.packbits(sampled, axis=1)
+    co_sampled = np.empty(co_assigned.nnz)
+    for start in range(0, co_assigned.nnz, CONSENSUS_PAIR_CHUNK_SIZE):
+        stop = start + CONSENSUS_PAIR_CHUNK_SIZE
+        both = sampled_bits[co_assigned.row[start:stop]] & sampled_bits[co_assigned.col[start:stop]]
+        co_sampled[start:stop] = np.bitwise_count(both).sum(axis=1)
+
+    return csr_matrix((co_assigned.data / co_sampled, (co_assigned.row, co_assigned.col)),
+                      shape=(n_samples, n_samples))
+
+
+def consensus_clusters(consensus, num_clusters, random_state=42):
+    """
+    Function to cluster the samples on their consensus matrix and score how stable each sample's cluster is.
+
+    :param consensus: Sparse consensus matrix, as returned by co_assignment_matrix
+    :param num_clusters: Number of clusters
+    :param random_state: Seed of the spectral embedding and label assignment
+    :return: Consensus cluster of each sample and its stability, the mean consensus between the sample and the other
+    samples of its cluster
+    """
+    n_samples = consensus.shape[0]
+    labels = SpectralClustering(n_clusters=min(num_clusters, n_samples), affinity='precomputed',
+                                random_state=random_state).fit_predict(consensus)
+
+    # Sum the consensus of each sample with the other samples of its cluster
+    pairs = consensus.tocoo()
+    same_cluster = (labels[pairs.row] == labels[pairs.col]) & (pairs.row != pairs.col)
+    totals = np.bincount(pairs.row[same_cluster], weights=pairs.data[same_cluster], minlength=n_samples)
+    others = np.bincount(labels, minlength=labels.max() + 1)[labels] - 1
+    # Samples alone in their cluster are trivially stable
+    stability = np.divide(totals, others, out=np.ones(n_samples), where=others > 0)
+    return labels, stability
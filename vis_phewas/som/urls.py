@@ -1,7 +1,16 @@
 from django.urls import path
 
-from .views import SOMView
+from .views import SOMView, ClusterMetricsView, SOMFigureView, SOMStatusView, SOMPointDetailView, SOMModelListView, \
+    SOMProjectionView, SOMNeuronView, plotly_js
 
 urlpatterns = [
     path('SOM/', SOMView.as_view(), name='SOM'),
+    path('SOM/figure/', SOMFigureView.as_view(), name='SOM_figure'),
+    path('SOM/status/', SOMStatusView.as_view(), name='SOM_status'),
+    path('SOM/point/', SOMPointDetailView.as_view(), name='SOM_point'),
+    path('SOM/neuron/', SOMNeuronView.as_view(), name='SOM_neuron'),
+    path('SOM/models/', SOMModelListView.as_view(), name='SOM_models'),
+    path('SOM/models/<str:version>/project/', SOMProjectionView.as_view(), name='SOM_project'),
+    path('plotly-<str:digest>.js', plotly_js, name='plotly_js'),
+    path('cluster-metrics/', ClusterMetricsView.as_view(), name='cluster_metrics'),
 ]
@@ -1,21 +1,38 @@
+import json
 from collections import defaultdict
+from urllib.parse import urlencode
 
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import plotly.io as pio
 from api.models import TemporaryCSVData
+from mainapp.compute import compute_context, thread_budget
+from mainapp.dataset import catalog_dataframe
+from mainapp.models import HlaPheWasCatalog
 from django.conf import settings
-from django.shortcuts import render, get_object_or_404
+from django.http import HttpResponse
+from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 from rest_framework.views import APIView
 from scipy.sparse import csr_matrix, hstack, vstack
-from sklearn.cluster import KMeans
 from sklearn.decomposition import TruncatedSVD
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from som.som_utils import cluster_results_to_csv, preprocess_temp_data, initialise_som, \
-    prepare_categories_for_context, create_title, create_hover_text, style_visualisation, evaluate_som, \
-    compute_mean_som_results
+    prepare_categories_for_context, create_title, create_hover_text, style_visualisation, \
+    som_cache, som_cache_key, cluster_count_sweep, SOM_PARAMS, \
+    clean_filters, figure_to_json, plotly_js_bundle, preprocess_som_data, find_warm_start_entry, \
+    som_trainer, stratified_sample, SCATTERGL_THRESHOLD, PREVIEW_ITERATIONS, HIERARCHICAL_SOM_MIN_SAMPLES, \
+    CHILD_SOM_ITERATIONS, run_consensus_clustering, CONSENSUS_RUNS, load_som_data
+from som.model_store import new_som_version, save_som_model, load_som_model, list_som_models, project_onto_som, \
+    transfer_som_weights, align_features
+from som.admission import som_admission, estimate_som_cost
+from som.streaming import feature_basis
+from som.training import cluster_som_neurons, warm_start_som, hierarchical_som, train_child_som, som_grid_size, \
+    CONSENSUS_SUBSAMPLE
 
 
 class SOMView(APIView):
@@ -35,24 +52,29 @@ class SOMView(APIView):
         num_clusters = request.GET.get('num_clusters', 4)
         # Get the filters from the request
         filters = request.GET.get('filters')
-        testing = request.GET.get('testing', False)  # Testing flag for evaluation
-
-        # If testing flag is set
-        if testing:
-            # Process and visualise the SOM 5 times for testing
-            for _ in range(5):
-                self.process_and_visualise_som(data_id, num_clusters, filters, som_type, testing=True)
-                print("Processed SOM")
-            # Compute the mean results for the SOM evaluation
-            compute_mean_som_results()
-            return
-        # Process and visualise the SOM if not in testing mode
-        context = self.process_and_visualise_som(data_id, num_clusters, filters, som_type, testing=testing)
+        # Whether to start from a previous SOM trained on a similar selection
+        warm_start = request.GET.get('warm_start') == 'true'
+        # Whether to cluster by consensus over several SOMs rather than with the single SOM
+        consensus = request.GET.get('consensus') == 'true'
+
+        # If the figure is requested asynchronously, render the page straight away and let it fetch the figure
+        if request.GET.get('async') == 'true':
+            context = self.page_context(data_id, num_clusters, filters, som_type)
+            figure_params = request.GET.copy()
+            figure_params.pop('async')
+            context['figure_url'] = f"{reverse('SOM_figure')}?{figure_params.urlencode()}"
+            return render(request, 'som/som_view.html', context)
+
+        # Process and visualise the SOM
+        context = self.process_and_visualise_som(data_id, num_clusters, filters, som_type, warm_start=warm_start,
+                                                 consensus=consensus)
 
         # Render the template with the context
         return render(request, 'som/som_view.html', context)
 
-    def process_and_visualise_som(self, data_id, num_clusters, filters, som_type, testing=False):
+    @compute_context('SOM visualisation')
+    def process_and_visualise_som(self, data_id, num_clusters, filters, som_type, warm_start=False, progressive=False,
+                                  consensus=False):
         """
         Method to process data and generate SOM visualisation.
 
@@ -60,43 +82,21 @@ class SOMView(APIView):
         :param num_clusters: Number of clusters
         :param filters: Filters string
         :param som_type: Type of the SOM (SNP or disease)
-        :param testing: Flag to indicate testing mode
+        :param warm_start: Whether to warm-start the SOM from a cached SOM trained on a similar input set
+        :param progressive: Whether to return a preview SOM trained on a sample if the SOM is not cached yet, and train
+        the SOM in the background
+        :param consensus: Whether to cluster by consensus over SOMs trained on subsamples, and add the stability of
+        each cluster assignment to the cluster results
         """
-        # Retrieve the temporary CSV data object using the data_id
-        temp_data = get_object_or_404(TemporaryCSVData, id=data_id)
-        filtered_df = preprocess_temp_data(temp_data)
+        filtered_df = self.load_som_input(data_id, filters, som_type)
 
-        # Engineer features based on the SOM type
-        features_matrix, grouped_df = self.engineer_features(filtered_df, som_type)
-
-        # Apply dimensionality reduction with TruncatedSVD to reduce the number of features for the SOM if needed
-        reduced_features_matrix = self.perform_dimensionality_reduction(features_matrix)
-
-        # Standardise the data without converting to dense format to save memory
-        scaler = StandardScaler(with_mean=False)
-        x_normalised = scaler.fit_transform(reduced_features_matrix)
-
-        # Ensure the SOM input is dense
-        if not isinstance(x_normalised, np.ndarray):
-            x_normalised = x_normalised.toarray()  # Convert to dense format
-
-        # Set som parameters based on best grid search results (See grid_search_results_snp.csv
-        # and grid_search_results_disease.csv)
-        if som_type == 'snp':
-            som_params = {
-                'sigma': 1.5,
-                'learning_rate': 0.1,
-                'num_iterations': 10000,
-            }
-        else:
-            som_params = {
-                'sigma': 1.0,
-                'learning_rate': 0.5,
-                'num_iterations': 20000,
-            }
-
-        # SOM training and positions using extracted parameters from dictionary
-        positions, som = initialise_som(x_normalised, **som_params)
+        # Train the SOM, reusing a cached SOM trained on the same data
+        cache_key = som_cache_key(som_type, filtered_df, SOM_PARAMS['snp' if som_type == 'snp' else 'disease'])
+        if progressive and som_cache.get(cache_key) is None:
+            return self.preview_som(filtered_df, data_id, num_clusters, filters, som_type, cache_key, warm_start)
+        positions, som, grouped_df, x_normalised = self.train_som(filtered_df, som_type, cache_key=cache_key,
+                                                                  warm_start=warm_start)
+        cached = som_cache.get(cache_key) or {}
 
         # Testing grid search
         # grid_search_som(x_normalised, output_csv=f"grid_search_results_{som_type}.csv")
@@ -106,23 +106,109 @@ class SOMView(APIView):
         # Create the results DataFrame based on the SOM type
         results_df = self.construct_results_df(grouped_df, positions_df, som_type)
 
-        # K-Means clustering
-        kmeans = KMeans(n_clusters=int(num_clusters), random_state=42)
-        positions_df['cluster'] = kmeans.fit_predict(positions_df)
+        # K-Means clustering of the occupied neurons, mapped back to the samples
+        positions_df['cluster'] = cluster_som_neurons(som, positions, num_clusters)
         results_df['cluster'] = positions_df['cluster']
+        if consensus:
+            results_df['cluster'], results_df['stability'] = self.consensus_clusters(
+                x_normalised, som_type, int(num_clusters), cache_key)
 
         # Save cluster results to a CSV
         cluster_results = results_df.sort_values(by=['cluster', 'snp' if som_type == 'snp' else 'phewas_string'])
-        file_name = cluster_results_to_csv(cluster_results)
+        csv_path = cluster_results_to_csv(cluster_results)
 
         # Evaluate the metrics on the SOM
         # plot_metrics_on_som(positions, som_type)
-        if testing:
-            # If testing flag is set, evaluate the SOM and return
-            evaluate_som(positions, positions_df, som, x_normalised, som_type)
-            return
 
         # Generate the SOM visualisation
+        fig, cleaned_filters = self.build_som_figure(som, results_df, num_clusters, filters, som_type)
+        # Point the page at the details of the points of this SOM
+        fig.update_layout(meta={'point_url': f"{reverse('SOM_point')}?{urlencode({'key': cache_key})}"})
+
+        # Return the context for the visualisation, with only the figure specification as JSON since plotly.js is
+        # loaded separately as a cached asset
+        return {
+            **self.page_context(data_id, num_clusters, filters, som_type, cleaned_filters),
+            'figure_json': figure_to_json(fig),
+            'csv_path': csv_path,
+            'model_version': cached.get('model_version'),
+            'warm_started': bool(cached.get('warm_started')),
+            'consensus': consensus,
+        }
+
+    def load_som_input(self, data_id, filters, som_type):
+        """
+        Helper method to load the preprocessed SOM input, from the temporary data if an ID is given and otherwise
+        straight from the catalog.
+
+        :param data_id: ID of the temporary data, or None to query the catalog with the filters
+        :param filters: Filters string
+        :param som_type: Type of the SOM (SNP or disease)
+        :return: Preprocessed DataFrame containing the input data
+        """
+        if data_id:
+            # Retrieve the temporary CSV data object using the data_id
+            temp_data = get_object_or_404(TemporaryCSVData, id=data_id)
+            return preprocess_temp_data(temp_data)
+
+        filtered_df = load_som_data(filters, som_type)
+        if filtered_df.empty:
+            raise ValidationError({'error': 'No significant associations match the selected filters.'})
+        return filtered_df
+
+    def preview_som(self, filtered_df, data_id, num_clusters, filters, som_type, cache_key, warm_start=False):
+        """
+        Method to start training the SOM in the background and visualise a SOM quickly trained on a stratified sample
+        of the data in the meantime.
+
+        :param filtered_df: Preprocessed DataFrame containing the input data
+        :param data_id: ID of the temporary data
+        :param num_clusters: Number of clusters
+        :param filters: Filters string
+        :param som_type: Type of the SOM (SNP or disease)
+        :param cache_key: Cache key the full SOM is stored under once trained
+        :param warm_start: Whether to warm-start the full SOM from a cached SOM trained on a similar input set
+        :return: Context for the preview visualisation, with the URL to poll for the full SOM
+        """
+        # The background training waits for capacity for as long as it takes rather than being rejected
+        som_trainer.submit(cache_key, self.train_som, filtered_df, som_type, cache_key=cache_key,
+                           warm_start=warm_start, background=True)
+
+        # Train a SOM with few iterations on a sample of the SNPs or diseases
+        sample_df = stratified_sample(filtered_df, som_type)
+        x_normalised, grouped_df = self.prepare_som_input(sample_df, som_type)
+        som_params = {**SOM_PARAMS['snp' if som_type == 'snp' else 'disease'], 'num_iterations': PREVIEW_ITERATIONS}
+        positions, som = initialise_som(x_normalised, **som_params)
+
+        positions_df = pd.DataFrame(positions, columns=['x', 'y'])
+        results_df = self.construct_results_df(grouped_df, positions_df, som_type)
+        results_df['cluster'] = cluster_som_neurons(som, positions, num_clusters)
+
+        n_items = filtered_df['snp' if som_type == 'snp' else 'phewas_string'].nunique()
+        fig, cleaned_filters = self.build_som_figure(
+            som, results_df, num_clusters, filters, som_type,
+            title_suffix=f"<br>Preview of {len(grouped_df)} of {n_items}, refining in the background")
+
+        return {
+            **self.page_context(data_id, num_clusters, filters, som_type, cleaned_filters),
+            'figure_json': figure_to_json(fig),
+            'csv_path': None,
+            'preview': True,
+            'status_url': f"{reverse('SOM_status')}?{urlencode({'key': cache_key})}",
+        }
+
+    def build_som_figure(self, som, results_df, num_clusters, filters, som_type, title_suffix=''):
+        """
+        Helper method to build the SOM visualisation from the trained SOM and the clustered results.
+
+        :param som: The trained SOM
+        :param results_df: Results DataFrame with the position and cluster of each sample
+        :param num_clusters: Number of clusters
+        :param filters: Filters string
+        :param som_type: Type of the SOM (SNP or disease)
+        :param title_suffix: Text appended to the title
+        :return: The figure and the cleaned filters string
+        """
         fig = go.Figure()
         distance_map = som.distance_map().T
         fig.add_trace(go.Heatmap(
@@ -132,13 +218,16 @@ class SOMView(APIView):
             showscale=True,
         ))
 
+        # Use WebGL markers rather than SVG when there are too many points for SVG to stay responsive
+        scatter = go.Scattergl if len(results_df) > SCATTERGL_THRESHOLD else go.Scatter
+
         # Add the cluster data to the visualisation
         for cluster in range(int(num_clusters)):
             cluster_data = results_df[results_df['cluster'] == cluster]
             hover_texts = create_hover_text(cluster_data, som_type)
 
             # Add the cluster data to the visualisation
-            fig.add_trace(go.Scatter(
+            fig.add_trace(scatter(
                 x=cluster_data['x'] + 0.5,
                 y=cluster_data['y'] + 0.5,
                 mode='markers',
@@ -148,13 +237,31 @@ class SOMView(APIView):
                     opacity=0.8,
                 ),
                 text=hover_texts,
-                hoverinfo='text'
+                hoverinfo='text',
+                # Identify each point so that its full details can be fetched when it is clicked
+                customdata=cluster_data.index,
             ))
 
         # Clean and format the filters string and create the title text
         cleaned_filters, title_text = create_title(filters, num_clusters, som_type)
+        title_text += title_suffix
         # Style the visualisation
         style_visualisation(cleaned_filters, fig, title_text)
+        return fig, cleaned_filters
+
+    def page_context(self, data_id, num_clusters, filters, som_type, cleaned_filters=None):
+        """
+        Helper method to build the context of the SOM page that does not depend on the trained SOM.
+
+        :param data_id: ID of the temporary data
+        :param num_clusters: Number of clusters
+        :param filters: Filters string
+        :param som_type: Type of the SOM (SNP or disease)
+        :param cleaned_filters: Cleaned and formatted filters string, computed from the filters if not given
+        :return: Context for the SOM page
+        """
+        if cleaned_filters is None:
+            cleaned_filters = clean_filters(filters, som_type)
 
         # Format the filters for the context
         filter_list = cleaned_filters.lower()
@@ -164,40 +271,198 @@ class SOMView(APIView):
         if som_type == 'snp':
             filter_list = [f.upper() for f in filter_list]
 
-        # Render the visualisation
-        graph_div = pio.to_html(fig, full_html=False)
         # Prepare the categories for the context
         categories = prepare_categories_for_context(som_type)
 
-        # Return the context for the visualisation
         return {
-            'graph_div': graph_div,
-            'csv_path': settings.MEDIA_URL + file_name,
+            'plotly_js_url': reverse('plotly_js', args=[plotly_js_bundle()[1]]),
             'type': som_type,
             'categories': categories,
             'num_clusters': num_clusters,
+            'data_id': data_id,
             'filters': filters if filters else categories,
             'cleaned_filters': filter_list
         }
 
-    def perform_dimensionality_reduction(self, features_matrix):
+    def estimate_training_cost(self, filtered_df, som_type, num_iterations):
+        """
+        Helper method to estimate the cost of training a SOM on the preprocessed data before building its input.
+
+        :param filtered_df: Preprocessed DataFrame containing the input data
+        :param som_type: Type of the SOM ('snp' or 'disease')
+        :param num_iterations: Number of training iterations
+        :return: Dictionary with the estimated memory in bytes and CPU time in seconds
+        """
+        n_samples = filtered_df['snp' if som_type == 'snp' else 'phewas_string'].nunique()
+        som_x, som_y = som_grid_size(n_samples)
+        # The SOM input has at most 100 features, as it is reduced with SVD beyond that
+        return estimate_som_cost(n_samples, len(filtered_df), 100, som_x, som_y, num_iterations)
+
+    @compute_context('SOM training')
+    def train_som(self, filtered_df, som_type, use_cache=True, cache_key=None, warm_start=False, background=False):
+        """
+        Helper method to train the SOM on the preprocessed data, or fetch it from the cache if a SOM has already been
+        trained on the same data.
+
+        :param filtered_df: Preprocessed DataFrame containing the input data
+        :param som_type: Type of the SOM ('snp' or 'disease')
+        :param use_cache: Whether to reuse and store trained SOMs in the cache and save newly trained SOMs
+        :param cache_key: Cache key of the SOM, computed from the data if not given
+        :param warm_start: Whether to initialise the SOM from the cached SOM with the most similar input set, if any,
+        and only refine it
+        :param background: Whether the SOM is trained in the background, so waits for the capacity to train it for
+        as long as it takes rather than rejecting the request after SOM_ADMISSION_WAIT seconds
+        :return: Positions of the winning neurons, the trained SOM, the grouped DataFrame and the SOM input
+        """
+        # Use the parameters tuned for the SOM type
+        som_params = SOM_PARAMS['snp' if som_type == 'snp' else 'disease']
+
+        if cache_key is None:
+            cache_key = som_cache_key(som_type, filtered_df, som_params)
+        if use_cache:
+            cached = som_cache.get(cache_key)
+            if cached is not None:
+                return cached['positions'], cached['som'], cached['grouped_df'], cached['x_normalised']
+
+        # Only train once the process has the capacity the SOM is estimated to need
+        estimate = self.estimate_training_cost(filtered_df, som_type, som_params['num_iterations'])
+        with som_admission.admit(estimate, wait=None if background else settings.SOM_ADMISSION_WAIT,
+                                 description=f"{som_type} {cache_key}"):
+            # Engineer, reduce and normalise the features used as the SOM input
+            x_normalised, grouped_df, transforms = self.prepare_som_input(filtered_df, som_type,
+                                                                          return_transforms=True)
+
+            labels = grouped_df['snp' if som_type == 'snp' else 'phewas_string']
+            # Find a cached SOM trained on a similar input set to start from
+            source = find_warm_start_entry(som_type, labels) if warm_start and use_cache else None
+
+            # SOM training and positions using extracted parameters from dictionary
+            if source is not None:
+                initial_weights = transfer_som_weights(source['som'].get_weights(), source['transforms'], transforms)
+                positions, som = warm_start_som(x_normalised, initial_weights, **som_params)
+            elif x_normalised.shape[0] >= HIERARCHICAL_SOM_MIN_SAMPLES:
+                # Large grids are trained coarse to fine, which keeps the training time close to linear
+                positions, som = hierarchical_som(x_normalised, **som_params)
+            else:
+                positions, som = initialise_som(x_normalised, **som_params)
+
+        if use_cache:
+            # Save the SOM so that new items can be projected onto it after it has left the cache, under a version
+            # of its own since training the same data again gives a different SOM
+            model_version = new_som_version()
+            save_som_model(model_version, som, positions, transforms, som_type, som_params, labels,
+                           warm_started=source is not None)
+            som_cache.set(cache_key, {
+                'model_version': model_version,
+                'positions': positions,
+                'som': som,
+                'grouped_df': grouped_df,
+                'x_normalised': x_normalised,
+                'som_type': som_type,
+                'labels': frozenset(labels),
+                'transforms': transforms,
+                'warm_started': source is not None,
+            })
+        return positions, som, grouped_df, x_normalised
+
+    def prepare_som_input(self, filtered_df, som_type, return_transforms=False):
+        """
+        Helper method to build the normalised, dense SOM input from the preprocessed catalog data.
+
+        :param filtered_df: Preprocessed DataFrame containing the input data
+        :param som_type: Type of the SOM ('snp' or 'disease')
+        :param return_transforms: Whether to also return the feature names, SVD components and scale of the input, so
+        that new items can be transformed in the same way
+        :return: Normalised feature matrix and the grouped DataFrame, and the transforms if requested
+        """
+        # Engineer features based on the SOM type
+        features_matrix, grouped_df, feature_names = self.engineer_features(filtered_df, som_type,
+                                                                            return_feature_names=True)
+
+        # Project onto the SVD basis fitted once on the whole catalog rather than fitting one for every selection
+        basis = feature_basis(som_type)
+        if basis is not None:
+            features_matrix = align_features(features_matrix, feature_names, basis['feature_names'])
+            feature_names = basis['feature_names']
+
+        # Apply dimensionality reduction with TruncatedSVD to reduce the number of features for the SOM if needed
+        reduced_features_matrix, svd_components = self.perform_dimensionality_reduction(
+            features_matrix, return_components=True, components=basis['components'] if basis is not None else None)
+
+        # Standardise the data without converting to dense format to save memory
+        scaler = StandardScaler(with_mean=False)
+        x_normalised = scaler.fit_transform(reduced_features_matrix)
+
+        # Ensure the SOM input is dense, which only happens to the full features if they were not reduced
+        if not isinstance(x_normalised, np.ndarray):
+            x_normalised = x_normalised.toarray()  # Convert to dense format
+        if return_transforms:
+            transforms = {
+                'feature_names': feature_names,
+                'svd_components': svd_components,
+                'scale': scaler.scale_,
+            }
+            return x_normalised, grouped_df, transforms
+        return x_normalised, grouped_df
+
+    def perform_dimensionality_reduction(self, features_matrix, return_components=False, components=None):
         """
         Helper method to perform dimensionality reduction using TruncatedSVD if the number of features exceeds 100.
         :param features_matrix:
+        :param return_components: Whether to also return the SVD components (None if the features were not reduced)
+        :param components: SVD components already fitted on the features (such as the catalog basis) to project the
+        features onto, rather than fitting a TruncatedSVD
         :return:
         """
-        if features_matrix.shape[1] > 100:
-            # Ensure input is sparse before applying TruncatedSVD
-            if not isinstance(features_matrix, csr_matrix):
-                features_matrix = csr_matrix(features_matrix)
+        if components is not None:
+            # Project the sparse single precision features, so that only the reduced matrix is dense
+            reduced_features_matrix = csr_matrix(features_matrix, dtype=np.float32) @ np.asarray(components).T
+        elif features_matrix.shape[1] > 100:
+            # Ensure input is sparse and single precision before applying TruncatedSVD
+            features_matrix = csr_matrix(features_matrix, dtype=np.float32)
             # Perform TruncatedSVD with 100 components, but ensure it doesn’t exceed available features
-            svd = TruncatedSVD(n_components=min(100, features_matrix.shape[1] - 1), random_state=42)
+            svd = TruncatedSVD(n_components=min(100, features_matrix.shape[1] - 1), algorithm='randomized',
+                               random_state=42)
             reduced_features_matrix = svd.fit_transform(features_matrix)
+            components = svd.components_
         else:
             # If there are fewer than 100 features, skip SVD and use the original features matrix
             reduced_features_matrix = features_matrix
+        if return_components:
+            return reduced_features_matrix, components
         return reduced_features_matrix
 
+    def consensus_clusters(self, x_normalised, som_type, num_clusters, cache_key=None):
+        """
+        Helper method to cluster the SOM input by consensus over SOMs trained on subsamples in parallel, or fetch the
+        consensus clusters from the cached SOM.
+
+        :param x_normalised: Normalised SOM input
+        :param som_type: Type of the SOM ('snp' or 'disease')
+        :param num_clusters: Number of clusters
+        :param cache_key: Cache key of the SOM to keep the consensus clusters with, or None to not cache them
+        :return: Consensus cluster of each SNP or disease and the stability of its assignment
+        """
+        cached = som_cache.get(cache_key) if cache_key is not None else None
+        if cached is not None and num_clusters in cached.get('consensus', {}):
+            return cached['consensus'][num_clusters]
+
+        som_params = SOM_PARAMS['snp' if som_type == 'snp' else 'disease']
+        # Each run trains a SOM on a subsample, with as many runs at the same time as there are cores
+        n_samples = x_normalised.shape[0]
+        run_estimate = estimate_som_cost(n_samples, 0, x_normalised.shape[1],
+                                         *som_grid_size(int(n_samples * CONSENSUS_SUBSAMPLE)),
+                                         som_params['num_iterations'])
+        # The runs share the thread budget of the worker, one BLAS thread each
+        workers = min(CONSENSUS_RUNS, thread_budget())
+        estimate = {'memory_bytes': run_estimate['memory_bytes'] * workers,
+                    'cpu_seconds': run_estimate['cpu_seconds'] * CONSENSUS_RUNS / workers}
+        with som_admission.admit(estimate, wait=settings.SOM_ADMISSION_WAIT, description=f"{som_type} consensus"):
+            result = run_consensus_clustering(x_normalised, som_params, num_clusters, n_jobs=workers)
+        if cached is not None:
+            cached.setdefault('consensus', {})[num_clusters] = result
+        return result
+
     def construct_results_df(self, grouped_df, positions_df, som_type):
         """
         Helper method to construct the results DataFrame based on the SOM type.
@@ -230,7 +495,7 @@ class SOMView(APIView):
         results_df = pd.DataFrame(results_data)
         return results_df
 
-    def engineer_features(self, filtered_df, som_type):
+    def engineer_features(self, filtered_df, som_type, return_feature_names=False):
         """
         Helper method to engineer the features for the SOM (Self-Organising Map) based on the specified type.
 
@@ -238,14 +503,15 @@ class SOMView(APIView):
         :param som_type: Type of the SOM ('snp' or 'disease').
             - 'snp': Groups the data by SNP and generates features based on associated phenotypes.
             - 'disease': Groups the data by disease and generates features based on associated SNPs and gene categories.
+        :param return_feature_names: Whether to also return the name of each feature.
 
-        :return: Features matrix (sparse) and grouped DataFrame.
+        :return: Features matrix (sparse) and grouped DataFrame, and the feature names if requested.
         """
 
         # For disease-based SOM, group data by 'phewas_string' (disease identifier)
         if som_type == 'disease':
             # Group and aggregate relevant columns
-            grouped_df = filtered_df.groupby('phewas_string').agg({
+            grouped_df = filtered_df.groupby('phewas_string', observed=True).agg({
                 'snp': list,  # List of SNPs associated with each disease
                 'gene_name': list,  # List of gene names associated with each disease
                 'p': list,  # List of p-values
@@ -286,9 +552,15 @@ class SOMView(APIView):
                 # Combine allele features with encoded gene and category features
                 return hstack([allele_features, encoded_features[df_row.name]])
 
+            # Name the features in the same order as they are combined
+            feature_names = [f"allele:{allele}" for allele in ohe_gene.categories_[0]] + \
+                            [f"gene:{gene}={value}" for gene, values in zip(ohe_gene.feature_names_in_,
+                                                                            ohe_gene.categories_) for value in values] + \
+                            [f"category:{category}" for category in ohe_category.categories_[0]]
+
         else:  # For SNP-based SOM
             # Group data by 'snp' and aggregate relevant columns
-            grouped_df = filtered_df.groupby('snp').agg({
+            grouped_df = filtered_df.groupby('snp', observed=True).agg({
                 'phewas_string': list,  # List of phenotypes associated with each SNP
                 'p': list,  # List of p-values
                 'odds_ratio': list,  # List of odds ratios
@@ -340,8 +612,245 @@ class SOMView(APIView):
                 # Combine phenotype features with encoded categorical features
                 return hstack([phenotype_features, encoded_features[df_row.name]])
 
+            # Name the features in the same order as they are combined
+            feature_names = [f"odds_ratio:{phenotype}" for phenotype in ohe_phenotype.categories_[0]] + \
+                            [f"phenotype:{phenotype}" for phenotype in ohe_phenotype.categories_[0]] + \
+                            [f"category:{category}" for category in ohe_category.categories_[0]]
+
         # Apply the feature creation function across the grouped DataFrame
         features_matrix = vstack(grouped_df.apply(create_combined_features, axis=1).values)
 
         # Return the final sparse features matrix and the grouped DataFrame
+        if return_feature_names:
+            return features_matrix, grouped_df, feature_names
         return features_matrix, grouped_df
+
+
+class ClusterMetricsView(APIView):
+    """
+    View to recommend the number of clusters for a SOM
+    """
+
+    def get(self, request):
+        """
+        :param request: Request object with parameters data_id and type
+        :return: Response with the WCSS, silhouette, Davies-Bouldin and Calinski-Harabasz scores for each number of
+        clusters and the suggested number of clusters
+        """
+        data_id = request.GET.get('data_id')
+        som_type = request.GET.get('type')
+        if som_type not in ('snp', 'disease'):
+            return Response({'error': "Invalid SOM type. Please provide a valid type ('snp' or 'disease')."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Reuse the cached SOM for the data if it has already been trained, so changing the number of clusters
+        # never retrains it
+        som_view = SOMView()
+        filtered_df = som_view.load_som_input(data_id, request.GET.get('filters'), som_type)
+        positions, _, _, _ = som_view.train_som(filtered_df, som_type)
+
+        metrics, suggested_k = cluster_count_sweep(positions)
+        return Response({'metrics': metrics, 'suggested_k': suggested_k})
+
+
+class SOMFigureView(APIView):
+    """
+    View to generate the SOM visualisation figure for a page that fetches it asynchronously
+    """
+
+    def get(self, request):
+        """
+        :param request: Request object with parameters data_id, num_clusters, type, filters, warm_start, progressive
+        and consensus
+        :return: JSON response with the figure specification, the path of the cluster results CSV and, for previews,
+        the URL to poll for the full SOM
+        """
+        num_clusters = request.GET.get('num_clusters', 4)
+        context = SOMView().process_and_visualise_som(request.GET.get('data_id'), num_clusters,
+                                                      request.GET.get('filters'), request.GET.get('type'),
+                                                      warm_start=request.GET.get('warm_start') == 'true',
+                                                      progressive=request.GET.get('progressive') == 'true',
+                                                      consensus=request.GET.get('consensus') == 'true')
+        details = {
+            'csv_path': context['csv_path'],
+            'warm_started': context.get('warm_started', False),
+            'preview': context.get('preview', False),
+            'status_url': context.get('status_url'),
+        }
+        # The figure is already JSON so is embedded as is rather than parsed and serialised again
+        content = f'{{"figure": {context["figure_json"]}, {json.dumps(details)[1:]}'
+        return HttpResponse(content, content_type='application/json')
+
+
+class SOMStatusView(APIView):
+    """
+    View to check whether a SOM trained in the background is ready
+    """
+
+    def get(self, request):
+        """
+        :param request: Request object with parameter key (the cache key of the SOM)
+        :return: Response with the status of the SOM ('ready', 'training', 'failed' or 'unknown')
+        """
+        return Response({'status': som_trainer.status(request.GET.get('key'))})
+
+
+class SOMPointDetailView(APIView):
+    """
+    View to get the full details of a single point of a SOM, which are left out of its hover text
+    """
+
+    def get(self, request):
+        """
+        :param request: Request object with parameters key (the cache key of the SOM) and point (the point id)
+        :return: Response with the point label and all of its associations, most significant first
+        """
+        cached = som_cache.get(request.GET.get('key'))
+        if cached is None:
+            return Response({'error': 'The SOM is no longer available. Please generate it again.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        # The columns are those of the type the SOM was trained for, whatever the request says
+        som_type = cached['som_type']
+        grouped_df = cached['grouped_df']
+        try:
+            row = grouped_df.iloc[int(request.GET.get('point'))]
+        except (TypeError, ValueError, IndexError):
+            return Response({'error': 'Invalid point id.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # The SNP SOM groups phenotypes by SNP and the disease SOM groups SNPs by disease
+        label_column, item_column = ('snp', 'phewas_string') if som_type == 'snp' else ('phewas_string', 'snp')
+        associations = pd.DataFrame({
+            item_column: row[item_column],
+            'odds_ratio': row['odds_ratio'],
+            'p': row['p'],
+        }).sort_values('p', kind='stable')
+        return Response({
+            label_column: row[label_column],
+            'associations': associations.to_dict(orient='records'),
+        })
+
+
+class SOMNeuronView(APIView):
+    """
+    View to drill down into a single neuron of a SOM by training a child SOM on the SNPs or diseases mapped to it
+    """
+
+    def get(self, request):
+        """
+        :param request: Request object with parameters key (the cache key of the SOM), x and y (the neuron)
+        :return: Response with the child SOM grid size and the position of each SNP or disease of the neuron in it
+        """
+        cached = som_cache.get(request.GET.get('key'))
+        if cached is None:
+            return Response({'error': 'The SOM is no longer available. Please generate it again.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        # The type is the one the SOM was trained for, whatever the request says
+        som_type = cached['som_type']
+        try:
+            neuron = (int(request.GET.get('x')), int(request.GET.get('y')))
+        except (TypeError, ValueError):
+            return Response({'error': 'Invalid neuron position.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Child SOMs are kept with their parent so that each neuron is only drilled into once
+        children = cached.setdefault('children', {})
+        if neuron not in children:
+            som_params = SOM_PARAMS[som_type]
+            try:
+                children[neuron] = train_child_som(cached['x_normalised'], cached['positions'], neuron,
+                                                   sigma=som_params['sigma'],
+                                                   learning_rate=som_params['learning_rate'],
+                                                   num_iterations=CHILD_SOM_ITERATIONS, random_seed=42)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        indices, child_positions, child_som = children[neuron]
+
+        label_column = 'snp' if som_type == 'snp' else 'phewas_string'
+        labels = cached['grouped_df'][label_column].iloc[indices]
+        return Response({
+            'neuron': list(neuron),
+            'grid': list(child_som.get_weights().shape[:2]),
+            'points': [{label_column: label, 'point': int(index), 'position': [int(x), int(y)]}
+                       for label, index, (x, y) in zip(labels, indices, child_positions)],
+        })
+
+
+class SOMModelListView(APIView):
+    """
+    View to list the saved SOMs that new items can be projected onto
+    """
+
+    def get(self, request):
+        """
+        :param request: Request object
+        :return: Response with the version, type, parameters, grid size and creation time of each saved SOM
+        """
+        return Response({'models': list_som_models()})
+
+
+class SOMProjectionView(APIView):
+    """
+    View to project SNPs or diseases from the catalog onto a saved SOM without retraining it
+    """
+
+    def get(self, request, version):
+        """
+        :param request: Request object with parameters items (comma-separated SNPs or diseases) and num_clusters
+        :param version: Version of the saved SOM
+        :return: Response with the best matching unit, cluster and distance of each item found in the catalog, and
+        the items that were not found
+        """
+        model = load_som_model(version)
+        if model is None:
+            return Response({'error': 'SOM not found.'}, status=status.HTTP_404_NOT_FOUND)
+        som_type = model['type']
+        label_column = 'snp' if som_type == 'snp' else 'phewas_string'
+        items = [item.strip() for item in request.GET.get('items', '').split(',') if item.strip()]
+        if not items:
+            return Response({'error': 'Please provide the items to project.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            num_clusters = int(request.GET.get('num_clusters', 4))
+        except (TypeError, ValueError):
+            num_clusters = 0
+        if num_clusters < 1:
+            return Response({'error': 'The number of clusters must be a positive integer.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Get the catalog associations of the items, accepting SNPs with or without the HLA_ prefix
+        if som_type == 'snp':
+            queryset = HlaPheWasCatalog.objects.filter(
+                snp__in=items + [f"HLA_{item}" for item in items if not item.startswith('HLA_')])
+        else:
+            queryset = HlaPheWasCatalog.objects.filter(phewas_string__in=items)
+        df = catalog_dataframe(queryset)
+        filtered_df = preprocess_som_data(df) if not df.empty else df
+
+        results = []
+        if not filtered_df.empty:
+            features_matrix, grouped_df, feature_names = SOMView().engineer_features(filtered_df, som_type,
+                                                                                     return_feature_names=True)
+            bmus, clusters, distances = project_onto_som(model, features_matrix, feature_names, num_clusters)
+            results = [{label_column: label, 'bmu': [int(x), int(y)], 'cluster': int(cluster),
+                        'distance': float(distance)}
+                       for label, (x, y), cluster, distance in zip(grouped_df[label_column], bmus, clusters, distances)]
+
+        found = {result[label_column] for result in results}
+        missing = [item for item in items if item.removeprefix('HLA_') not in found and item not in found]
+        return Response({'version': version, 'type': som_type, 'results': results, 'missing': missing})
+
+
+def plotly_js(request, digest):
+    """
+    View to serve the plotly.js bundle matching the installed plotly version, under a URL that changes with its
+    content so that browsers can cache it indefinitely.
+
+    :param request: HttpRequest object
+    :param digest: Content hash of the bundle, as given by plotly_js_bundle
+    :return: HttpResponse with the plotly.js bundle
+    """
+    js, current_digest = plotly_js_bundle()
+    # Redirect stale URLs to the current bundle
+    if digest != current_digest:
+        return redirect('plotly_js', current_digest)
+    response = HttpResponse(js, content_type='application/javascript')
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
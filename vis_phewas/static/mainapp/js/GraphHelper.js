@@ -484,6 +484,47 @@ class GraphHelper {
       });
     });
 
+    this.relaxFlexibleNodes(graph);
+  }
+
+  /**
+   * Method for placing the nodes at the positions computed by the server, instead of laying out the graph.
+   * Alleles with multiple parents are unfixed and adjusted using ForceAtlas2, as in applyLayout.
+   * @param {Object} graph - The graph instance
+   * @param {Object} positions - Map of node ID to the [x, y] position of the node
+   */
+  applyPrecomputedLayout(graph, positions) {
+    graph.forEachNode((node, attributes) => {
+      const position = positions[node];
+      if (position) {
+        graph.setNodeAttribute(node, "x", position[0]);
+        graph.setNodeAttribute(node, "y", position[1]);
+      }
+
+      // Alleles connected to multiple diseases are flexible, as are the nodes the server could not place
+      const connectedDiseases =
+        attributes.node_type === "allele"
+          ? graph
+              .inNeighbors(node)
+              .filter(
+                (n) => graph.getNodeAttribute(n, "node_type") === "disease",
+              ).length
+          : 0;
+      graph.setNodeAttribute(
+        node,
+        "fixed",
+        (Boolean(position) || attributes.fixed) && connectedDiseases <= 1,
+      );
+    });
+
+    this.relaxFlexibleNodes(graph);
+  }
+
+  /**
+   * Method for adjusting the positions of the nodes that are not fixed with ForceAtlas2
+   * @param {Object} graph - The graph instance
+   */
+  relaxFlexibleNodes(graph) {
     // Apply Force Atlas 2 to non-fixed nodes (mainly for the flexible allele nodes)
     const settings = {
       iterations: 100,
@@ -2,7 +2,7 @@ import Graph from "graphology";
 import { Sigma } from "sigma";
 import { createNodeBorderProgram } from "@sigma/node-border";
 import GraphHelper from "./GraphHelper";
-import { closeInfoContainer } from "./utils";
+import { closeInfoContainer, decodeCompactGraph } from "./utils";
 
 // Main class for managing the graph
 class GraphManager {
@@ -116,6 +116,9 @@ class GraphManager {
     // Set the default parameters
     params.showSubtypes =
       localStorage.getItem("showSubtypes") === "true" ? "true" : "false";
+    // Ask the server for the positions of the nodes, in the compact format
+    params.layout = "true";
+    params.compact = "true";
 
     // Create a new URLSearchParams object
     const query = new URLSearchParams(params).toString();
@@ -124,7 +127,8 @@ class GraphManager {
     // Fetch the data from the URL
     fetch(url)
       .then((response) => response.json())
-      .then((data) => {
+      .then((response) => {
+        const data = decodeCompactGraph(response);
         // If the type parameter is set, update the graph
         if (params.type) {
           this.updateGraph(
@@ -132,10 +136,16 @@ class GraphManager {
             data.edges,
             data.visible,
             params.clicked,
+            data.positions,
           );
           // Otherwise, initialise the graph
         } else {
-          this.initializeGraph(data.nodes, data.edges, data.visible);
+          this.initializeGraph(
+            data.nodes,
+            data.edges,
+            data.visible,
+            data.positions,
+          );
         }
       })
       .catch((error) => console.error("Error loading graph data:", error));
@@ -146,8 +156,9 @@ class GraphManager {
    * @param {Array} nodes - Array of nodes to initialise
    * @param {Array} edges - Array of edges to initialise
    * @param {Array} visible - Array of visible nodes
+   * @param {Object} [positions=null] - Map of node ID to the position computed by the server
    */
-  initializeGraph(nodes, edges, visible) {
+  initializeGraph(nodes, edges, visible, positions = null) {
     const containerCenterX = this.container.offsetWidth / 2;
     const containerCenterY = this.container.offsetHeight / 2;
     this.graph.clear();
@@ -205,7 +216,7 @@ class GraphManager {
       }
     });
 
-    this.graphHelper.applyLayout(this.graph, this.sigmaInstance);
+    this.applyLayout(positions);
   }
 
   /**
@@ -214,8 +225,9 @@ class GraphManager {
    * @param {Array} edges - Array of edges to update
    * @param {Array} visible - Array of visible nodes
    * @param {boolean} clicked - Flag indicating if the update was triggered by a click
+   * @param {Object} [positions=null] - Map of node ID to the position computed by the server
    */
-  updateGraph(nodes, edges, visible, clicked) {
+  updateGraph(nodes, edges, visible, clicked, positions = null) {
     if (!clicked) {
       this.graph.nodes().forEach((node) => {
         this.graph.setNodeAttribute(node, "hidden", true);
@@ -276,14 +288,20 @@ class GraphManager {
     });
 
     // Apply the layout to the graph
-    this.applyLayout();
+    this.applyLayout(positions);
   }
 
   /**
    * Method to apply the layout to the graph
+   * @param {Object} [positions=null] - Map of node ID to the position computed by the server, if any
    */
-  applyLayout() {
-    this.graphHelper.applyLayout(this.graph);
+  applyLayout(positions = null) {
+    // Place the nodes where the server put them, and only lay out the graph if it did not
+    if (positions) {
+      this.graphHelper.applyPrecomputedLayout(this.graph, positions);
+    } else {
+      this.graphHelper.applyLayout(this.graph);
+    }
   }
 
   // Method to get the information table for an allele node
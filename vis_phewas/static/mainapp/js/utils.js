@@ -251,3 +251,51 @@ async function triggerNodeClick(
     console.error("Error during clickedNode execution:", error);
   }
 }
+
+/**
+ * Function to decode a graph data response in the compact format, with a string table and columnar node attributes.
+ * @param {Object} data - The compact response.
+ * @returns {Object} - The nodes, edges, visible nodes and positions (null if the response is not laid out).
+ */
+export function decodeCompactGraph(data) {
+  const strings = data.strings;
+  const columns = { ...data.nodes.columns };
+  data.nodes.string_columns.forEach((name) => {
+    columns[name] = columns[name].map((index) =>
+      index === null ? null : strings[index],
+    );
+  });
+
+  // The positions of the nodes are stored as the x and y columns
+  const xs = columns.x;
+  const ys = columns.y;
+  delete columns.x;
+  delete columns.y;
+  const positions = xs ? {} : null;
+
+  const names = Object.keys(columns);
+  const nodes = data.nodes.id.map((index, i) => {
+    const node = { id: strings[index] };
+    names.forEach((name) => {
+      if (columns[name][i] !== null) {
+        node[name] = columns[name][i];
+      }
+    });
+    if (xs && xs[i] !== null) {
+      positions[node.id] = [xs[i], ys[i]];
+    }
+    return node;
+  });
+
+  // The edges are stored as a flat list of source and target pairs
+  const edges = [];
+  for (let i = 0; i < data.edges.length; i += 2) {
+    edges.push({
+      source: strings[data.edges[i]],
+      target: strings[data.edges[i + 1]],
+    });
+  }
+  const visible = data.visible.map((index) => strings[index]);
+
+  return { nodes, edges, visible, positions };
+}
@@ -3,8 +3,10 @@
  * @param {string} filters - The filters to apply to the data.
  * @param {string} type - The type of SOM to generate ('allele' or 'disease').
  * @param {number} [num_clusters] - The number of clusters to generate. Defaults to 5 for 'disease' and 7 for 'allele'.
+ * @param {boolean} [warmStart] - Whether to start from a previous SOM trained on a similar selection.
+ * @param {boolean} [consensus] - Whether to cluster by consensus over several SOMs.
  */
-function generateSOM(filters, type, num_clusters) {
+function generateSOM(filters, type, num_clusters, warmStart, consensus) {
   // Validate the type parameter
   if (type !== "snp" && type !== "disease") {
     alert("Invalid SOM type specified. Must be 'snp' or 'disease'.");
@@ -18,44 +20,216 @@ function generateSOM(filters, type, num_clusters) {
 
   console.log("Generating SOM with filters: " + filters + ", type: " + type + ", num_clusters: " + num_clusters);
 
-  // Send the data to the server to generate the SOM
+  // The SOM page filters the catalog itself, so it is opened straight away with the filters
+  let url = "/som/SOM/?type=" + type + "&async=true&progressive=true";
+
+  // Open the SOM visualisation page
+  if (filters === "") {
+    // If no filters, it means the SOM is generated for all data as an initial SOM
+    window.open(url, "SOMWindow", "width=800,height=600,scrollbars=yes,resizable=yes");
+  } else {
+    // If filters are specified, pass them as query parameters to the SOM page
+    window.open(url + "&num_clusters=" + encodeURIComponent(num_clusters) +
+        "&filters=" + encodeURIComponent(filters) +
+        (warmStart ? "&warm_start=true" : "") +
+        (consensus ? "&consensus=true" : "")
+        , "_self")
+  }
+}
+
+/**
+ * Function to fetch the cluster metrics of the current SOM and set the number of clusters slider to the suggested
+ * number of clusters. The SOM is not retrained.
+ * @param {string} dataId - The ID of the data the SOM was trained on, or empty if it was trained on the filters of
+ * the page.
+ * @param {string} type - The type of SOM ('snp' or 'disease').
+ */
+function suggestClusters(dataId, type) {
   $.ajax({
-    url: "/api/send_data_to_som/",
+    url: "/som/cluster-metrics/",
     type: "GET",
     data: {
-      filters: filters, // Initialise with no filter but allow to pass filters
-      type: type,
-      num_clusters: num_clusters
+      data_id: dataId,
+      filters: new URLSearchParams(window.location.search).get("filters") || "",
+      type: type
     },
 
-    // Handle the response from the server
+    // Set the slider to the suggested number of clusters
     success: function (response) {
-      // Get the URL for the SOM visualisation page
-      let url = "/som/SOM/";
-
-      // Open the SOM visualisation page
-      if (filters === "") {
-        // If no filters, it means the SOM is generated for all data as an initial SOM
-        window.open(
-          url + "?data_id=" + response.data_id + "&type=" + type,
-          "SOMWindow",
-          "width=800,height=600,scrollbars=yes,resizable=yes"
-        );
-      } else {
-        // If filters are specified, pass them as query parameters to the SOM page
-        window.open(url + "?data_id=" + encodeURIComponent(response.data_id) +
-            "&num_clusters=" + encodeURIComponent(response.num_clusters) +
-            "&filters=" + encodeURIComponent(filters)+ "&type=" + type
-            , "_self")
-
+      if (response.suggested_k == null) {
+        alert("Not enough data to suggest a number of clusters.");
+        return;
       }
+      const slider = document.getElementById("clusters");
+      slider.value = response.suggested_k;
+      slider.dispatchEvent(new Event("input"));
     },
     // Handle any errors that occur during the request
     error: function (xhr, status, error) {
-      alert("Failed to generate SOM: " + error);
+      alert("Failed to suggest the number of clusters: " + error);
     },
   });
 }
 
-// Assign the function to window object for external use
-window.generateSOM = generateSOM;
\ No newline at end of file
+/**
+ * Function to render a SOM figure specification with plotly.js.
+ * @param {string} divId - The ID of the element to render the figure in.
+ * @param {Object} figure - The figure specification with its data and layout.
+ */
+function renderSOMFigure(divId, figure) {
+  const div = document.getElementById(divId);
+  div.innerHTML = "";
+  Plotly.newPlot(div, figure.data, figure.layout);
+
+  // Show the full details of a point when it is clicked, as the hover text only shows its top associations
+  const pointUrl = figure.layout.meta && figure.layout.meta.point_url;
+  if (pointUrl) {
+    div.on("plotly_click", (event) => {
+      const point = event.points.find((p) => p.customdata != null);
+      if (point) {
+        loadPointDetail(pointUrl, point.customdata, "point-detail");
+      }
+    });
+  }
+}
+
+/**
+ * Function to poll the status of a SOM trained in the background until it is no longer training.
+ * @param {string} url - The URL of the SOM status endpoint.
+ * @param {Function} onDone - Function called with the status once the SOM is no longer training ('ready', 'failed',
+ * or 'unknown' if the server process answering does not know the training, e.g. behind a load balancer).
+ * @param {number} [interval] - Polling interval in milliseconds.
+ */
+function pollSOMStatus(url, onDone, interval = 2000) {
+  fetch(url)
+    .then((response) => response.json())
+    .then((data) => {
+      if (data.status === "training") {
+        setTimeout(() => pollSOMStatus(url, onDone, interval), interval);
+      } else {
+        onDone(data.status);
+      }
+    })
+    .catch(() => setTimeout(() => pollSOMStatus(url, onDone, interval), interval));
+}
+
+/**
+ * Function to fetch the full details of a SOM point and show them in a table.
+ * @param {string} url - The URL of the SOM point endpoint for the current SOM.
+ * @param {number} pointId - The ID of the point.
+ * @param {string} detailId - The ID of the element to show the details in.
+ */
+function loadPointDetail(url, pointId, detailId) {
+  const detail = document.getElementById(detailId);
+  fetch(url + "&point=" + encodeURIComponent(pointId))
+    .then((response) => response.json().then((data) => {
+      if (!response.ok) {
+        throw new Error(data.error || response.statusText);
+      }
+      return data;
+    }))
+    .then((data) => {
+      const label = data.snp !== undefined ? "SNP: " + data.snp : "Disease: " + data.phewas_string;
+      const item = data.snp !== undefined ? "phewas_string" : "snp";
+      const table = document.createElement("table");
+      table.className = "table table-sm";
+      const header = table.insertRow();
+      [item === "snp" ? "SNP" : "Phenotype", "Odds Ratio", "P-Value"].forEach((text) => {
+        const cell = document.createElement("th");
+        cell.textContent = text;
+        header.appendChild(cell);
+      });
+      data.associations.forEach((association) => {
+        const row = table.insertRow();
+        row.insertCell().textContent = association[item];
+        row.insertCell().textContent = association.odds_ratio.toFixed(2);
+        row.insertCell().textContent = association.p.toExponential(2);
+      });
+      const title = document.createElement("h5");
+      title.textContent = label;
+      detail.replaceChildren(title, table);
+    })
+    .catch((error) => {
+      alert("Failed to load the point details: " + error.message);
+    });
+}
+
+// Number of times a preview is requested again when the status of its background training is unknown
+const SOM_PREVIEW_RETRIES = 3;
+
+/**
+ * Function to fetch the SOM figure after the page has rendered and render it. If the figure is a preview, the full
+ * SOM is polled for and rendered in its place once it has been trained. Requests rejected while the server is at
+ * capacity are retried after the Retry-After delay.
+ * @param {string} url - The URL of the SOM figure endpoint.
+ * @param {string} divId - The ID of the element to render the figure in.
+ * @param {string} csvLinkId - The ID of the link to the cluster results CSV.
+ * @param {number} [previewRetries] - Number of times the preview can still be requested again.
+ */
+function loadSOMFigure(url, divId, csvLinkId, previewRetries = SOM_PREVIEW_RETRIES) {
+  fetch(url)
+    .then((response) => {
+      // The server is at capacity, so try again once it expects to have capacity
+      const retryAfter = response.headers.get("Retry-After");
+      if ((response.status === 429 || response.status === 503) && retryAfter) {
+        document.getElementById(divId).innerHTML =
+          '<p style="margin: 5%">The server is busy, retrying in ' + retryAfter + " seconds...</p>";
+        setTimeout(() => loadSOMFigure(url, divId, csvLinkId, previewRetries), Number(retryAfter) * 1000);
+        return null;
+      }
+      if (!response.ok) {
+        return response.json().then(
+          (data) => { throw new Error(data.detail || data.error || response.statusText); },
+          () => { throw new Error(response.statusText); }
+        );
+      }
+      return response.json();
+    })
+    .then((data) => {
+      if (data === null) {
+        return;
+      }
+      renderSOMFigure(divId, data.figure);
+      const previewNote = document.getElementById("preview-note");
+      if (previewNote) {
+        previewNote.style.display = data.preview ? "" : "none";
+      }
+      if (data.preview) {
+        // Request the full figure without a preview once the SOM has been trained in the background
+        const fullUrl = new URL(url, window.location.origin);
+        fullUrl.searchParams.delete("progressive");
+        pollSOMStatus(data.status_url, (trainingStatus) => {
+          if (trainingStatus !== "unknown") {
+            loadSOMFigure(fullUrl.toString(), divId, csvLinkId);
+          } else if (previewRetries > 0) {
+            // The status was answered by a process that is not training the SOM. Requesting the full figure would
+            // train it again in the foreground, so the figure is requested progressively: it is returned if that
+            // process has the SOM, and a preview polled for again otherwise
+            loadSOMFigure(url, divId, csvLinkId, previewRetries - 1);
+          } else if (previewNote) {
+            previewNote.textContent = "Showing a preview trained on a sample. The full SOM could not be tracked, " +
+              "reload the page to try again.";
+          }
+        });
+        return;
+      }
+      document.getElementById(csvLinkId).href = data.csv_path;
+      // Note if the SOM was refined from a previous SOM
+      const warmStartNote = document.getElementById("warm-start-note");
+      if (warmStartNote && data.warm_started) {
+        warmStartNote.style.display = "";
+      }
+    })
+    .catch((error) => {
+      document.getElementById(divId).innerHTML = "";
+      alert("Failed to generate SOM: " + error.message);
+    });
+}
+
+// Assign the functions to window object for external use
+window.generateSOM = generateSOM;
+window.suggestClusters = suggestClusters;
+window.renderSOMFigure = renderSOMFigure;
+window.loadSOMFigure = loadSOMFigure;
+window.pollSOMStatus = pollSOMStatus;
+window.loadPointDetail = loadPointDetail;
\ No newline at end of file
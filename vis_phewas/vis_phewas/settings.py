@@ -110,6 +110,24 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        # Thread limits applied to the numeric stages of each request, logged at DEBUG level
+        'mainapp.compute': {
+            'handlers': ['file'],
+            'level': os.getenv('COMPUTE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        # Catalog snapshots written for the analytical reads
+        'mainapp.analytics': {
+            'handlers': ['file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+        # Estimated and actual resource usage of each SOM training
+        'som.admission': {
+            'handlers': ['file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
@@ -117,8 +135,22 @@ WSGI_APPLICATION = 'vis_phewas.wsgi.application'
 
 REST_FRAMEWORK = {
     'EXCEPTION_HANDLER': 'rest_framework.views.exception_handler',
+    # Encode JSON with orjson when it is installed, rendering NaN and infinite values as null
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     # Other DRF settings can be added here
 }
+# Number of seconds the API responses are used by caches before being revalidated with their ETag
+API_CACHE_MAX_AGE = int(os.getenv('API_CACHE_MAX_AGE', 0))
+# Version of the deployed code the ETags are derived from, so that a release changing the responses invalidates them,
+# e.g. the image tag or commit set by the build (defaults to a digest of the source of the project)
+RELEASE_VERSION = os.getenv('RELEASE_VERSION', '')
+# Number of seconds the dataset version the ETags are derived from is reused before being read again
+DATASET_VERSION_TTL = float(os.getenv('DATASET_VERSION_TTL', 30))
+# Number of items from which list responses are streamed as JSON chunk by chunk
+JSON_STREAMING_MIN_ITEMS = int(os.getenv('JSON_STREAMING_MIN_ITEMS', 10000))
 
 DATABASES = {
     'default': {
@@ -177,4 +209,46 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
 
+# Number of graph layouts each process keeps in memory, keyed by the canonical graph request
+GRAPH_LAYOUT_CACHE_SIZE = int(os.getenv('GRAPH_LAYOUT_CACHE_SIZE', 256))
+# Number of trained SOMs each process keeps in memory so they can be re-clustered without retraining
+SOM_CACHE_SIZE = int(os.getenv('SOM_CACHE_SIZE', 8))
+# Number of SOMs each process trains in the background at the same time while showing a preview
+SOM_BACKGROUND_WORKERS = int(os.getenv('SOM_BACKGROUND_WORKERS', 1))
+# Directory trained SOMs are saved in so that new items can be projected onto them without retraining
+SOM_MODEL_ROOT = os.getenv('SOM_MODEL_ROOT', BASE_DIR / 'som_models')
+# Number of SOMs the server trains at the same time and the memory they are estimated to use, beyond which SOM
+# requests wait for up to SOM_ADMISSION_WAIT seconds and are then rejected with a Retry-After hint. Each of the
+# WEB_WORKERS processes enforces an equal share of them, and may always train at least one SOM
+SOM_MAX_CONCURRENT_TRAININGS = int(os.getenv('SOM_MAX_CONCURRENT_TRAININGS', 2))
+SOM_MEMORY_BUDGET_MB = int(os.getenv('SOM_MEMORY_BUDGET_MB', 2048))
+SOM_ADMISSION_WAIT = float(os.getenv('SOM_ADMISSION_WAIT', 10))
+# Whether to trace the memory allocated by each SOM training, which slows training down, to calibrate the estimates
+SOM_PROFILE_MEMORY = os.getenv('SOM_PROFILE_MEMORY', 'false').lower() == 'true'
+
+# Number of web worker processes sharing the cores of the host (read by gunicorn from the same variable), and the
+# number of BLAS/OpenMP threads each may use, which defaults to an equal share of the cores
+WEB_WORKERS = int(os.getenv('WEB_CONCURRENCY', 1))
+COMPUTE_THREADS = int(os.getenv('COMPUTE_THREADS', 0)) or None
+
+# Hours after its last use that SOM data staged by the API is deleted by the sweep_temporary_data command
+TEMPORARY_DATA_MAX_AGE_HOURS = float(os.getenv('TEMPORARY_DATA_MAX_AGE_HOURS', 24))
+
+# Directory the Parquet snapshots of the catalog are written to by load_phewas_data and snapshot_catalog. Exports,
+# SOM inputs and combined associations are read from the snapshot of the current catalog with DuckDB if it exists
+CATALOG_SNAPSHOT_ROOT = os.getenv('CATALOG_SNAPSHOT_ROOT', BASE_DIR / 'catalog_snapshots')
+
+# Backend the files generated for download are saved with: 'local' for MEDIA_ROOT, or 's3' for an S3-compatible
+# bucket shared by several web nodes (which requires boto3, from requirements-s3.txt). The sweep_artefacts command deletes the files not used
+# for ARTEFACT_MAX_AGE_HOURS, and then the least recently used files beyond ARTEFACT_MAX_SIZE_MB
+ARTEFACT_BACKEND = os.getenv('ARTEFACT_BACKEND', 'local')
+ARTEFACT_S3_BUCKET = os.getenv('ARTEFACT_S3_BUCKET')
+ARTEFACT_S3_PREFIX = os.getenv('ARTEFACT_S3_PREFIX', '')
+ARTEFACT_S3_ENDPOINT_URL = os.getenv('ARTEFACT_S3_ENDPOINT_URL')
+ARTEFACT_S3_PUBLIC_URL = os.getenv('ARTEFACT_S3_PUBLIC_URL')
+ARTEFACT_MAX_AGE_HOURS = float(os.getenv('ARTEFACT_MAX_AGE_HOURS', 24))
+ARTEFACT_MAX_SIZE_MB = float(os.getenv('ARTEFACT_MAX_SIZE_MB', 512))
+# Format the cluster results of a SOM are saved in: 'csv' or 'csv.gz'
+CLUSTER_RESULTS_FORMAT = os.getenv('CLUSTER_RESULTS_FORMAT', 'csv')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'